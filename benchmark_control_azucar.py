@@ -0,0 +1,405 @@
+"""
+Benchmarks de las rutas críticas con historiales sintéticos.
+
+Genera historiales reproducibles (semilla fija) de 1.000 a 1.000.000 de
+registros, incluidas filas antiguas con `nivel_azucar`, y mide la carga y el
+guardado del archivo, la construcción del árbol del historial (Tk, con un
+Xvfb temporal si no hay pantalla), el borrado de registros marcados y los
+exportadores. Los resultados se pueden guardar como línea base JSON y
+comparar con ella para avisar de regresiones.
+
+También conserva la comparación de la exportación a Excel clásica (Workbook
+normal, un Border/Alignment/PatternFill por celda) con el pipeline de una
+sola pasada y su `SumideroExcel` write-only, y compara el archivo de datos en
+JSON plano con sus versiones comprimidas (.json.gz, .json.xz): tamaño,
+tiempos de lectura, carga y guardado, y pico de memoria al leer.
+
+Uso:
+    python benchmark_control_azucar.py --tamanos 1000 10000 100000
+    python benchmark_control_azucar.py --guardar-base benchmark_base.json
+    python benchmark_control_azucar.py --base benchmark_base.json --umbral 0.25
+    python benchmark_control_azucar.py --excel-clasico --registros 100000
+    python benchmark_control_azucar.py --compresion --tamanos 10000 100000
+"""
+import argparse
+import contextlib
+import copy
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from control_azucar_app import (
+    AlmacenRegistros, FRANJAS_PREDETERMINADAS, ServicioExportacion, crear_sumidero, ejecutar_exportacion,
+    leer_datos
+)
+
+ALIMENTOS_EJEMPLO = [
+    "Avena", "Plátano", "Leche", "Nueces", "Pan integral", "Huevos revueltos",
+    "Café", "Yogur", "Manzana", "Arroz", "Pollo", "Ensalada", "Lentejas"
+]
+COMIDAS_EJEMPLO = ["Desayuno", "Almuerzo", "Comida", "Merienda", "Cena"]
+TAMANOS_PREDETERMINADOS = [1000, 10000, 100000]
+
+def generar_registros(cantidad, semilla=42, proporcion_legacy=0.0):
+    """
+    Generar registros sintéticos con la misma estructura que la app.
+
+    Con `proporcion_legacy` > 0 esa fracción de filas tiene el formato antiguo
+    (`tipo_comida` y `nivel_azucar`, sin id ni antes/después), como los
+    archivos creados por las primeras versiones.
+    """
+    rnd = random.Random(semilla)
+    inicio = datetime(2020, 1, 1, 7, 0)
+    registros = []
+    for i in range(cantidad):
+        momento = inicio + timedelta(minutes=180 * i)
+        alimentos = rnd.sample(ALIMENTOS_EJEMPLO, rnd.randint(1, 5))
+        if rnd.random() < proporcion_legacy:
+            registros.append({
+                "fecha": momento.strftime("%Y-%m-%d"),
+                "hora": momento.strftime("%H:%M"),
+                "tipo_comida": rnd.choice(COMIDAS_EJEMPLO).lower(),
+                "nivel_azucar": round(rnd.uniform(60, 220), 1),
+                "alimentos": alimentos,
+                "foto_path": None,
+                "timestamp": momento.isoformat()
+            })
+            continue
+        registros.append({
+            "fecha": momento.strftime("%Y-%m-%d"),
+            "hora": momento.strftime("%H:%M"),
+            "nombre_comida": rnd.choice(COMIDAS_EJEMPLO),
+            "azucar_antes": round(rnd.uniform(60, 130), 1),
+            "azucar_despues": round(rnd.uniform(90, 220), 1),
+            "alimentos": alimentos,
+            "foto_path": None,
+            "timestamp": momento.isoformat(),
+            "fuente_fecha": "EXIF"
+        })
+    return registros
+
+def escribir_historial(ruta, registros):
+    """Escribir un archivo de datos como el de la app con esos registros"""
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump({
+            "registros": registros,
+            "configuracion": {"franjas_horarias": copy.deepcopy(FRANJAS_PREDETERMINADAS)}
+        }, f, ensure_ascii=False, indent=2)
+
+# ---------------------------------------------------------------------------
+# Comparación de la exportación a Excel clásica con la de streaming
+# ---------------------------------------------------------------------------
+
+def exportar_excel_clasico(filename, registros):
+    """Ruta anterior: Workbook normal con estilos creados celda a celda"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Control de Azúcar"
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+    border = Border(
+        left=Side(style='thin'), right=Side(style='thin'),
+        top=Side(style='thin'), bottom=Side(style='thin')
+    )
+    headers = ['📅 Fecha', '🕐 Hora', '🍽️ Comida', '📉 Azúcar Antes', '📈 Azúcar Después', '🥗 Alimentos', '📊 Estado']
+    for col, header in enumerate(headers, 1):
+        cell = ws.cell(row=5, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.border = border
+
+    for row, registro in enumerate(registros, start=6):
+        nivel = max(registro['azucar_antes'], registro['azucar_despues'])
+        estado_color = "51CF66" if 70 <= nivel <= 140 else "FFD43B"
+        datos_fila = [
+            registro['fecha'], registro['hora'], registro['nombre_comida'],
+            f"{registro['azucar_antes']} mg/dL", f"{registro['azucar_despues']} mg/dL",
+            ', '.join(registro['alimentos']), "estado"
+        ]
+        for col, valor in enumerate(datos_fila, 1):
+            cell = ws.cell(row=row, column=col, value=valor)
+            cell.border = border
+            cell.alignment = Alignment(vertical='center')
+            if col == 7:
+                cell.fill = PatternFill(start_color=estado_color, end_color=estado_color, fill_type="solid")
+                cell.font = Font(bold=True, color="FFFFFF")
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+    wb.save(filename)
+
+def exportar_excel_streaming(filename, registros):
+    """Ruta nueva: modo write-only con estilos con nombre"""
+    ejecutar_exportacion(iter(registros), [crear_sumidero(filename)], len(registros))
+
+def medir(funcion, registros, directorio):
+    """Medir tiempo y pico de memoria de una exportación"""
+    filename = os.path.join(directorio, f"{funcion.__name__}.xlsx")
+
+    inicio = time.perf_counter()
+    funcion(filename, registros)
+    segundos = time.perf_counter() - inicio
+
+    tracemalloc.start()
+    funcion(filename, registros)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return segundos, pico / (1024 * 1024), os.path.getsize(filename) / (1024 * 1024)
+
+def comparar_excel(cantidad):
+    registros = generar_registros(cantidad)
+    print(f"📊 Exportando {cantidad} registros")
+    with tempfile.TemporaryDirectory() as directorio:
+        for funcion in (exportar_excel_clasico, exportar_excel_streaming):
+            segundos, pico_mb, tamano_mb = medir(funcion, registros, directorio)
+            print(f"{funcion.__name__:28} {segundos:8.2f} s  pico {pico_mb:8.1f} MB  archivo {tamano_mb:6.1f} MB")
+
+# ---------------------------------------------------------------------------
+# Archivo de datos comprimido frente a JSON plano
+# ---------------------------------------------------------------------------
+
+def comparar_compresion(tamanos, repeticiones=3):
+    """Tamaño, lectura, carga (con índices) y guardado del archivo de datos en cada formato"""
+    with tempfile.TemporaryDirectory() as directorio:
+        for cantidad in tamanos:
+            print(f"\n🗜️ {cantidad} registros")
+            repes = repeticiones if cantidad <= 100000 else 1
+            plano = os.path.join(directorio, f"historial_{cantidad}.json")
+            escribir_historial(plano, generar_registros(cantidad))
+            AlmacenRegistros(plano)  # Migración (ids, alimentos, franjas) una sola vez
+            tamano_plano = os.path.getsize(plano)
+            for compresion in ("", ".gz", ".xz"):
+                ruta = plano + compresion
+                if compresion:
+                    AlmacenRegistros(ruta).guardar()  # Parte del JSON plano y lo guarda comprimido
+                almacen = AlmacenRegistros(ruta)
+                leer = mejor_de(repes, lambda: leer_datos(ruta, compresion))
+                cargar = mejor_de(repes, lambda: AlmacenRegistros(ruta))
+                guardar = mejor_de(repes, almacen.guardar)
+                del almacen
+
+                tracemalloc.start()
+                leer_datos(ruta, compresion)
+                _, pico = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                tamano = os.path.getsize(ruta)
+                print(f"   {'.json' + compresion:10} {tamano / 1024 / 1024:8.2f} MB ({tamano / tamano_plano:6.1%})"
+                      f"  leer {leer:7.3f} s  cargar {cargar:7.3f} s  guardar {guardar:7.3f} s"
+                      f"  pico al leer {pico / 1024 / 1024:7.1f} MB")
+
+# ---------------------------------------------------------------------------
+# Suite de rutas críticas
+# ---------------------------------------------------------------------------
+
+def cronometrar(funcion):
+    """Segundos que tarda `funcion()`"""
+    inicio = time.perf_counter()
+    funcion()
+    return time.perf_counter() - inicio
+
+def mejor_de(repeticiones, funcion, preparar=None):
+    """Mejor tiempo de varias repeticiones (`preparar` se ejecuta antes de cada una sin medirse)"""
+    tiempos = []
+    for _ in range(repeticiones):
+        if preparar:
+            preparar()
+        tiempos.append(cronometrar(funcion))
+    return min(tiempos)
+
+@contextlib.contextmanager
+def pantalla_virtual():
+    """
+    Asegurar una pantalla para Tk: la actual si existe o, en Linux sin
+    DISPLAY, un Xvfb temporal si está instalado. Devuelve si hay pantalla.
+    """
+    if os.name == "nt" or sys.platform == "darwin" or os.environ.get("DISPLAY"):
+        yield True
+        return
+    xvfb = shutil.which("Xvfb")
+    if not xvfb:
+        yield False
+        return
+    numero = 90 + os.getpid() % 100
+    proceso = subprocess.Popen([xvfb, f":{numero}", "-screen", "0", "1600x1000x24", "-nolisten", "tcp"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        if os.path.exists(f"/tmp/.X11-unix/X{numero}") or proceso.poll() is not None:
+            break
+        time.sleep(0.1)
+    os.environ["DISPLAY"] = f":{numero}"
+    try:
+        yield proceso.poll() is None
+    finally:
+        del os.environ["DISPLAY"]
+        proceso.terminate()
+        proceso.wait()
+
+def medir_historial_tk(ruta, repeticiones=1):
+    """Mejor tiempo de `mostrar_historial` hasta que Tk ha dibujado el árbol (None si no hay Tk)"""
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+    except Exception:
+        return None
+    from control_azucar_app import ControlAzucarApp
+
+    root.withdraw()
+    os.environ["DATA_FILE"] = ruta
+    os.environ.pop("API_PUERTO", None)
+    try:
+        app = ControlAzucarApp(root)
+
+        def mostrar():
+            app.mostrar_historial()
+            root.update()
+
+        def cerrar_ventanas():
+            for ventana in root.winfo_children():
+                if isinstance(ventana, tk.Toplevel):
+                    ventana.destroy()
+            root.update()
+
+        return mejor_de(repeticiones, mostrar, cerrar_ventanas)
+    finally:
+        root.destroy()
+
+def ejecutar_suite(tamanos, directorio, repeticiones=3, maximo_tk=100000, proporcion_legacy=0.05):
+    """Medir cada ruta para cada tamaño; devuelve {tamaño: {caso: segundos}}"""
+    resultados = {}
+    with pantalla_virtual() as hay_pantalla:
+        for cantidad in tamanos:
+            print(f"\n📊 {cantidad} registros")
+            repes = repeticiones if cantidad <= 100000 else 1
+            ruta = os.path.join(directorio, f"historial_{cantidad}.json")
+            tiempos = {}
+
+            registros = generar_registros(cantidad, proporcion_legacy=proporcion_legacy)
+            # Primera carga: asigna ids, alimentos canónicos y franjas, y guarda
+            tiempos["cargar (con migración)"] = mejor_de(repes, lambda: AlmacenRegistros(ruta),
+                                                         lambda: escribir_historial(ruta, registros))
+            registros = None  # Liberar la memoria antes del resto de casos
+            tiempos["cargar"] = mejor_de(repes, lambda: AlmacenRegistros(ruta))
+
+            almacen = AlmacenRegistros(ruta)
+            tiempos["guardar"] = mejor_de(repes, almacen.guardar)
+
+            if not hay_pantalla:
+                print("   (sin pantalla ni Xvfb: se omite el árbol del historial)")
+            elif cantidad > maximo_tk:
+                print(f"   (árbol del historial omitido: más de {maximo_tk} registros)")
+            else:
+                tiempo = medir_historial_tk(ruta, repes)
+                if tiempo is not None:
+                    tiempos["historial (árbol Tk)"] = tiempo
+
+            servicio = ServicioExportacion(almacen)
+            for caso, destinos in (
+                ("exportar csv", ["exportacion.csv"]),
+                ("exportar jsonl", ["exportacion.jsonl"]),
+                ("exportar excel", ["exportacion.xlsx"]),
+                ("exportar varios formatos", ["varios.xlsx", "varios.csv", "varios.jsonl"]),
+            ):
+                rutas = [os.path.join(directorio, destino) for destino in destinos]
+                tiempos[caso] = mejor_de(repes, lambda: servicio.exportar(rutas))
+
+            # Borrar el 1 % de los registros marcados, con los índices ya construidos (como en la app);
+            # antes de cada repetición se recupera el archivo sin borrar y se vuelve a cargar
+            copia = ruta + ".antes_de_borrar"
+            shutil.copyfile(ruta, copia)
+            borrado = {}
+
+            def preparar_borrado():
+                shutil.copyfile(copia, ruta)
+                borrado["almacen"] = AlmacenRegistros(ruta)
+                borrado["almacen"].indice_alimentos
+                borrado["almacen"].indice_sugerencias
+                borrado["marcados"] = borrado["almacen"].registros[::100]
+
+            tiempos["borrar marcados (1 %)"] = mejor_de(
+                repes, lambda: borrado["almacen"].borrar(borrado["marcados"]), preparar_borrado)
+            os.remove(copia)
+
+            for caso, segundos in tiempos.items():
+                print(f"   {caso:28} {segundos:9.3f} s")
+            resultados[str(cantidad)] = tiempos
+    return resultados
+
+def comparar_con_base(resultados, base, umbral, minimo):
+    """
+    Listar las regresiones: casos que tardan más de `umbral` (proporción)
+    por encima de la base y al menos `minimo` segundos más
+    """
+    regresiones = []
+    for cantidad, tiempos in resultados.items():
+        anteriores = base.get("resultados", {}).get(cantidad, {})
+        for caso, segundos in tiempos.items():
+            anterior = anteriores.get(caso)
+            if anterior is None:
+                continue
+            if segundos > anterior * (1 + umbral) and segundos - anterior >= minimo:
+                regresiones.append((cantidad, caso, anterior, segundos))
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de las rutas críticas")
+    parser.add_argument("--tamanos", type=int, nargs="+", default=TAMANOS_PREDETERMINADOS,
+                        help="número de registros de cada historial (1000 a 1000000)")
+    parser.add_argument("--repeticiones", type=int, default=3, help="se toma el mejor tiempo")
+    parser.add_argument("--legacy", type=float, default=0.05, help="proporción de filas con nivel_azucar")
+    parser.add_argument("--maximo-tk", type=int, default=100000, help="tamaño máximo para medir el árbol Tk")
+    parser.add_argument("--guardar-base", metavar="JSON", help="guardar los resultados como línea base")
+    parser.add_argument("--base", metavar="JSON", help="comparar con una línea base guardada")
+    parser.add_argument("--umbral", type=float, default=0.25, help="regresión si tarda esta proporción más")
+    parser.add_argument("--minimo", type=float, default=0.02, help="diferencia mínima en segundos para avisar")
+    parser.add_argument("--excel-clasico", action="store_true", help="solo comparar Excel clásico vs streaming")
+    parser.add_argument("--registros", type=int, default=100000, help="registros para --excel-clasico")
+    parser.add_argument("--compresion", action="store_true",
+                        help="solo comparar el archivo de datos en JSON plano, .json.gz y .json.xz")
+    args = parser.parse_args()
+
+    if args.excel_clasico:
+        comparar_excel(args.registros)
+        return 0
+    if args.compresion:
+        comparar_compresion(args.tamanos, args.repeticiones)
+        return 0
+
+    with tempfile.TemporaryDirectory() as directorio:
+        resultados = ejecutar_suite(args.tamanos, directorio, args.repeticiones, args.maximo_tk, args.legacy)
+
+    if args.guardar_base:
+        with open(args.guardar_base, 'w', encoding='utf-8') as f:
+            json.dump({
+                "fecha": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "plataforma": platform.platform(),
+                "resultados": resultados,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Línea base guardada en {args.guardar_base}")
+
+    if args.base:
+        with open(args.base, 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        regresiones = comparar_con_base(resultados, base, args.umbral, args.minimo)
+        if regresiones:
+            print(f"\n⚠️ {len(regresiones)} regresión(es) respecto a {args.base} (umbral {args.umbral:.0%}):")
+            for cantidad, caso, anterior, segundos in regresiones:
+                print(f"   {cantidad:>8} {caso:28} {anterior:8.3f} s → {segundos:8.3f} s ({segundos / anterior - 1:+.0%})")
+            return 1
+        print(f"\n✅ Sin regresiones respecto a {args.base}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
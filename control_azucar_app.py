@@ -1,13 +1,24 @@
+import time
+
+# Tiempos de arranque (segundos por fase); ver `informe_arranque`
+_INICIO_ARRANQUE = time.perf_counter()
+TIEMPOS_ARRANQUE = {}
+
 import os
 import sys
 
 # Configurar variables de entorno ANTES de cualquier otra importación
 from dotenv import load_dotenv
 
+def ruta_env():
+    """Ruta del .env: junto al ejecutable si la app está congelada, si no en el directorio actual"""
+    if getattr(sys, 'frozen', False):
+        return os.path.join(os.path.dirname(sys.executable), '.env')
+    return '.env'
+
 def cargar_env_ejecutable():
     if getattr(sys, 'frozen', False):
-        exe_dir = os.path.dirname(sys.executable)
-        env_path = os.path.join(exe_dir, '.env')
+        env_path = ruta_env()
         if os.path.exists(env_path):
             load_dotenv(env_path)
         else:
@@ -20,34 +31,66 @@ def cargar_env_ejecutable():
         load_dotenv()
 
 cargar_env_ejecutable()
-
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
-from PIL import Image, ImageTk
-from PIL.ExifTags import TAGS
+TIEMPOS_ARRANQUE["entorno (.env)"] = time.perf_counter() - _INICIO_ARRANQUE
+
+# PIL, requests y exifread se importan en su primer uso (ver `informe_arranque`)
+_inicio = time.perf_counter()
+try:
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox
+except ImportError:  # Sin Tk (p. ej. un servidor): el núcleo sin interfaz sigue funcionando
+    tk = ttk = filedialog = messagebox = None
+TIEMPOS_ARRANQUE["importar tkinter"] = time.perf_counter() - _inicio
+
+_inicio = time.perf_counter()
 import json
-import requests
 import base64
-from datetime import datetime
-import exifread
+from array import array
+import bisect
+import collections
+import contextlib
+import copy
+import heapq
+import itertools
+import math
+import queue
+import re
+import threading
+import uuid
+from datetime import datetime, timedelta
+TIEMPOS_ARRANQUE["importar biblioteca estándar"] = time.perf_counter() - _inicio
+
+# Módulos pesados que no deberían cargarse antes de mostrar la ventana
+MODULOS_DIFERIDOS = ("PIL", "requests", "exifread", "numpy", "pandas", "matplotlib", "openpyxl")
+
+def informe_arranque():
+    """Texto con el tiempo de cada fase del arranque y los módulos pesados ya cargados"""
+    lineas = ["⏱️ Tiempos de arranque"]
+    for fase, segundos in TIEMPOS_ARRANQUE.items():
+        lineas.append(f"  {fase:30} {segundos * 1000:8.1f} ms")
+    cargados = [m for m in MODULOS_DIFERIDOS if m in sys.modules]
+    lineas.append(f"  Módulos pesados cargados: {', '.join(cargados) if cargados else 'ninguno'}")
+    return "\n".join(lineas)
 
 class AbacusAIClient:
     """Cliente para interactuar con la API de Abacus.AI"""
 
     def __init__(self):
+        error = self.error_configuracion()
+        if error:
+            raise ValueError(error)
         self.api_key = os.getenv('ABACUS_API_KEY')
         self.api_url = os.getenv('ABACUS_API_URL')
 
-        if not self.api_key:
-            if getattr(sys, 'frozen', False):
-                raise ValueError("Error de configuración en el ejecutable. Contacta al desarrollador.")
-            else:
-                raise ValueError("ABACUS_API_KEY no encontrada en el archivo .env")
-        if not self.api_url:
-            if getattr(sys, 'frozen', False):
-                raise ValueError("Error de configuración en el ejecutable. Contacta al desarrollador.")
-            else:
-                raise ValueError("ABACUS_API_URL no encontrada en el archivo .env")
+    @staticmethod
+    def error_configuracion():
+        """Mensaje de error si faltan variables de entorno, o None (sin crear el cliente)"""
+        for variable in ('ABACUS_API_KEY', 'ABACUS_API_URL'):
+            if not os.getenv(variable):
+                if getattr(sys, 'frozen', False):
+                    return "Error de configuración en el ejecutable. Contacta al desarrollador."
+                return f"{variable} no encontrada en el archivo .env"
+        return None
 
     def encode_image_to_base64(self, image_path):
         """Convertir imagen a base64 para enviar a la API"""
@@ -61,6 +104,8 @@ class AbacusAIClient:
         """
         Identificar alimentos en una imagen usando Abacus.AI
         """
+        import requests
+
         try:
             # Codificar imagen a base64
             base64_image = self.encode_image_to_base64(image_path)
@@ -127,122 +172,4309 @@ Solo menciona alimentos específicos que puedas ver claramente en la imagen. No
         except Exception as e:
             raise Exception(f"Error al identificar alimentos: {str(e)}")
 
-class ControlAzucarApp:
-    def __init__(self, root):
-        self.root = root
-        self.root.title(os.getenv('APP_NAME', 'Control de Azúcar y Alimentación'))
-        self.root.geometry("850x700")
+# Colores de la columna de estado en Excel (nombre de estilo -> color de relleno)
+COLORES_ESTADO_EXCEL = {
+    "estado_bajo": "FF6B6B",
+    "estado_normal": "51CF66",
+    "estado_alto": "FFD43B",
+    "estado_muy_alto": "FF6B6B",
+    "estado_sin_datos": "CCCCCC",
+}
+
+def clasificar_estado_azucar(nivel):
+    """Devolver (texto, nombre de estilo) del estado para un nivel de azúcar"""
+    if nivel is None:
+        return "❓ Sin datos", "estado_sin_datos"
+    if nivel < 70:
+        return "🔻 Bajo", "estado_bajo"
+    elif nivel <= 140:
+        return "✅ Normal", "estado_normal"
+    elif nivel <= 200:
+        return "⚠️ Alto", "estado_alto"
+    return "🔴 Muy Alto", "estado_muy_alto"
+
+def ahora_iso():
+    """Marca de tiempo actual con microsegundos, comparable como texto"""
+    return datetime.now().isoformat(timespec='microseconds')
+
+def asegurar_identificadores(datos):
+    """
+    Asignar `id` y `actualizado` a los registros que aún no los tienen.
+
+    A los registros antiguos se les pone como fecha de actualización su propio
+    timestamp. Devuelve cuántos registros se han modificado.
+    """
+    cambiados = 0
+    for registro in datos["registros"]:
+        if "id" not in registro:
+            registro["id"] = uuid.uuid4().hex
+            registro.setdefault("actualizado", registro.get("timestamp") or ahora_iso())
+            cambiados += 1
+    return cambiados
+
+def clave_destino(filename):
+    """Clave normalizada de un destino de exportación para guardar su marca"""
+    return os.path.normcase(os.path.abspath(filename))
+
+def registros_desde_marca(registros, marca):
+    """Registros nuevos o modificados después de la marca `actualizado` dada"""
+    if not marca:
+        return list(registros)
+    return [r for r in registros if r.get("actualizado", "") > marca]
+
+def materializar_fila(registro):
+    """
+    Calcular una sola vez todas las columnas derivadas de un registro.
+
+    Es la única fuente de las reglas de exportación: nombre de la comida con
+    respaldo a `tipo_comida`, valor legacy `nivel_azucar` solo cuando no hay
+    antes/después, y estado según el nivel más alto disponible.
+    """
+    azucar_antes = registro.get('azucar_antes')
+    azucar_despues = registro.get('azucar_despues')
+    nivel_azucar_legacy = registro.get('nivel_azucar')  # Para compatibilidad
+
+    niveles = [n for n in (azucar_antes, azucar_despues) if n is not None]
+    if not niveles and nivel_azucar_legacy is not None:
+        niveles.append(nivel_azucar_legacy)
+    else:
+        nivel_azucar_legacy = None
+
+    estado, estilo_estado = clasificar_estado_azucar(max(niveles) if niveles else None)
+    alimentos = registro.get('alimentos', [])
+
+    return {
+        "id": registro.get("id", ""),
+        "actualizado": registro.get("actualizado", ""),
+        "fecha": registro['fecha'],
+        "hora": registro['hora'],
+        "nombre_comida": registro.get("nombre_comida") or registro.get("tipo_comida") or "Sin nombre",
+        "azucar_antes": azucar_antes,
+        "azucar_despues": azucar_despues,
+        "nivel_azucar_legacy": nivel_azucar_legacy,
+        "alimentos": alimentos,
+        "alimentos_str": ', '.join(alimentos),
+        "niveles": niveles,
+        "estado": estado,
+        "estilo_estado": estilo_estado,
+    }
+
+# Objetivo de glucosa por defecto (mg/dL), el mismo que usa la clasificación de estados
+OBJETIVO_GLUCOSA = (70, 140)
+PERCENTILES_GLUCOSA = (5, 25, 50, 75, 95)
+
+def calcular_estadisticas_glucosa(valores, objetivo=OBJETIVO_GLUCOSA):
+    """
+    Estadísticas vectorizadas de un conjunto de lecturas de glucosa (mg/dL).
+
+    Devuelve media, desviación, coeficiente de variación, percentiles, tiempo
+    en/bajo/sobre rango y GMI (3.31 + 0.02392 × media). Con `valores` vacío
+    devuelve None.
+    """
+    import numpy as np
+
+    valores = np.asarray(valores, dtype=float)
+    if valores.size == 0:
+        return None
+
+    bajo, alto = objetivo
+    media = float(valores.mean())
+    desviacion = float(valores.std(ddof=1)) if valores.size > 1 else 0.0
+    percentiles = np.percentile(valores, PERCENTILES_GLUCOSA)
+    en_rango = int(np.count_nonzero((valores >= bajo) & (valores <= alto)))
+    bajo_rango = int(np.count_nonzero(valores < bajo))
+
+    return {
+        "lecturas": int(valores.size),
+        "media": media,
+        "desviacion": desviacion,
+        "cv": desviacion / media * 100 if media else 0.0,
+        "minimo": float(valores.min()),
+        "maximo": float(valores.max()),
+        "percentiles": {p: float(v) for p, v in zip(PERCENTILES_GLUCOSA, percentiles)},
+        "objetivo": objetivo,
+        "en_rango": en_rango,
+        "bajo_rango": bajo_rango,
+        "sobre_rango": int(valores.size) - en_rango - bajo_rango,
+        "tir": en_rango / valores.size * 100,
+        "tbr": bajo_rango / valores.size * 100,
+        "tar": (valores.size - en_rango - bajo_rango) / valores.size * 100,
+        "gmi": 3.31 + 0.02392 * media,
+    }
+
+class AcumuladorEstadisticas:
+    """
+    Estadísticas de azúcar acumuladas fila a fila.
+
+    Solo guarda las lecturas en un `array('d')` compacto; el cálculo se hace
+    de una vez y vectorizado con `calcular_estadisticas_glucosa`.
+    """
+
+    def __init__(self, objetivo=OBJETIVO_GLUCOSA):
+        self.objetivo = objetivo
+        self.registros = 0
+        self.valores = array('d')
+
+    def agregar(self, fila):
+        self.registros += 1
+        self.valores.extend(fila["niveles"])
+
+    def resultado(self):
+        return calcular_estadisticas_glucosa(self.valores, self.objetivo)
+
+    def filas_resumen(self):
+        """Filas (etiqueta, valor) para la hoja de estadísticas"""
+        e = self.resultado()
+        if not e:
+            return []
+        bajo, alto = e["objetivo"]
+        p = e["percentiles"]
+        return [
+            ("📊 ESTADÍSTICAS DE AZÚCAR", ""),
+            ("", ""),
+            ("📈 Nivel promedio", f"{e['media']:.1f} mg/dL"),
+            ("🔺 Nivel máximo", f"{e['maximo']:g} mg/dL"),
+            ("🔻 Nivel mínimo", f"{e['minimo']:g} mg/dL"),
+            ("📏 Desviación estándar", f"{e['desviacion']:.1f} mg/dL"),
+            ("〰️ Coeficiente de variación", f"{e['cv']:.1f}%"),
+            ("🩸 GMI (HbA1c estimada)", f"{e['gmi']:.1f}%"),
+            ("", ""),
+            ("📊 PERCENTILES", ""),
+            ("P5 / P25", f"{p[5]:.0f} / {p[25]:.0f} mg/dL"),
+            ("Mediana", f"{p[50]:.0f} mg/dL"),
+            ("P75 / P95", f"{p[75]:.0f} / {p[95]:.0f} mg/dL"),
+            ("", ""),
+            ("📊 DISTRIBUCIÓN", ""),
+            (f"✅ Registros normales ({bajo}-{alto})", e["en_rango"]),
+            (f"⚠️ Registros altos (>{alto})", e["sobre_rango"]),
+            (f"🔻 Registros bajos (<{bajo})", e["bajo_rango"]),
+            ("", ""),
+            ("📈 Porcentaje normal", f"{e['tir']:.1f}%"),
+            ("⚠️ Porcentaje alto", f"{e['tar']:.1f}%"),
+            ("🔻 Porcentaje bajo", f"{e['tbr']:.1f}%"),
+        ]
 
-        # Inicializar cliente de Abacus.AI
-        try:
-            self.ai_client = AbacusAIClient()
-        except Exception as e:
-            messagebox.showerror("Error de Configuración", 
-                               f"Error al inicializar Abacus.AI: {str(e)}\n\n"
-                               "Verifica tu archivo .env")
-            self.ai_client = None
+class MotorAnaliticas:
+    """
+    Analíticas de glucosa sobre el historial con NumPy/pandas.
+
+    La tabla de lecturas se construye una vez por versión de los datos, ordenada
+    por momento, de modo que cualquier rango de fechas se resuelve con
+    `searchsorted`. Los resultados se guardan en caché por (rango, objetivo) y
+    se descartan con `invalidar()` cada vez que cambian los datos.
+
+    Se puede consultar sin el cerrojo del almacén: la tabla se construye
+    sobre una copia de la lista de registros, y lo calculado mientras cambiaba
+    la versión se devuelve pero no se guarda.
+    """
+
+    def __init__(self, obtener_registros):
+        self._obtener_registros = obtener_registros
+        self._tabla = None
+        self._cache = {}
+        self.version = 0  # Cambia con cada invalidación; otras cachés la usan como clave
+
+    def invalidar(self):
+        """Descartar tabla y resultados tras un cambio en los registros"""
+        self.version += 1  # Antes de vaciar: lo que se esté calculando con la versión anterior no se guardará
+        self._tabla = None
+        self._cache.clear()
+
+    def tabla(self):
+        """DataFrame de registros ordenado por momento (una fila por registro)"""
+        tabla = self._tabla
+        if tabla is None:
+            import pandas as pd
+
+            version = self.version
+            registros = list(self._obtener_registros())
+            tabla = pd.DataFrame.from_records(
+                [(r.get("timestamp"), r.get("fecha"), r.get("hora"),
+                  r.get("nombre_comida") or r.get("tipo_comida") or "Sin nombre",
+                  r.get("azucar_antes"), r.get("azucar_despues"), r.get("nivel_azucar"))
+                 for r in registros],
+                columns=["timestamp", "fecha", "hora", "comida", "antes", "despues", "legacy"]
+            )
+            momento = pd.to_datetime(tabla["timestamp"], format="ISO8601", errors="coerce")
+            respaldo = pd.to_datetime(tabla["fecha"] + " " + tabla["hora"], format="%Y-%m-%d %H:%M", errors="coerce")
+            tabla["momento"] = momento.fillna(respaldo)
+            for columna in ("antes", "despues", "legacy"):
+                tabla[columna] = pd.to_numeric(tabla[columna], errors="coerce")
+            # El valor legacy solo cuenta si el registro no tiene antes/después
+            tabla.loc[tabla["antes"].notna() | tabla["despues"].notna(), "legacy"] = float("nan")
+            tabla = tabla.dropna(subset=["momento"]).sort_values("momento", kind="stable")
+            tabla = tabla.drop(columns=["timestamp"]).reset_index(drop=True)
+            if self.version == version:
+                self._tabla = tabla
+        return tabla
+
+    def rango(self, desde=None, hasta=None):
+        """Filas entre `desde` y `hasta` (fechas o textos YYYY-MM-DD, ambos incluidos)"""
+        import pandas as pd
+
+        tabla = self.tabla()
+        momentos = tabla["momento"].values
+        inicio = 0 if desde is None else momentos.searchsorted(pd.Timestamp(desde).to_datetime64(), side="left")
+        if hasta is None:
+            fin = len(tabla)
+        else:
+            limite = pd.Timestamp(hasta).normalize() + pd.Timedelta(days=1)
+            fin = momentos.searchsorted(limite.to_datetime64(), side="left")
+        return tabla.iloc[inicio:fin]
+
+    def resumen(self, desde=None, hasta=None, objetivo=OBJETIVO_GLUCOSA):
+        """Estadísticas del rango, incluida la variación antes→después por comida"""
+        clave = (str(desde) if desde else None, str(hasta) if hasta else None, tuple(objetivo))
+        resultado = self._cache.get(clave)
+        if resultado is not None:
+            return resultado
+
+        import numpy as np
+
+        version = self.version
+        filas = self.rango(desde, hasta)
+        valores = np.concatenate([filas[c].to_numpy() for c in ("antes", "despues", "legacy")])
+        valores = valores[~np.isnan(valores)]
+
+        pares = filas.dropna(subset=["antes", "despues"])
+        deltas = (pares["despues"] - pares["antes"]).groupby(pares["comida"]).agg(["count", "mean", "median", "max"])
+        por_comida = [
+            {"comida": comida, "pares": int(fila["count"]), "delta_media": float(fila["mean"]),
+             "delta_mediana": float(fila["median"]), "delta_maxima": float(fila["max"])}
+            for comida, fila in deltas.sort_values("mean", ascending=False).iterrows()
+        ]
 
-        # Datos de la aplicación
-        self.datos_file = os.getenv('DATA_FILE', 'control_alimentacion.json')
-        self.cargar_datos()
+        resultado = {
+            "registros": len(filas),
+            "glucosa": calcular_estadisticas_glucosa(valores, tuple(objetivo)),
+            "por_comida": por_comida,
+        }
+        if self.version == version:
+            self._cache[clave] = resultado
+        return resultado
+
+def reducir_lttb(x, y, umbral):
+    """
+    Reducir una serie a `umbral` puntos con Largest-Triangle-Three-Buckets.
+
+    Conserva la forma visual (picos y valles) de la serie; `x` debe estar
+    ordenado. Devuelve los arrays originales si ya caben en el umbral.
+    """
+    import numpy as np
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if umbral >= n or umbral < 3:
+        return x, y
+
+    indices = np.empty(umbral, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    cada = (n - 2) / (umbral - 2)
+    a = 0
+    for i in range(umbral - 2):
+        # Punto medio de la cubeta siguiente
+        sig_ini = int((i + 1) * cada) + 1
+        sig_fin = min(int((i + 2) * cada) + 1, n)
+        media_x = x[sig_ini:sig_fin].mean()
+        media_y = y[sig_ini:sig_fin].mean()
+
+        # Punto de la cubeta actual que forma el triángulo de mayor área
+        ini = int(i * cada) + 1
+        fin = int((i + 1) * cada) + 1
+        areas = np.abs((x[a] - media_x) * (y[ini:fin] - y[a]) - (x[a] - x[ini:fin]) * (media_y - y[a]))
+        a = ini + int(areas.argmax())
+        indices[i + 1] = a
+
+    return x[indices], y[indices]
+
+class GraficosTendencias:
+    """
+    Figuras de tendencias de glucosa con caché y series reducidas.
+
+    Las series se guardan por (rango, resolución) junto con la versión de las
+    analíticas, así que cualquier cambio en los datos las invalida. La figura
+    se crea nueva en cada llamada (un `Figure` no se puede pasar a otro
+    lienzo de Tk), lo que cuesta poco frente a filtrar y agregar las series.
+    Las series de lecturas se reducen con LTTB al ancho de la figura y se
+    vuelven a reducir para el tramo visible cada vez que cambia el zoom.
+    """
+
+    RESOLUCIONES = {"Lecturas": None, "Diaria": "D", "Semanal": "W-MON"}
+    PUNTOS_MAXIMOS = 1500
+    SERIES_EN_CACHE = 8
+
+    def __init__(self, analiticas, obtener_cgm=None):
+        self.analiticas = analiticas
+        self._obtener_cgm = obtener_cgm
+        self._cache = {}
+        self._version = None
+
+    def figura(self, desde=None, hasta=None, resolucion="Lecturas", objetivo=OBJETIVO_GLUCOSA):
+        """Figura nueva del rango, con las series de la caché si siguen vigentes"""
+        cgm = self._obtener_cgm() if self._obtener_cgm else None
+        version = (self.analiticas.version, cgm.version if cgm is not None else None)
+        if self._version != version:
+            self._cache.clear()
+            self._version = version
+
+        clave = (desde, hasta, resolucion)
+        if clave in self._cache:
+            series = self._cache.pop(clave)
+        else:
+            series = self._series(desde, hasta, resolucion)
+            if len(self._cache) >= self.SERIES_EN_CACHE:
+                self._cache.pop(next(iter(self._cache)))
+        self._cache[clave] = series  # Al final: la más reciente
+        return self._construir(series, resolucion, objetivo)
+
+    def _series(self, desde, hasta, resolucion):
+        """Series (nombre, x en días de matplotlib, y, estilo) del rango pedido"""
+        import matplotlib.dates as mdates
+
+        filas = self.analiticas.rango(desde, hasta)
+        regla = self.RESOLUCIONES[resolucion]
+        series = []
+        for columna, nombre, color in (("antes", "Antes de comer", "#4472C4"),
+                                       ("despues", "Después de comer", "#E8590C"),
+                                       ("legacy", "Registro antiguo", "#868E96")):
+            serie = filas.set_index("momento")[columna].dropna()
+            if regla:
+                serie = serie.resample(regla).mean().dropna()
+            if len(serie):
+                series.append((nombre, mdates.date2num(serie.index.to_pydatetime()), serie.to_numpy(float), color))
+
+        cgm = self._obtener_cgm() if self._obtener_cgm else None
+        if cgm is not None and len(cgm):
+            serie = self._serie_cgm(cgm, desde, hasta, regla)
+            if len(serie):
+                x = serie.index.to_numpy("datetime64[m]").astype("int64") / 1440 + mdates.date2num(_EPOCA_CGM)
+                series.insert(0, ("Sensor (CGM)", x, serie.to_numpy(float), "#7950F2"))
+        return series
+
+    def _serie_cgm(self, cgm, desde, hasta, regla):
+        """Serie del sensor desde el nivel preagregado más fino que quepa en la figura"""
+        import numpy as np
+        import pandas as pd
+
+        nivel = "dia" if regla else cgm.elegir_nivel(desde, hasta)
+        minutos, medias = cgm.serie(desde, hasta, nivel)
+        indice = pd.DatetimeIndex(np.frombuffer(minutos, dtype=np.int32).astype("datetime64[m]"))
+        serie = pd.Series(medias, index=indice, dtype=float)
+        if regla and regla != "D":
+            serie = serie.resample(regla).mean().dropna()
+        return serie
+
+    def _construir(self, series, resolucion, objetivo):
+        from matplotlib.figure import Figure
+        import matplotlib.dates as mdates
+
+        figura = Figure(figsize=(10, 5), dpi=100)
+        ax = figura.add_subplot(111)
+        ax.axhspan(objetivo[0], objetivo[1], color="#51CF66", alpha=0.15, label=f"Objetivo {objetivo[0]:g}-{objetivo[1]:g}")
+
+        lineas = []
+        for nombre, x, y, color in series:
+            rx, ry = reducir_lttb(x, y, self.PUNTOS_MAXIMOS)
+            marcador = "o" if resolucion == "Lecturas" and nombre != "Sensor (CGM)" else None
+            linea, = ax.plot(rx, ry, color=color, marker=marcador, markersize=2, linewidth=1, label=nombre)
+            lineas.append((linea, x, y))
+
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+        ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(ax.xaxis.get_major_locator()))
+        ax.set_ylabel("mg/dL")
+        ax.set_title(f"Tendencia de glucosa ({resolucion.lower()})")
+        ax.grid(True, alpha=0.3)
+        if lineas:
+            ax.legend(loc="upper left", fontsize=8)
+        else:
+            ax.text(0.5, 0.5, "Sin lecturas en el rango", transform=ax.transAxes, ha="center", color="gray")
+
+        def al_cambiar_zoom(eje):
+            inicio, fin = eje.get_xlim()
+            for linea, x, y in lineas:
+                desde_i, hasta_i = x.searchsorted(inicio), x.searchsorted(fin, side="right")
+                # Un punto extra a cada lado para que la línea llegue a los bordes
+                desde_i, hasta_i = max(desde_i - 1, 0), min(hasta_i + 1, len(x))
+                linea.set_data(*reducir_lttb(x[desde_i:hasta_i], y[desde_i:hasta_i], self.PUNTOS_MAXIMOS))
+
+        ax.callbacks.connect("xlim_changed", al_cambiar_zoom)
+        figura.tight_layout()
+        return figura
+
+def normalizar_alimento(nombre):
+    """Clave de agrupación de un alimento: minúsculas, sin tildes ni espacios extra"""
+    import unicodedata
+    sin_tildes = unicodedata.normalize("NFKD", nombre.casefold())
+    sin_tildes = "".join(c for c in sin_tildes if not unicodedata.combining(c))
+    return " ".join(sin_tildes.split())
+
+def percentil_ordenado(valores, p):
+    """Percentil `p` (0-100) con interpolación lineal de una lista ya ordenada"""
+    if not valores:
+        return None
+    posicion = (len(valores) - 1) * p / 100
+    inferior = int(posicion)
+    superior = min(inferior + 1, len(valores) - 1)
+    return valores[inferior] + (valores[superior] - valores[inferior]) * (posicion - inferior)
+
+def trigramas(texto):
+    """Trigramas de un texto normalizado, con relleno de espacios en los bordes"""
+    relleno = f"  {texto} "
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+class NormalizadorAlimentos:
+    """
+    Asigna a cada nombre de alimento un identificador canónico.
+
+    Orden de resolución: tabla de alias editable por el usuario, nombre
+    canónico exacto (sin tildes ni mayúsculas) y, por último, coincidencia
+    aproximada con un índice de trigramas (similitud de Dice). Si nada se
+    parece lo suficiente se crea un alimento canónico nuevo. Las resoluciones
+    se memorizan hasta que cambia la tabla de alias.
+
+    Trabaja sobre `configuracion["alimentos_canonicos"]` (id → nombre) y
+    `configuracion["alias_alimentos"]` (alias normalizado → id), que se guardan
+    con el resto de los datos.
+    """
+
+    UMBRAL_SIMILITUD = 0.6
+
+    def __init__(self, configuracion):
+        self.canonicos = configuracion.setdefault("alimentos_canonicos", {})
+        self.alias = configuracion.setdefault("alias_alimentos", {})
+        self._por_nombre = {}
+        self._trigramas = {}  # trigrama -> ids canónicos que lo contienen
+        self._tamanos = {}  # id -> número de trigramas de su nombre
+        self._memo = {}
+        for id_alimento, nombre in self.canonicos.items():
+            self._indexar(id_alimento, nombre)
+
+    def _indexar(self, id_alimento, nombre):
+        clave = normalizar_alimento(nombre)
+        self._por_nombre[clave] = id_alimento
+        grams = trigramas(clave)
+        self._tamanos[id_alimento] = len(grams)
+        for gram in grams:
+            self._trigramas.setdefault(gram, set()).add(id_alimento)
+
+    def nombre(self, id_alimento):
+        """Nombre canónico para mostrar"""
+        return self.canonicos.get(id_alimento, id_alimento)
+
+    def _similar(self, clave):
+        """Id canónico más parecido a `clave` por encima del umbral, o None"""
+        grams = trigramas(clave)
+        comunes = {}
+        for gram in grams:
+            for id_alimento in self._trigramas.get(gram, ()):
+                comunes[id_alimento] = comunes.get(id_alimento, 0) + 1
+        mejor, mejor_similitud = None, self.UMBRAL_SIMILITUD
+        for id_alimento, compartidos in comunes.items():
+            similitud = 2 * compartidos / (len(grams) + self._tamanos[id_alimento])
+            if similitud >= mejor_similitud:
+                mejor, mejor_similitud = id_alimento, similitud
+        return mejor
+
+    def resolver(self, nombre, crear=True):
+        """Id canónico del alimento; con `crear=False` devuelve None si no existe"""
+        clave = normalizar_alimento(nombre)
+        if not clave:
+            return None
+        if clave in self._memo:
+            return self._memo[clave]
+
+        id_alimento = self.alias.get(clave) or self._por_nombre.get(clave) or self._similar(clave)
+        if id_alimento is None:
+            if not crear:
+                return None
+            id_alimento = clave.replace(" ", "-")
+            while id_alimento in self.canonicos:
+                id_alimento += "-"
+            self.canonicos[id_alimento] = " ".join(nombre.split()).capitalize()
+            self._indexar(id_alimento, self.canonicos[id_alimento])
+        self._memo[clave] = id_alimento
+        return id_alimento
+
+    def agregar_alias(self, alias, nombre_canonico):
+        """Hacer que `alias` resuelva al alimento `nombre_canonico` (creándolo si hace falta)"""
+        clave = normalizar_alimento(alias)
+        id_alimento = self._por_nombre.get(normalizar_alimento(nombre_canonico))
+        if id_alimento is None:
+            self._memo.clear()
+            id_alimento = self.resolver(nombre_canonico)
+        self.alias[clave] = id_alimento
+        self._memo.clear()
+        return id_alimento
+
+    def quitar_alias(self, alias):
+        self.alias.pop(normalizar_alimento(alias), None)
+        self._memo.clear()
+
+    def normalizar_registros(self, registros, todos=False):
+        """
+        Rellenar `alimentos_ids` de los registros (solo los que no lo tienen,
+        salvo con `todos=True`). Devuelve cuántos registros se han modificado.
+        """
+        cambiados = 0
+        for registro in registros:
+            if todos or "alimentos_ids" not in registro:
+                ids = [self.resolver(a) for a in registro.get("alimentos", [])]
+                if registro.get("alimentos_ids") != ids:
+                    registro["alimentos_ids"] = ids
+                    cambiados += 1
+        return cambiados
+
+class RespuestaAlimento:
+    """Respuesta glucémica acumulada de un alimento"""
+
+    __slots__ = ("nombre", "apariciones", "deltas", "suma_deltas", "vistos", "cgm_comidas", "suma_subidas_cgm", "suma_auc_cgm")
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.apariciones = 0
+        self.deltas = []  # Ordenados, para percentiles sin reordenar
+        self.suma_deltas = 0.0
+        self.vistos = []  # Timestamps ordenados, para "última vez" tras borrados
+        self.cgm_comidas = 0  # Comidas con curva del sensor
+        self.suma_subidas_cgm = 0.0
+        self.suma_auc_cgm = 0.0
+
+    def resumen(self):
+        return {
+            "alimento": self.nombre,
+            "apariciones": self.apariciones,
+            "con_delta": len(self.deltas),
+            "delta_media": self.suma_deltas / len(self.deltas) if self.deltas else None,
+            "delta_mediana": percentil_ordenado(self.deltas, 50),
+            "delta_p90": percentil_ordenado(self.deltas, 90),
+            "delta_maxima": self.deltas[-1] if self.deltas else None,
+            "cgm_subida_media": self.suma_subidas_cgm / self.cgm_comidas if self.cgm_comidas else None,
+            "cgm_auc_media": self.suma_auc_cgm / self.cgm_comidas if self.cgm_comidas else None,
+            "ultima_vez": self.vistos[-1] if self.vistos else None,
+        }
 
-        self.crear_interfaz()
+class IndiceAlimentos:
+    """
+    Índice alimento normalizado → respuesta glucémica tras la comida.
+
+    Se construye una vez recorriendo el historial y después se mantiene con
+    `agregar`/`quitar` en cada registro guardado o borrado, sin volver a
+    recorrer el historial. La respuesta de un registro es azúcar después −
+    azúcar antes; los registros sin ambos valores solo cuentan como aparición.
+    Con un `NormalizadorAlimentos` agrupa por id canónico (`alimentos_ids`).
+    Con `respuesta_cgm` (registro → respuesta del sensor o None, ver
+    `CorrelacionCGM`) acumula además la subida y el área de la curva del sensor.
+    """
+
+    def __init__(self, normalizador=None, respuesta_cgm=None):
+        self.normalizador = normalizador
+        self.respuesta_cgm = respuesta_cgm
+        self._alimentos = {}
+
+    def construir(self, registros):
+        self._alimentos = {}
+        for registro in registros:
+            self.agregar(registro)
+
+    @staticmethod
+    def _delta(registro):
+        antes = registro.get("azucar_antes")
+        despues = registro.get("azucar_despues")
+        if antes is None or despues is None:
+            return None
+        return despues - antes
+
+    def _clave(self, nombre, crear=True):
+        if self.normalizador is not None:
+            return self.normalizador.resolver(nombre, crear=crear)
+        return normalizar_alimento(nombre)
+
+    def _claves(self, registro):
+        """Pares (clave, nombre) de los alimentos distintos del registro"""
+        vistos = {}
+        alimentos = registro.get("alimentos", [])
+        ids = registro.get("alimentos_ids")
+        if self.normalizador is not None and ids is not None and len(ids) == len(alimentos):
+            for id_alimento in ids:
+                if id_alimento and id_alimento not in vistos:
+                    vistos[id_alimento] = self.normalizador.nombre(id_alimento)
+        else:
+            for nombre in alimentos:
+                clave = self._clave(nombre)
+                if clave and clave not in vistos:
+                    vistos[clave] = self.normalizador.nombre(clave) if self.normalizador else nombre
+        return vistos.items()
+
+    def agregar(self, registro):
+        delta = self._delta(registro)
+        cgm = self.respuesta_cgm(registro) if self.respuesta_cgm else None
+        momento = registro.get("timestamp") or ""
+        for clave, nombre in self._claves(registro):
+            respuesta = self._alimentos.get(clave)
+            if respuesta is None:
+                respuesta = self._alimentos[clave] = RespuestaAlimento(nombre)
+            respuesta.apariciones += 1
+            bisect.insort(respuesta.vistos, momento)
+            if self.normalizador is None and momento >= respuesta.vistos[-1]:
+                respuesta.nombre = nombre  # Mostrar la grafía más reciente
+            if delta is not None:
+                bisect.insort(respuesta.deltas, delta)
+                respuesta.suma_deltas += delta
+            if cgm is not None:
+                respuesta.cgm_comidas += 1
+                respuesta.suma_subidas_cgm += cgm["subida"]
+                respuesta.suma_auc_cgm += cgm["auc"]
+
+    def quitar(self, registro):
+        delta = self._delta(registro)
+        cgm = self.respuesta_cgm(registro) if self.respuesta_cgm else None
+        momento = registro.get("timestamp") or ""
+        for clave, _ in self._claves(registro):
+            respuesta = self._alimentos.get(clave)
+            if respuesta is None:
+                continue
+            respuesta.apariciones -= 1
+            if respuesta.apariciones <= 0:
+                del self._alimentos[clave]
+                continue
+            posicion = bisect.bisect_left(respuesta.vistos, momento)
+            if posicion < len(respuesta.vistos) and respuesta.vistos[posicion] == momento:
+                del respuesta.vistos[posicion]
+            if delta is not None:
+                posicion = bisect.bisect_left(respuesta.deltas, delta)
+                if posicion < len(respuesta.deltas) and respuesta.deltas[posicion] == delta:
+                    del respuesta.deltas[posicion]
+                    respuesta.suma_deltas -= delta
+            if cgm is not None and respuesta.cgm_comidas:
+                respuesta.cgm_comidas -= 1
+                respuesta.suma_subidas_cgm -= cgm["subida"]
+                respuesta.suma_auc_cgm -= cgm["auc"]
+
+    def consultar(self, alimento):
+        """Resumen de un alimento por nombre (cualquier grafía) o None"""
+        respuesta = self._alimentos.get(self._clave(alimento, crear=False))
+        return respuesta.resumen() if respuesta else None
+
+    def ranking(self, ordenar_por="delta_media", descendente=True, minimo_deltas=1):
+        """Resúmenes de los alimentos con al menos `minimo_deltas` respuestas medidas"""
+        resumenes = [r.resumen() for r in self._alimentos.values() if len(r.deltas) >= minimo_deltas]
+        con_valor = [r for r in resumenes if r[ordenar_por] is not None]
+        sin_valor = [r for r in resumenes if r[ordenar_por] is None]
+        con_valor.sort(key=lambda r: r[ordenar_por], reverse=descendente)
+        return con_valor + sin_valor
+
+class IndiceSugerencias:
+    """
+    Nombres de comida ordenados por frecuencia y recencia ("frecency").
+
+    Cada uso suma exp(λ·t) a la puntuación del nombre (t en días, vida media
+    `VIDA_MEDIA_DIAS`). Como todas las puntuaciones decaen al mismo ritmo, el
+    orden relativo no cambia con el paso del tiempo y basta con mantener una
+    lista ordenada: `top(k)` es un corte O(k) y cada uso recoloca un solo
+    nombre con bisect. Las puntuaciones se guardan en escala logarítmica para
+    no desbordar. Una segunda lista ordenada por nombre normalizado resuelve
+    el autocompletado por prefijo. Los prefijos cortos (las primeras letras
+    que se escriben) abarcan casi todos los nombres, así que guardan sus
+    `MEJORES_POR_PREFIJO` mejores: un uso los actualiza en O(1) y solo un
+    borrado obliga a volver a calcularlos.
+    """
+
+    VIDA_MEDIA_DIAS = 14
+    PREFIJO_CACHEADO = 2
+    MEJORES_POR_PREFIJO = 16
+    _LAMBDA = math.log(2) / VIDA_MEDIA_DIAS
+    _EPOCA = datetime(2020, 1, 1)
 
-    def extraer_fecha_hora_exif(self, ruta_imagen):
-        """Extraer fecha y hora de los metadatos EXIF de una imagen"""
+    def __init__(self):
+        self._entradas = {}  # clave -> [nombre, usos, ultimo_uso, log_puntuacion]
+        self._orden = []  # (-log_puntuacion, clave), ordenada
+        self._claves = []  # claves normalizadas, ordenadas
+        self._mejores = {}  # prefijo corto -> sus mejores claves, en orden
+
+    def construir(self, registros):
+        self.__init__()
+        for registro in registros:
+            self.registrar(registro.get("nombre_comida"), registro.get("timestamp"))
+
+    def _log_peso(self, momento):
+        if isinstance(momento, str):
+            try:
+                momento = datetime.fromisoformat(momento)
+            except ValueError:
+                momento = None
+        momento = momento or datetime.now()
+        return self._LAMBDA * (momento - self._EPOCA).total_seconds() / 86400
+
+    def _recolocar(self, clave, log_anterior, log_nuevo):
+        if log_anterior is not None:
+            posicion = bisect.bisect_left(self._orden, (-log_anterior, clave))
+            del self._orden[posicion]
+        if log_nuevo is not None:
+            bisect.insort(self._orden, (-log_nuevo, clave))
+
+    def _actualizar_mejores(self, clave, subio):
+        """Llevar a las listas de prefijos cortos el cambio de puntuación de `clave`"""
+        for prefijo in {clave[:largo] for largo in range(1, self.PREFIJO_CACHEADO + 1)}:
+            mejores = self._mejores.get(prefijo)
+            if mejores is None:
+                continue
+            if not subio:
+                del self._mejores[prefijo]  # Al bajar, otra que no está en la lista podría adelantarla
+                continue
+            if clave not in mejores:
+                mejores.append(clave)
+            mejores.sort(key=lambda c: self._entradas[c][3], reverse=True)
+            del mejores[self.MEJORES_POR_PREFIJO:]
+
+    def registrar(self, nombre, momento=None):
+        """Contar un uso de `nombre` en `momento` (datetime o texto ISO)"""
+        if not nombre:
+            return
+        clave = normalizar_alimento(nombre)
+        log_peso = self._log_peso(momento)
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            self._entradas[clave] = [nombre, 1, momento, log_peso]
+            bisect.insort(self._claves, clave)
+            self._recolocar(clave, None, log_peso)
+            self._actualizar_mejores(clave, True)
+            return
+
+        anterior = entrada[3]
+        # log(e^a + e^b) sin desbordar
+        mayor, menor = max(anterior, log_peso), min(anterior, log_peso)
+        entrada[3] = mayor + math.log1p(math.exp(menor - mayor))
+        entrada[1] += 1
+        if momento is not None and (entrada[2] is None or str(momento) >= str(entrada[2])):
+            entrada[0], entrada[2] = nombre, momento
+        self._recolocar(clave, anterior, entrada[3])
+        self._actualizar_mejores(clave, True)
+
+    def quitar(self, nombre, momento=None):
+        """Descontar un uso (por ejemplo, al borrar un registro)"""
+        if not nombre:
+            return
+        clave = normalizar_alimento(nombre)
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return
+        anterior = entrada[3]
+        entrada[1] -= 1
+        self._actualizar_mejores(clave, False)
+        if entrada[1] <= 0:
+            del self._entradas[clave]
+            del self._claves[bisect.bisect_left(self._claves, clave)]
+            self._recolocar(clave, anterior, None)
+            return
+        diferencia = self._log_peso(momento) - anterior
+        if diferencia < -1e-12:
+            # log(e^a - e^b)
+            entrada[3] = anterior + math.log1p(-math.exp(diferencia))
+        else:
+            # Sin fecha fiable no se sabe cuánto sumó ese uso: quitar la parte media
+            entrada[3] = anterior + math.log(entrada[1] / (entrada[1] + 1))
+        self._recolocar(clave, anterior, entrada[3])
+
+    def top(self, k=10):
+        """Los `k` nombres con mayor puntuación, en O(k)"""
+        return [self._entradas[clave][0] for _, clave in self._orden[:k]]
+
+    def completar(self, prefijo, k=8):
+        """Nombres que empiezan por `prefijo` (sin tildes ni mayúsculas), mejor puntuados primero"""
+        prefijo = normalizar_alimento(prefijo)
+        if not prefijo:
+            return self.top(k)
+        corto = len(prefijo) <= self.PREFIJO_CACHEADO and k <= self.MEJORES_POR_PREFIJO
+        if corto and prefijo in self._mejores:
+            return [self._entradas[clave][0] for clave in self._mejores[prefijo][:k]]
+        inicio = bisect.bisect_left(self._claves, prefijo)
+        fin = bisect.bisect_left(self._claves, prefijo + "\uffff")
+        candidatas = heapq.nlargest(self.MEJORES_POR_PREFIJO if corto else k, self._claves[inicio:fin],
+                                    key=lambda c: self._entradas[c][3])
+        if corto:
+            self._mejores[prefijo] = candidatas
+        return [self._entradas[clave][0] for clave in candidatas[:k]]
+
+FRANJAS_PREDETERMINADAS = {
+    "desayuno": {"inicio": "06:00", "fin": "10:00"},
+    "almuerzo": {"inicio": "10:01", "fin": "13:00"},
+    "comida": {"inicio": "13:01", "fin": "16:00"},
+    "merienda": {"inicio": "16:01", "fin": "19:00"},
+    "cena": {"inicio": "19:01", "fin": "23:59"}
+}
+
+def minutos_del_dia(hora_str):
+    """Convertir "HH:MM" en minutos desde medianoche (ValueError si no es válida)"""
+    horas, separador, minutos = hora_str.strip().partition(":")
+    if not separador or not horas.isdigit() or not minutos.isdigit():
+        raise ValueError(f"Hora inválida: {hora_str!r}")
+    horas, minutos = int(horas), int(minutos)
+    if horas > 23 or minutos > 59:
+        raise ValueError(f"Hora inválida: {hora_str!r}")
+    return horas * 60 + minutos
+
+class ClasificadorFranjas:
+    """
+    Clasificador compilado de franjas horarias.
+
+    Las franjas se convierten en una tabla ordenada de límites en minutos del
+    día; cada tramo entre dos límites tiene asignada la primera franja (en el
+    orden de la configuración) que lo cubre, igual que el recorrido lineal de
+    antes. Clasificar una hora es un `bisect` sobre esa tabla. La tabla solo
+    se vuelve a compilar cuando cambia la configuración.
+    """
+
+    def __init__(self, franjas):
+        intervalos = []
+        for nombre, franja in franjas.items():
+            # El fin es inclusivo: el tramo termina en el minuto siguiente
+            intervalos.append((minutos_del_dia(franja["inicio"]), minutos_del_dia(franja["fin"]) + 1, nombre))
+
+        self._limites = sorted({0} | {i for i, _, _ in intervalos} | {f for _, f, _ in intervalos})
+        self._etiquetas = []
+        for limite in self._limites:
+            etiqueta = None
+            for inicio, fin, nombre in intervalos:
+                if inicio <= limite < fin:
+                    etiqueta = nombre
+                    break
+            self._etiquetas.append(etiqueta)
+
+    def clasificar(self, hora_str):
+        """Franja de una hora "HH:MM", o None si no cae en ninguna"""
         try:
-            # Método 1: Usando PIL
-            with Image.open(ruta_imagen) as img:
-                exifdata = img.getexif()
-                
-                # Buscar fecha en diferentes campos EXIF
-                fecha_campos = [36867, 36868, 306]  # DateTime, DateTimeOriginal, DateTimeDigitized
-                
-                for campo in fecha_campos:
-                    if campo in exifdata:
-                        fecha_str = exifdata[campo]
-                        try:
-                            # Formato EXIF: "YYYY:MM:DD HH:MM:SS"
-                            fecha_objeto = datetime.strptime(fecha_str, "%Y:%m:%d %H:%M:%S")
-                            return {
-                                'fecha': fecha_objeto.strftime("%Y-%m-%d"),
-                                'hora': fecha_objeto.strftime("%H:%M"),
-                                'datetime': fecha_objeto,
-                                'fuente': 'EXIF'
-                            }
-                        except ValueError:
-                            continue
-                            
-            # Método 2: Usando exifread como respaldo
-            with open(ruta_imagen, 'rb') as f:
-                tags = exifread.process_file(f)
-                
-                fecha_tags = ['EXIF DateTimeOriginal', 'EXIF DateTime', 'Image DateTime']
-                
-                for tag_name in fecha_tags:
-                    if tag_name in tags:
-                        fecha_str = str(tags[tag_name])
+            minuto = minutos_del_dia(hora_str)
+        except (ValueError, AttributeError):
+            return None
+        return self._etiquetas[bisect.bisect_right(self._limites, minuto) - 1]
+
+    def reclasificar(self, registros):
+        """Etiquetar la franja de todos los registros; devuelve cuántos cambiaron"""
+        cambiados = 0
+        for registro in registros:
+            franja = self.clasificar(registro.get("hora"))
+            if registro.get("franja") != franja:
+                registro["franja"] = franja
+                cambiados += 1
+        return cambiados
+
+def momento_registro(registro):
+    """Fecha y hora de un registro (timestamp ISO, o fecha + hora); None si no hay"""
+    try:
+        return datetime.fromisoformat(registro["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        return datetime.strptime(f"{registro['fecha']} {registro['hora']}", "%Y-%m-%d %H:%M")
+    except (KeyError, TypeError, ValueError):
+        return None
+
+ALERTAS_PREDETERMINADAS = {
+    "limite_bajo": 70,          # hipoglucemia por debajo de este valor
+    "limite_alto": 250,         # hiperglucemia por encima de este valor
+    "subida_posprandial": 60,   # subida después - antes que se considera excesiva
+    "umbral_alto": 180,         # lectura "alta" para las reglas de racha y media
+    "altos_consecutivos": 3,    # lecturas altas seguidas que disparan aviso
+    "ventana_horas": 24         # ventana de la media móvil
+}
+
+class MotorAlertas:
+    """
+    Motor de reglas de glucosa que evalúa cada lectura nueva de forma incremental.
+
+    El estado de las reglas se actualiza en O(1) amortizado por lectura: un
+    contador para la racha de lecturas altas y una ventana deslizante (deque
+    con suma acumulada) para la media de las últimas `ventana_horas`. Las
+    reglas puntuales (umbrales y subida posprandial) no necesitan historia.
+    Si llega un registro anterior al último evaluado (foto antigua con EXIF),
+    el estado se reconstruye reproduciendo el historial en orden.
+    """
+
+    def __init__(self, configuracion=None):
+        self.configuracion = dict(ALERTAS_PREDETERMINADAS, **(configuracion or {}))
+        self._reiniciar()
+
+    def _reiniciar(self):
+        self.ultimo_momento = None
+        self.racha_altos = 0
+        self._ventana = collections.deque()  # (momento, valor)
+        self._suma_ventana = 0.0
+        self._media_alta = False
+
+    @staticmethod
+    def lecturas(registro):
+        """Lecturas (tipo, valor) de un registro en orden cronológico"""
+        antes, despues = registro.get("azucar_antes"), registro.get("azucar_despues")
+        if antes is None and despues is None:
+            legacy = registro.get("nivel_azucar")
+            return [("nivel", legacy)] if legacy is not None else []
+        return [(tipo, valor) for tipo, valor in (("antes", antes), ("despues", despues)) if valor is not None]
+
+    def construir(self, registros):
+        """Reproducir el historial sin emitir alertas para dejar el estado al día"""
+        self._reiniciar()
+        ordenados = sorted(((m, r) for r in registros if (m := momento_registro(r)) is not None),
+                           key=lambda par: par[0])
+        for momento, registro in ordenados:
+            self._avanzar(momento, registro)
+
+    def evaluar(self, registro, registros=None):
+        """
+        Evaluar un registro nuevo y devolver la lista de alertas que dispara.
+        `registros` (el historial que ya lo incluye) solo se usa si el
+        registro llega fuera de orden y hay que reconstruir el estado.
+        """
+        momento = momento_registro(registro) or datetime.now()
+        if self.ultimo_momento is not None and momento < self.ultimo_momento:
+            # Fuera de orden: solo reglas puntuales; el estado se recalcula entero
+            alertas = self._avanzar(momento, registro, solo_puntuales=True)
+            if registros is not None:
+                self.construir(registros)
+            return alertas
+        return self._avanzar(momento, registro)
+
+    def _alerta(self, alertas, regla, nivel, mensaje, momento, registro, valor):
+        alertas.append({
+            "momento": momento.isoformat(timespec="minutes"),
+            "regla": regla,
+            "nivel": nivel,
+            "mensaje": mensaje,
+            "valor": valor,
+            "registro_id": registro.get("id")
+        })
+
+    def _avanzar(self, momento, registro, solo_puntuales=False):
+        c = self.configuracion
+        alertas = []
+        lecturas = self.lecturas(registro)
+        valores = dict(lecturas)
+
+        for tipo, valor in lecturas:
+            tipo = {"despues": "después"}.get(tipo, tipo)
+            if valor < c["limite_bajo"]:
+                self._alerta(alertas, "hipoglucemia", "grave",
+                             f"🔻 Hipoglucemia: {valor:g} mg/dL ({tipo})", momento, registro, valor)
+            elif valor > c["limite_alto"]:
+                self._alerta(alertas, "hiperglucemia", "grave",
+                             f"🔺 Hiperglucemia: {valor:g} mg/dL ({tipo})", momento, registro, valor)
+
+        if "antes" in valores and "despues" in valores:
+            subida = valores["despues"] - valores["antes"]
+            if subida > c["subida_posprandial"]:
+                self._alerta(alertas, "subida_posprandial", "aviso",
+                             f"📈 Subida tras la comida de {subida:+.0f} mg/dL", momento, registro, subida)
+
+        if solo_puntuales:
+            return alertas
+
+        self.ultimo_momento = momento
+        limite_ventana = momento - timedelta(hours=c["ventana_horas"])
+        for _, valor in lecturas:
+            # Racha de lecturas altas
+            if valor > c["umbral_alto"]:
+                self.racha_altos += 1
+                if self.racha_altos == c["altos_consecutivos"]:
+                    self._alerta(alertas, "altos_consecutivos", "aviso",
+                                 f"⚠️ {self.racha_altos} lecturas seguidas por encima de {c['umbral_alto']} mg/dL",
+                                 momento, registro, valor)
+            else:
+                self.racha_altos = 0
+
+            # Media móvil: entra la lectura nueva y salen las que quedan fuera de la ventana
+            self._ventana.append((momento, valor))
+            self._suma_ventana += valor
+        while self._ventana and self._ventana[0][0] < limite_ventana:
+            self._suma_ventana -= self._ventana.popleft()[1]
+
+        media = self.media_movil()
+        media_alta = media is not None and media > c["umbral_alto"]
+        if media_alta and not self._media_alta:
+            self._alerta(alertas, "media_movil", "aviso",
+                         f"📊 Media de las últimas {c['ventana_horas']} h: {media:.0f} mg/dL",
+                         momento, registro, round(media, 1))
+        self._media_alta = media_alta
+        return alertas
+
+    def media_movil(self):
+        """Media de las lecturas dentro de la ventana, o None si está vacía"""
+        if not self._ventana:
+            return None
+        return self._suma_ventana / len(self._ventana)
+
+_EPOCA_CGM = datetime(1970, 1, 1)
+MMOL_A_MGDL = 18.016
+
+def minuto_cgm(momento):
+    """Minutos desde 1970-01-01 de un datetime (hora local, sin zona)"""
+    return int((momento.replace(tzinfo=None) - _EPOCA_CGM).total_seconds() // 60)
+
+def momento_cgm(minuto):
+    """Inverso de `minuto_cgm`"""
+    return _EPOCA_CGM + timedelta(minutes=minuto)
+
+_FORMATOS_FECHA_CGM = (
+    "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%d-%m-%Y %H:%M", "%d/%m/%Y %H:%M",
+    "%d/%m/%Y %H:%M:%S", "%m/%d/%Y %H:%M", "%m/%d/%Y %I:%M %p", "%Y/%m/%d %H:%M"
+)
+
+def leer_csv_cgm(ruta, limite_cabecera=10):
+    """
+    Leer en streaming un CSV de un sensor continuo (Dexcom, FreeStyle Libre...).
+
+    Busca en las primeras líneas la cabecera con una columna de fecha y otra
+    de glucosa (mg/dL o mmol/L) y devuelve `(minutos, decimas, descartadas)`:
+    dos arrays de enteros con el minuto de cada lectura y su valor en décimas
+    de mg/dL, más el número de filas sin lectura válida (eventos, "Low"...).
+    """
+    import csv
+
+    minutos, decimas = array('i'), array('i')
+    descartadas = 0
+    with open(ruta, 'r', encoding='utf-8-sig', newline='') as f:
+        muestra = f.read(4096)
+        f.seek(0)
+        try:
+            dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t")
+        except csv.Error:
+            dialecto = csv.excel
+        lector = csv.reader(f, dialecto)
+
+        col_fecha = col_glucosa = None
+        factor = 1.0
+        for _ in range(limite_cabecera):
+            cabecera = [normalizar_alimento(c) for c in next(lector, [])]
+            for i, nombre in enumerate(cabecera):
+                if col_fecha is None and any(p in nombre for p in ("timestamp", "fecha", "hora", "date", "time")):
+                    col_fecha = i
+                elif col_glucosa is None and any(p in nombre for p in ("glucos", "mg/dl", "mmol")):
+                    # En Libre la primera columna de glucosa es la histórica (cada 15 min)
+                    col_glucosa = i
+                    factor = MMOL_A_MGDL if "mmol" in nombre else 1.0
+            if col_fecha is not None and col_glucosa is not None:
+                break
+            col_fecha = col_glucosa = None
+        else:
+            raise ValueError("No se encontró una cabecera con columnas de fecha y glucosa")
+
+        formato = None
+        for fila in lector:
+            try:
+                texto_fecha = fila[col_fecha].strip()
+                texto_valor = fila[col_glucosa].strip().replace(",", ".")
+                valor = float(texto_valor) * factor
+            except (IndexError, ValueError):
+                descartadas += 1
+                continue
+            try:
+                momento = datetime.fromisoformat(texto_fecha)
+            except ValueError:
+                momento = None
+                if formato is not None:
+                    try:
+                        momento = datetime.strptime(texto_fecha, formato)
+                    except ValueError:
+                        pass
+                if momento is None:
+                    for candidato in _FORMATOS_FECHA_CGM:
                         try:
-                            fecha_objeto = datetime.strptime(fecha_str, "%Y:%m:%d %H:%M:%S")
-                            return {
-                                'fecha': fecha_objeto.strftime("%Y-%m-%d"),
-                                'hora': fecha_objeto.strftime("%H:%M"),
-                                'datetime': fecha_objeto,
-                                'fuente': 'EXIF'
-                            }
+                            momento = datetime.strptime(texto_fecha, candidato)
+                            formato = candidato
+                            break
                         except ValueError:
                             continue
-                            
-        except Exception as e:
-            print(f"Error al extraer EXIF: {e}")
-            
-        # Si no se pudo extraer de EXIF, usar fecha/hora actual
-        ahora = datetime.now()
+            if momento is None or not 0 < valor <= 1000:
+                descartadas += 1
+                continue
+            minutos.append(minuto_cgm(momento))
+            decimas.append(round(valor * 10))
+    return minutos, decimas, descartadas
+
+class NivelCGM:
+    """Agregados (n, suma, mínimo, máximo) en cubos de `ancho` minutos, en arrays paralelos"""
+
+    def __init__(self, ancho):
+        self.ancho = ancho
+        self.inicio = array('i')
+        self.n = array('i')
+        self.suma = array('d')
+        self.minimo = array('i')
+        self.maximo = array('i')
+
+    def agregar(self, minuto, decimas):
+        cubo = minuto - minuto % self.ancho
+        inicio = self.inicio
+        if inicio and inicio[-1] == cubo:
+            posicion = len(inicio) - 1
+        elif not inicio or cubo > inicio[-1]:
+            # Caso habitual: lecturas en orden, se añade al final
+            inicio.append(cubo)
+            self.n.append(0)
+            self.suma.append(0.0)
+            self.minimo.append(decimas)
+            self.maximo.append(decimas)
+            posicion = len(inicio) - 1
+        else:
+            posicion = bisect.bisect_left(inicio, cubo)
+            if posicion == len(inicio) or inicio[posicion] != cubo:
+                inicio.insert(posicion, cubo)
+                self.n.insert(posicion, 0)
+                self.suma.insert(posicion, 0.0)
+                self.minimo.insert(posicion, decimas)
+                self.maximo.insert(posicion, decimas)
+        self.n[posicion] += 1
+        self.suma[posicion] += decimas
+        if decimas < self.minimo[posicion]:
+            self.minimo[posicion] = decimas
+        if decimas > self.maximo[posicion]:
+            self.maximo[posicion] = decimas
+
+class AlmacenCGM:
+    """
+    Serie temporal compacta de lecturas de sensor continuo (CGM).
+
+    Las lecturas se guardan en dos arrays de enteros ordenados (minuto desde
+    1970 y décimas de mg/dL) y en disco como pares int32 consecutivos, así que
+    añadir lecturas nuevas al final es escribir solo los bytes nuevos. Junto a
+    las lecturas en bruto se mantienen dos niveles preagregados (por hora y por
+    día) para que los gráficos consulten la resolución adecuada al rango sin
+    recorrer cientos de miles de puntos.
+    """
+
+    NIVELES = {"5min": None, "hora": 60, "dia": 1440}
+    _CABECERA = b"CGM1"
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.version = 0
+        self.minutos = array('i')
+        self.decimas = array('i')
+        self.niveles = {nombre: NivelCGM(ancho) for nombre, ancho in self.NIVELES.items() if ancho}
+        self.cargar()
+
+    def __len__(self):
+        return len(self.minutos)
+
+    def cargar(self):
+        try:
+            with open(self.ruta, 'rb') as f:
+                contenido = f.read()
+        except FileNotFoundError:
+            return
+        if not contenido.startswith(self._CABECERA):
+            raise ValueError(f"{self.ruta} no es un almacén CGM válido")
+        pares = array('i')
+        cuerpo = contenido[len(self._CABECERA):]
+        pares.frombytes(cuerpo[:len(cuerpo) - len(cuerpo) % 8])  # Ignorar una escritura cortada
+        if sys.byteorder == "big":
+            pares.byteswap()
+        self.minutos, self.decimas = pares[0::2], pares[1::2]
+        self._reconstruir_niveles()
+
+    def _reconstruir_niveles(self):
+        self.niveles = {nombre: NivelCGM(ancho) for nombre, ancho in self.NIVELES.items() if ancho}
+        niveles = list(self.niveles.values())
+        for minuto, decimas in zip(self.minutos, self.decimas):
+            for nivel in niveles:
+                nivel.agregar(minuto, decimas)
+        self.version += 1
+
+    @staticmethod
+    def _bytes(minutos, decimas):
+        pares = array('i', bytes(8 * len(minutos)))
+        pares[0::2], pares[1::2] = minutos, decimas
+        if sys.byteorder == "big":
+            pares.byteswap()
+        return pares.tobytes()
+
+    def agregar_lote(self, minutos, decimas):
+        """
+        Añadir lecturas (en cualquier orden) ignorando las de minutos ya
+        guardados (si el lote repite un minuto vale su primera lectura). Si
+        todas son posteriores a la última se añaden al final del archivo; si
+        no, se intercalan y el archivo se reescribe. Devuelve el número de
+        lecturas nuevas.
+        """
+        primeras = {}
+        for minuto, valor in zip(minutos, decimas):
+            primeras.setdefault(minuto, valor)
+        ultimo = self.minutos[-1] if self.minutos else None
+        nuevos_m, nuevos_d = array('i'), array('i')
+        intercalar = []
+        for minuto, valor in sorted(primeras.items()):
+            if ultimo is None or minuto > ultimo:
+                nuevos_m.append(minuto)
+                nuevos_d.append(valor)
+            else:
+                posicion = bisect.bisect_left(self.minutos, minuto)
+                if posicion == len(self.minutos) or self.minutos[posicion] != minuto:
+                    intercalar.append((minuto, valor))
+
+        if intercalar:
+            # Importación que solapa con el historial: fusión completa (poco frecuente)
+            fusion = sorted(dict(list(zip(self.minutos, self.decimas)) + intercalar).items())
+            self.minutos = array('i', (m for m, _ in fusion))
+            self.decimas = array('i', (d for _, d in fusion))
+            self.minutos.extend(nuevos_m)
+            self.decimas.extend(nuevos_d)
+            self._reescribir()
+            self._reconstruir_niveles()
+        elif nuevos_m:
+            self.minutos.extend(nuevos_m)
+            self.decimas.extend(nuevos_d)
+            nueva = not os.path.exists(self.ruta)
+            with open(self.ruta, 'ab') as f:
+                if nueva:
+                    f.write(self._CABECERA)
+                f.write(self._bytes(nuevos_m, nuevos_d))
+            niveles = list(self.niveles.values())
+            for minuto, valor in zip(nuevos_m, nuevos_d):
+                for nivel in niveles:
+                    nivel.agregar(minuto, valor)
+            self.version += 1
+        return len(intercalar) + len(nuevos_m)
+
+    def _reescribir(self):
+        temporal = self.ruta + ".tmp"
+        with open(temporal, 'wb') as f:
+            f.write(self._CABECERA)
+            f.write(self._bytes(self.minutos, self.decimas))
+        os.replace(temporal, self.ruta)
+
+    @staticmethod
+    def limites(desde=None, hasta=None):
+        """Minutos [inicio, fin) de un rango de fechas "AAAA-MM-DD" (fin inclusivo)"""
+        inicio = minuto_cgm(datetime.strptime(desde, "%Y-%m-%d")) if desde else -2 ** 31
+        fin = minuto_cgm(datetime.strptime(hasta, "%Y-%m-%d")) + 1440 if hasta else 2 ** 31 - 1
+        return inicio, fin
+
+    def elegir_nivel(self, desde=None, hasta=None, maximo_puntos=20000):
+        """Nivel más fino cuyo número de puntos en el rango no pasa de `maximo_puntos`"""
+        inicio, fin = self.limites(desde, hasta)
+        for nombre in self.NIVELES:
+            tiempos = self.minutos if nombre == "5min" else self.niveles[nombre].inicio
+            if bisect.bisect_left(tiempos, fin) - bisect.bisect_left(tiempos, inicio) <= maximo_puntos:
+                return nombre
+        return "dia"
+
+    def serie(self, desde=None, hasta=None, nivel="5min"):
+        """
+        Lecturas del rango en el nivel pedido: `(minutos, medias)` en mg/dL
+        (para "5min" las medias son las propias lecturas)
+        """
+        inicio, fin = self.limites(desde, hasta)
+        if nivel == "5min":
+            i, j = bisect.bisect_left(self.minutos, inicio), bisect.bisect_left(self.minutos, fin)
+            return self.minutos[i:j], [d / 10 for d in self.decimas[i:j]]
+        agregado = self.niveles[nivel]
+        i, j = bisect.bisect_left(agregado.inicio, inicio), bisect.bisect_left(agregado.inicio, fin)
+        return agregado.inicio[i:j], [s / n / 10 for s, n in zip(agregado.suma[i:j], agregado.n[i:j])]
+
+    def valores(self, desde=None, hasta=None):
+        """Lecturas en bruto del rango en mg/dL, para estadísticas"""
+        return self.serie(desde, hasta, "5min")[1]
+
+class CorrelacionCGM:
+    """
+    Respuesta del sensor continuo alrededor de cada comida.
+
+    Para cada registro se toma la ventana [comida − `minutos_base`, comida +
+    `minutos_despues`] de la curva del sensor localizando sus extremos con
+    bisect sobre los minutos ordenados del almacén (sin recorrer el resto de
+    lecturas). De ahí salen la línea base (media de la ventana previa), el
+    pico, el tiempo hasta el pico, el área incremental bajo la curva y el
+    tiempo de vuelta a la línea base. Los resultados se guardan por minuto de
+    la comida y se descartan cuando cambia el almacén.
+    """
+
+    LECTURAS_MINIMAS = 6  # Media hora de lecturas cada 5 minutos
+    HUECO_MAXIMO = 20  # Minutos sin lecturas a partir de los que no se integra el tramo
+
+    def __init__(self, obtener_cgm, minutos_base=30, minutos_despues=180, tolerancia=10):
+        self._obtener_cgm = obtener_cgm
+        self.minutos_base = minutos_base
+        self.minutos_despues = minutos_despues
+        self.tolerancia = tolerancia
+        self._cache = {}
+        self._version = None
+
+    def para_registro(self, registro):
+        """Respuesta del sensor a la comida del registro, o None si no hay lecturas suficientes"""
+        cgm = self._obtener_cgm()
+        if cgm is None or not len(cgm):
+            return None
+        if self._version != cgm.version:
+            self._cache.clear()
+            self._version = cgm.version
+        momento = momento_registro(registro)
+        if momento is None:
+            return None
+        minuto = minuto_cgm(momento)
+        if minuto not in self._cache:
+            self._cache[minuto] = self._calcular(cgm, minuto)
+        return self._cache[minuto]
+
+    def _calcular(self, cgm, minuto):
+        minutos, decimas = cgm.minutos, cgm.decimas
+        i = bisect.bisect_left(minutos, minuto - self.minutos_base)
+        j = bisect.bisect_right(minutos, minuto)
+        k = bisect.bisect_right(minutos, minuto + self.minutos_despues)
+        if i == j or k - j < self.LECTURAS_MINIMAS:
+            return None
+
+        base = sum(decimas[i:j]) / (j - i) / 10
+        pico_pos = max(range(j, k), key=decimas.__getitem__)
+        pico = decimas[pico_pos] / 10
+
+        # Área incremental (trapecios por encima de la línea base), en mg/dL·h
+        area = 0.0
+        anterior_m, anterior_v = minuto, max(decimas[j - 1] / 10 - base, 0.0)
+        for posicion in range(j, k):
+            actual_m, actual_v = minutos[posicion], max(decimas[posicion] / 10 - base, 0.0)
+            if actual_m - anterior_m <= self.HUECO_MAXIMO:
+                area += (anterior_v + actual_v) / 2 * (actual_m - anterior_m)
+            anterior_m, anterior_v = actual_m, actual_v
+
+        vuelta = None
+        for posicion in range(pico_pos + 1, k):
+            if decimas[posicion] / 10 <= base + self.tolerancia:
+                vuelta = minutos[posicion] - minuto
+                break
+
         return {
-            'fecha': ahora.strftime("%Y-%m-%d"),
-            'hora': ahora.strftime("%H:%M"),
-            'datetime': ahora,
-            'fuente': 'Actual'
+            "base": round(base, 1),
+            "pico": pico,
+            "subida": round(pico - base, 1),
+            "minutos_al_pico": minutos[pico_pos] - minuto,
+            "auc": round(area / 60, 1),
+            "vuelta_base": vuelta,
+            "lecturas": k - j
         }
 
-    def cargar_datos(self):
+    @staticmethod
+    def texto(respuesta):
+        """Resumen corto para una fila del historial"""
+        if respuesta is None:
+            return ""
+        texto = f"↑{respuesta['subida']:+.0f} en {respuesta['minutos_al_pico']}′ · AUC {respuesta['auc']:.0f}"
+        if respuesta["vuelta_base"] is not None:
+            texto += f" · ↩{respuesta['vuelta_base']}′"
+        return texto
+
+def registrar_estilos_excel(wb):
+    """Registrar en el libro los estilos con nombre compartidos por todas las celdas"""
+    from openpyxl.styles import NamedStyle, Font, PatternFill, Alignment, Border, Side
+
+    borde = Border(
+        left=Side(style='thin'), right=Side(style='thin'),
+        top=Side(style='thin'), bottom=Side(style='thin')
+    )
+
+    titulo = NamedStyle(name="titulo")
+    titulo.font = Font(bold=True, size=16, color="4472C4")
+    titulo.alignment = Alignment(horizontal='center')
+
+    info = NamedStyle(name="info")
+    info.font = Font(size=10, italic=True)
+
+    encabezado = NamedStyle(name="encabezado")
+    encabezado.font = Font(bold=True, color="FFFFFF")
+    encabezado.fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+    encabezado.alignment = Alignment(horizontal='center', vertical='center')
+    encabezado.border = borde
+
+    celda = NamedStyle(name="celda")
+    celda.border = borde
+    celda.alignment = Alignment(vertical='center')
+
+    etiqueta = NamedStyle(name="etiqueta")
+    etiqueta.font = Font(bold=True)
+
+    estilos = [titulo, info, encabezado, celda, etiqueta]
+    for nombre, color in COLORES_ESTADO_EXCEL.items():
+        estado = NamedStyle(name=nombre)
+        estado.fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
+        estado.font = Font(bold=True, color="FFFFFF")
+        estado.alignment = Alignment(horizontal='center', vertical='center')
+        estado.border = borde
+        estilos.append(estado)
+
+    for estilo in estilos:
+        wb.add_named_style(estilo)
+
+def cerrar_salida(archivo):
+    """Cerrar un archivo de salida, salvo la salida estándar (que solo se vacía)"""
+    if archivo is sys.stdout:
+        archivo.flush()
+    else:
+        archivo.close()
+
+class SumideroCSV:
+    """
+    Escribe filas materializadas en un CSV (`filename="-"`: salida estándar).
+
+    Con `anexar=True` añade las filas al final de un CSV existente (sin repetir
+    la cabecera); si la exportación se aborta, el archivo se trunca a su
+    tamaño original. Un registro modificado se añade otra vez con el mismo ID:
+    la fila válida es la de `Actualizado` más reciente.
+    """
+
+    admite_anexar = True
+    fieldnames = ['Fecha', 'Hora', 'Nombre_Comida', 'Azucar_Antes_mg/dL', 'Azucar_Despues_mg/dL',
+                  'Nivel_Azucar_Legacy_mg/dL', 'Alimentos_Detectados', 'Estado', 'ID', 'Actualizado']
+
+    def __init__(self, filename, anexar=False, **opciones):
+        self.filename = filename
+        self.anexar = anexar
+        self._tamano_original = None
+        self._archivo = None
+        self._writer = None
+
+    def abrir(self, total):
+        import csv
+        if self.anexar and os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            with open(self.filename, 'r', newline='', encoding='utf-8') as existente:
+                cabecera = next(csv.reader(existente), [])
+            if cabecera != self.fieldnames:
+                raise ValueError("El CSV existente tiene otras columnas; expórtalo de nuevo completo")
+            self._tamano_original = os.path.getsize(self.filename)
+            self._archivo = open(self.filename, 'a', newline='', encoding='utf-8')
+            self._writer = csv.writer(self._archivo)
+        else:
+            self._archivo = sys.stdout if self.filename == "-" else open(self.filename, 'w', newline='', encoding='utf-8')
+            self._writer = csv.writer(self._archivo)
+            self._writer.writerow(self.fieldnames)
+
+    def escribir(self, fila):
+        self._writer.writerow([
+            fila["fecha"], fila["hora"], fila["nombre_comida"],
+            '' if fila["azucar_antes"] is None else fila["azucar_antes"],
+            '' if fila["azucar_despues"] is None else fila["azucar_despues"],
+            '' if fila["nivel_azucar_legacy"] is None else fila["nivel_azucar_legacy"],
+            fila["alimentos_str"], fila["estado"], fila["id"], fila["actualizado"]
+        ])
+
+    def cerrar(self, estadisticas):
+        cerrar_salida(self._archivo)
+
+    def abortar(self):
+        if self._archivo is not None:
+            cerrar_salida(self._archivo)
+        if self._tamano_original is not None:
+            os.truncate(self.filename, self._tamano_original)
+
+class SumideroJSONL:
+    """Escribe una línea JSON por fila materializada (o las añade con `anexar=True`; "-" = salida estándar)"""
+
+    admite_anexar = True
+
+    def __init__(self, filename, anexar=False, **opciones):
+        self.filename = filename
+        self.anexar = anexar
+        self._tamano_original = None
+        self._archivo = None
+
+    def abrir(self, total):
+        if self.anexar and os.path.exists(self.filename):
+            self._tamano_original = os.path.getsize(self.filename)
+            self._archivo = open(self.filename, 'a', encoding='utf-8')
+        else:
+            self._archivo = sys.stdout if self.filename == "-" else open(self.filename, 'w', encoding='utf-8')
+
+    def escribir(self, fila):
+        self._archivo.write(json.dumps({
+            "id": fila["id"],
+            "actualizado": fila["actualizado"],
+            "fecha": fila["fecha"],
+            "hora": fila["hora"],
+            "nombre_comida": fila["nombre_comida"],
+            "azucar_antes": fila["azucar_antes"],
+            "azucar_despues": fila["azucar_despues"],
+            "nivel_azucar_legacy": fila["nivel_azucar_legacy"],
+            "alimentos": fila["alimentos"],
+            "estado": fila["estado"],
+        }, ensure_ascii=False))
+        self._archivo.write("\n")
+
+    def cerrar(self, estadisticas):
+        cerrar_salida(self._archivo)
+
+    def abortar(self):
+        if self._archivo is not None:
+            cerrar_salida(self._archivo)
+        if self._tamano_original is not None:
+            os.truncate(self.filename, self._tamano_original)
+
+class SumideroExcel:
+    """
+    Escribe filas materializadas en un libro Excel en modo write-only.
+
+    Las filas se vuelcan a disco a medida que llegan y todas las celdas
+    comparten los estilos con nombre de `registrar_estilos_excel`.
+    """
+
+    admite_anexar = False
+    headers = ['📅 Fecha', '🕐 Hora', '🍽️ Comida', '📉 Azúcar Antes', '📈 Azúcar Después', '🥗 Alimentos', '📊 Estado']
+    column_widths = [12, 8, 20, 15, 15, 40, 12]
+
+    def __init__(self, filename, titulo="📊 CONTROL DE AZÚCAR Y ALIMENTACIÓN",
+                 titulo_hoja="Control de Azúcar", incluir_estadisticas=True, **opciones):
+        self.filename = filename
+        self.titulo = titulo
+        self.titulo_hoja = titulo_hoja
+        self.incluir_estadisticas = incluir_estadisticas
+        self._wb = None
+        self._ws = None
+
+    def _celda(self, hoja, valor, estilo):
+        from openpyxl.cell import WriteOnlyCell
+        cell = WriteOnlyCell(hoja, value=valor)
+        cell.style = estilo
+        return cell
+
+    def abrir(self, total):
+        from openpyxl import Workbook
+        from openpyxl.utils import get_column_letter
+
+        self._wb = Workbook(write_only=True)
+        registrar_estilos_excel(self._wb)
+        ws = self._ws = self._wb.create_sheet(self.titulo_hoja)
+
+        # En modo write-only los anchos y las celdas combinadas se definen antes de escribir filas
+        for col, width in enumerate(self.column_widths, 1):
+            ws.column_dimensions[get_column_letter(col)].width = width
+        ws.merged_cells.add("A1:F1")
+
+        ws.append([self._celda(ws, self.titulo, "titulo")])
+        ws.append([self._celda(ws, f"📅 Generado el: {datetime.now().strftime('%d/%m/%Y %H:%M')}", "info")])
+        ws.append([self._celda(ws, f"📊 Total de registros: {total}", "info")])
+        ws.append([])
+        ws.append([self._celda(ws, header, "encabezado") for header in self.headers])
+
+    def escribir(self, fila):
+        ws = self._ws
+        if fila["nivel_azucar_legacy"] is not None:
+            azucar_antes_str = f"{fila['nivel_azucar_legacy']} mg/dL (legacy)"
+        else:
+            azucar_antes_str = "-" if fila["azucar_antes"] is None else f"{fila['azucar_antes']} mg/dL"
+        azucar_despues_str = "-" if fila["azucar_despues"] is None else f"{fila['azucar_despues']} mg/dL"
+
+        ws.append([
+            self._celda(ws, fila["fecha"], "celda"),
+            self._celda(ws, fila["hora"], "celda"),
+            self._celda(ws, fila["nombre_comida"], "celda"),
+            self._celda(ws, azucar_antes_str, "celda"),
+            self._celda(ws, azucar_despues_str, "celda"),
+            self._celda(ws, fila["alimentos_str"], "celda"),
+            self._celda(ws, fila["estado"], fila["estilo_estado"]),
+        ])
+
+    def cerrar(self, estadisticas):
+        if self.incluir_estadisticas:
+            stats_ws = self._wb.create_sheet("📊 Estadísticas")
+            stats_ws.column_dimensions['A'].width = 25
+            stats_ws.column_dimensions['B'].width = 15
+            for label, value in estadisticas.filas_resumen():
+                stats_ws.append([self._celda(stats_ws, label, "etiqueta"), value])
+        self._wb.save(self.filename)
+
+    def abortar(self):
+        # Cerrar la hoja para liberar su archivo temporal
+        if self._ws is not None and not self._ws.closed:
+            self._ws.close()
+
+# Sumideros disponibles según la extensión del archivo de destino
+SUMIDEROS_EXPORTACION = {
+    ".csv": SumideroCSV,
+    ".xlsx": SumideroExcel,
+    ".jsonl": SumideroJSONL,
+}
+
+def clase_sumidero(filename):
+    """Clase de sumidero que corresponde a la extensión de `filename`"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in SUMIDEROS_EXPORTACION:
+        raise ValueError(f"Formato de exportación no soportado: {extension or filename}")
+    return SUMIDEROS_EXPORTACION[extension]
+
+def crear_sumidero(filename, ruta_escritura=None, **opciones):
+    """Crear el sumidero que corresponde a la extensión de `filename`"""
+    return clase_sumidero(filename)(ruta_escritura or filename, **opciones)
+
+def ejecutar_exportacion(registros, sumideros, total):
+    """
+    Recorrer los registros una sola vez alimentando todos los sumideros.
+
+    Cada registro se materializa una vez y la misma fila se entrega a todos
+    los formatos; las estadísticas se acumulan en la misma pasada.
+    """
+    estadisticas = AcumuladorEstadisticas()
+    abiertos = []
+    try:
+        for sumidero in sumideros:
+            sumidero.abrir(total)
+            abiertos.append(sumidero)
+        for registro in registros:
+            fila = materializar_fila(registro)
+            estadisticas.agregar(fila)
+            for sumidero in sumideros:
+                sumidero.escribir(fila)
+        for sumidero in sumideros:
+            sumidero.cerrar(estadisticas)
+    except Exception:
+        for sumidero in abiertos:
+            sumidero.abortar()
+        raise
+    return estadisticas
+
+class ExportacionCancelada(Exception):
+    """La exportación fue cancelada por el usuario"""
+
+class TrabajoExportacion:
+    """Una exportación pendiente o en curso dentro de la cola"""
+
+    def __init__(self, descripcion, destinos, registros, mensaje_exito, **opciones):
+        self.descripcion = descripcion
+        self.destinos = destinos  # Una ruta por formato; todos se escriben en una pasada
+        self.registros = registros
+        self.total = len(registros)
+        self.mensaje_exito = mensaje_exito
+        self.opciones = opciones
+        self.escritos = 0
+        self.estado = "en cola"  # en cola, exportando, completado, cancelado, error
+        self.error = None
+        self.cancelar = threading.Event()
+        self.al_completar = None  # Se ejecuta en el hilo de Tk al notificar el éxito
+
+class ColaExportaciones:
+    """
+    Ejecutar exportaciones en un hilo de fondo, una detrás de otra.
+
+    El hilo solo toca los archivos de destino y el estado de cada trabajo; la
+    interfaz consulta ese estado con `after()` para no llamar a Tk desde otro
+    hilo. Cada destino se escribe primero en un archivo `.parcial` que solo
+    se renombra si la exportación termina bien; los destinos en modo anexar se
+    escriben en su sitio y el sumidero los trunca si se aborta.
+
+    El hilo se arranca con el primer trabajo y espera bloqueado en la cola
+    hasta que `cancelar_todo` le envía `_FIN`.
+    """
+
+    _FIN = None  # Centinela para que el hilo termine
+
+    def __init__(self):
+        self._cola = queue.Queue()
+        self._hilo = None
+        self._cerrojo = threading.Lock()
+        self.trabajos = []
+
+    def encolar(self, trabajo):
+        """Añadir un trabajo y arrancar el hilo si aún no existe"""
+        self.trabajos.append(trabajo)
+        with self._cerrojo:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._procesar, name="exportaciones", daemon=True)
+                self._hilo.start()
+            self._cola.put(trabajo)
+
+    def pendientes(self):
+        """Trabajos en cola o en curso"""
+        return [t for t in self.trabajos if t.estado in ("en cola", "exportando")]
+
+    def recoger_terminados(self):
+        """Sacar de la lista los trabajos ya terminados para notificarlos"""
+        terminados = [t for t in self.trabajos if t.estado not in ("en cola", "exportando")]
+        self.trabajos = [t for t in self.trabajos if t not in terminados]
+        return terminados
+
+    def cancelar_todo(self, espera=5):
+        """Cancelar todos los trabajos, parar el hilo y esperar a que se borren los parciales"""
+        for trabajo in self.trabajos:
+            trabajo.cancelar.set()
+        with self._cerrojo:
+            hilo, self._hilo = self._hilo, None
+            if hilo is not None:
+                self._cola.put(self._FIN)
+        if hilo is not None:
+            hilo.join(espera)
+
+    def _seguir(self, trabajo):
+        """Recorrer los registros contando progreso y atendiendo la cancelación"""
+        for registro in trabajo.registros:
+            if trabajo.cancelar.is_set():
+                raise ExportacionCancelada()
+            yield registro
+            trabajo.escritos += 1
+
+    def _procesar(self):
+        while True:
+            trabajo = self._cola.get()
+            if trabajo is self._FIN:
+                return
+
+            if trabajo.cancelar.is_set():
+                trabajo.estado = "cancelado"
+                continue
+
+            trabajo.estado = "exportando"
+            anexar = trabajo.opciones.get("anexar", False)
+            parciales = {}
+            try:
+                for destino in trabajo.destinos:
+                    en_sitio = anexar and clase_sumidero(destino).admite_anexar
+                    parciales[destino] = destino if en_sitio else f"{destino}.parcial"
+                sumideros = [crear_sumidero(destino, parcial, **trabajo.opciones)
+                             for destino, parcial in parciales.items()]
+                ejecutar_exportacion(self._seguir(trabajo), sumideros, trabajo.total)
+                for destino, parcial in parciales.items():
+                    if parcial != destino:
+                        os.replace(parcial, destino)
+                trabajo.estado = "completado"
+            except ExportacionCancelada:
+                trabajo.estado = "cancelado"
+            except ImportError as e:
+                libreria = (e.name or "openpyxl").split(".")[0]
+                trabajo.error = f"La librería {libreria} no está instalada.\nEjecuta: pip install {libreria}"
+                trabajo.estado = "error"
+            except Exception as e:
+                trabajo.error = f"Error al exportar: {str(e)}"
+                trabajo.estado = "error"
+            finally:
+                if trabajo.estado != "completado":
+                    for destino, parcial in parciales.items():
+                        if parcial != destino and os.path.exists(parcial):
+                            try:
+                                os.remove(parcial)
+                            except OSError:
+                                pass
+                # Soltar la referencia a la copia de los registros
+                trabajo.registros = ()
+
+# ---------------------------------------------------------------------------
+# Núcleo sin interfaz: almacén de registros y servicios de análisis,
+# estadísticas y exportación. Nada de aquí usa tkinter; la ventana
+# (`ControlAzucarApp`), la línea de comandos o un script lo usan igual.
+# ---------------------------------------------------------------------------
+
+class ErrorValidacion(ValueError):
+    """Datos de un registro que no pasan la validación"""
+
+def validar_nivel_azucar(texto, cuando):
+    """Convertir el texto de un nivel de azúcar en float (None si está vacío)"""
+    if texto is None or str(texto).strip() == "":
+        return None
+    try:
+        valor = float(texto)
+    except (TypeError, ValueError):
+        raise ErrorValidacion("Los niveles de azúcar deben ser números válidos")
+    if valor < 0 or valor > 1000:
+        raise ErrorValidacion(f"El nivel de azúcar {cuando} debe estar entre 0 y 1000 mg/dL")
+    return valor
+
+def extraer_fecha_hora_exif(ruta_imagen):
+    """Extraer fecha y hora de los metadatos EXIF de una imagen"""
+    try:
+        from PIL import Image
+
+        # Método 1: Usando PIL
+        with Image.open(ruta_imagen) as img:
+            exifdata = img.getexif()
+            
+            # Buscar fecha en diferentes campos EXIF
+            fecha_campos = [36867, 36868, 306]  # DateTime, DateTimeOriginal, DateTimeDigitized
+            
+            for campo in fecha_campos:
+                if campo in exifdata:
+                    fecha_str = exifdata[campo]
+                    try:
+                        # Formato EXIF: "YYYY:MM:DD HH:MM:SS"
+                        fecha_objeto = datetime.strptime(fecha_str, "%Y:%m:%d %H:%M:%S")
+                        return {
+                            'fecha': fecha_objeto.strftime("%Y-%m-%d"),
+                            'hora': fecha_objeto.strftime("%H:%M"),
+                            'datetime': fecha_objeto,
+                            'fuente': 'EXIF'
+                        }
+                    except ValueError:
+                        continue
+                        
+        # Método 2: Usando exifread como respaldo
+        import exifread
+        with open(ruta_imagen, 'rb') as f:
+            tags = exifread.process_file(f)
+            
+            fecha_tags = ['EXIF DateTimeOriginal', 'EXIF DateTime', 'Image DateTime']
+            
+            for tag_name in fecha_tags:
+                if tag_name in tags:
+                    fecha_str = str(tags[tag_name])
+                    try:
+                        fecha_objeto = datetime.strptime(fecha_str, "%Y:%m:%d %H:%M:%S")
+                        return {
+                            'fecha': fecha_objeto.strftime("%Y-%m-%d"),
+                            'hora': fecha_objeto.strftime("%H:%M"),
+                            'datetime': fecha_objeto,
+                            'fuente': 'EXIF'
+                        }
+                    except ValueError:
+                        continue
+                        
+    except Exception as e:
+        print(f"Error al extraer EXIF: {e}")
+        
+    # Si no se pudo extraer de EXIF, usar fecha/hora actual
+    ahora = datetime.now()
+    return {
+        'fecha': ahora.strftime("%Y-%m-%d"),
+        'hora': ahora.strftime("%H:%M"),
+        'datetime': ahora,
+        'fuente': 'Actual'
+    }
+
+class AlmacenFotos:
+    """
+    Almacén de fotos direccionado por contenido (SHA-256 del archivo).
+
+    Al importar una foto se decodifica una sola vez y se guardan sus
+    derivados en JPEG: una miniatura para la interfaz y una versión reducida
+    para enviar a la IA. Opcionalmente se guarda también una copia del
+    original. Los registros guardan el hash (`foto_hash`), así que la foto
+    sigue disponible aunque el archivo original se mueva o se borre, y la
+    misma foto importada dos veces ocupa una sola vez.
+
+        <directorio>/originales/ab/abcd….jpg
+        <directorio>/miniaturas/ab/abcd….jpg
+        <directorio>/api/ab/abcd….jpg
+
+    `recolectar` borra los archivos de hashes que ya no usa ningún registro.
+    """
+
+    MINIATURA = (300, 300)
+    TAMANO_API = (1024, 1024)
+    CALIDAD_JPEG = 85
+    DERIVADOS = ("miniaturas", "api")
+
+    def __init__(self, directorio, originales=True):
+        self.directorio = directorio
+        self.originales = originales
+
+    @staticmethod
+    def calcular_hash(ruta, bloque=1024 * 1024):
+        """SHA-256 (hex) del contenido del archivo, leído por bloques"""
+        import hashlib
+
+        resumen = hashlib.sha256()
+        with open(ruta, 'rb') as f:
+            for trozo in iter(lambda: f.read(bloque), b""):
+                resumen.update(trozo)
+        return resumen.hexdigest()
+
+    def _ruta(self, tipo, foto_hash, extension=".jpg"):
+        return os.path.join(self.directorio, tipo, foto_hash[:2], foto_hash + extension)
+
+    @staticmethod
+    def _escribir(ruta, escribir):
+        """Escribir un archivo de forma atómica con `escribir(ruta_temporal)`"""
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            escribir(temporal)
+            os.replace(temporal, ruta)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temporal)
+            raise
+
+    def importar(self, ruta):
+        """
+        Añadir la foto de `ruta` al almacén y devolver su hash. Si ya estaba
+        no se vuelve a copiar ni a decodificar. Lanza OSError si el archivo
+        no existe o no es una imagen.
+        """
+        import shutil
+
+        foto_hash = self.calcular_hash(ruta)
+        if self.originales:
+            extension = os.path.splitext(ruta)[1].lower() or ".jpg"
+            if self.ruta_original(foto_hash) is None:
+                self._escribir(self._ruta("originales", foto_hash, extension),
+                               lambda temporal: shutil.copyfile(ruta, temporal))
+        if not all(os.path.exists(self._ruta(tipo, foto_hash)) for tipo in self.DERIVADOS):
+            self._generar_derivados(ruta, foto_hash)
+        return foto_hash
+
+    def _generar_derivados(self, ruta, foto_hash):
+        from PIL import Image, ImageOps
+
+        with Image.open(ruta) as imagen:
+            # Con JPEG se decodifica directamente a escala reducida (mucho más rápido que a tamaño completo)
+            imagen.draft("RGB", self.TAMANO_API)
+            imagen = ImageOps.exif_transpose(imagen).convert("RGB")
+        imagen.thumbnail(self.TAMANO_API)
+        self._escribir(self._ruta("api", foto_hash),
+                       lambda temporal: imagen.save(temporal, "JPEG", quality=self.CALIDAD_JPEG, optimize=True))
+        imagen.thumbnail(self.MINIATURA)  # Desde la versión reducida, no desde el original
+        self._escribir(self._ruta("miniaturas", foto_hash),
+                       lambda temporal: imagen.save(temporal, "JPEG", quality=self.CALIDAD_JPEG))
+
+    def existe(self, foto_hash):
+        return bool(re.fullmatch(r"[0-9a-f]{64}", foto_hash or "")) and os.path.exists(self._ruta("api", foto_hash))
+
+    def ruta_miniatura(self, foto_hash):
+        """Ruta de la miniatura, o None si no está en el almacén"""
+        ruta = self._ruta("miniaturas", foto_hash)
+        return ruta if os.path.exists(ruta) else None
+
+    def ruta_api(self, foto_hash):
+        """Ruta de la versión reducida para la IA, o None si no está en el almacén"""
+        ruta = self._ruta("api", foto_hash)
+        return ruta if os.path.exists(ruta) else None
+
+    def ruta_original(self, foto_hash):
+        """Ruta de la copia del original, o None si no se guardó"""
+        carpeta = os.path.dirname(self._ruta("originales", foto_hash))
+        try:
+            nombres = os.listdir(carpeta)
+        except FileNotFoundError:
+            return None
+        return next((os.path.join(carpeta, n) for n in nombres
+                     if n.startswith(foto_hash) and not n.endswith(".tmp")), None)
+
+    def recolectar(self, en_uso, gracia=3600):
+        """
+        Borrar los archivos de fotos cuyo hash no está en `en_uso`. Se
+        respetan los de menos de `gracia` segundos (fotos recién importadas
+        cuyo registro aún no se ha guardado, quizá en otro proceso).
+        Devuelve (archivos borrados, bytes liberados).
+        """
+        limite = time.time() - gracia
+        borrados = liberados = 0
+        for tipo in ("originales",) + self.DERIVADOS:
+            raiz = os.path.join(self.directorio, tipo)
+            for carpeta, _, nombres in os.walk(raiz):
+                for nombre in nombres:
+                    if nombre.split(".")[0] in en_uso:
+                        continue
+                    ruta = os.path.join(carpeta, nombre)
+                    try:
+                        estado = os.stat(ruta)
+                        if estado.st_mtime > limite:
+                            continue
+                        os.remove(ruta)
+                    except OSError:
+                        continue
+                    borrados += 1
+                    liberados += estado.st_size
+        return borrados, liberados
+
+# Compresión del archivo de datos según su extensión (p. ej. DATA_FILE=control_alimentacion.json.gz)
+COMPRESION_DATOS = {".gz": "gzip", ".xz": "lzma", ".lzma": "lzma"}
+
+def compresion_datos(ruta):
+    """Extensión de compresión del archivo de datos ('.gz', '.xz', '.lzma') o '' si es JSON plano"""
+    extension = os.path.splitext(ruta)[1].lower()
+    return extension if extension in COMPRESION_DATOS else ""
+
+def base_datos(ruta):
+    """Ruta sin extensiones para los archivos asociados: 'datos.json.gz' -> 'datos'"""
+    return os.path.splitext(ruta[:len(ruta) - len(compresion_datos(ruta))])[0]
+
+def abrir_datos(ruta, modo, compresion=""):
+    """Abrir un archivo de datos en modo texto ('r' o 'w'), con gzip o lzma si `compresion` lo indica"""
+    if COMPRESION_DATOS.get(compresion) == "gzip":
+        import gzip
+        opciones = {"compresslevel": 6} if modo == "w" else {}
+        return gzip.open(ruta, modo + "t", encoding="utf-8", **opciones)
+    if COMPRESION_DATOS.get(compresion) == "lzma":
+        import lzma
+        opciones = {"preset": 3} if modo == "w" else {}  # El 6 por defecto tarda varias veces más en guardar
+        return lzma.open(ruta, modo + "t", encoding="utf-8", **opciones)
+    return open(ruta, modo, encoding="utf-8")
+
+class LectorJSON:
+    """
+    Decodificador JSON por bloques para archivos comprimidos.
+
+    `json.load` lee todo el texto descomprimido en una cadena antes de
+    decodificarlo, así que durante la carga conviven el texto completo y los
+    objetos. Este lector lee bloques de `bloque` caracteres y decodifica los
+    elementos de las listas del primer nivel (los registros) de uno en uno
+    con `JSONDecoder.raw_decode`, de modo que solo hay un bloque de texto en
+    memoria. El resto de valores se decodifican enteros.
+
+    Cada `raw_decode` crearía sus propias cadenas para las claves; se
+    comparten entre todos los registros (como hace `json.load` en una sola
+    llamada), lo que ahorra memoria y tiempo.
+    """
+
+    _RESTO_NUMERO = re.compile(r"[0-9.eE+-]*\Z")
+
+    def __init__(self, archivo, bloque=256 * 1024):
+        self.archivo = archivo
+        self.bloque = bloque
+        claves = {}
+        self._decodificador = json.JSONDecoder(
+            object_pairs_hook=lambda pares: {claves.setdefault(clave, clave): valor for clave, valor in pares})
+        self._texto = ""
+        self._posicion = 0
+        self._fin = False
+
+    def _leer_mas(self):
+        trozo = self.archivo.read(self.bloque)
+        self._fin = not trozo
+        self._texto = self._texto[self._posicion:] + trozo
+        self._posicion = 0
+
+    def _siguiente(self):
+        """Primer carácter no blanco a partir de la posición actual ('' al final del archivo)"""
+        while True:
+            while self._posicion < len(self._texto) and self._texto[self._posicion] in " \t\r\n":
+                self._posicion += 1
+            if self._posicion < len(self._texto) or self._fin:
+                return self._texto[self._posicion:self._posicion + 1]
+            self._leer_mas()
+
+    def _esperar(self, caracteres):
+        caracter = self._siguiente()
+        if not caracter or caracter not in caracteres:
+            raise ValueError(f"JSON inválido: se esperaba {' o '.join(caracteres)} y hay {caracter!r}")
+        self._posicion += 1
+        return caracter
+
+    def _valor(self):
+        self._siguiente()
+        while True:
+            try:
+                valor, fin = self._decodificador.raw_decode(self._texto, self._posicion)
+                # Un número cortado por el bloque ("12." o "-2.5e") se decodifica sin el resto: leer más
+                numero = isinstance(valor, (int, float)) and not isinstance(valor, bool)
+                if self._fin or not (numero and self._RESTO_NUMERO.match(self._texto, fin)):
+                    self._posicion = fin
+                    return valor
+            except json.JSONDecodeError:
+                if self._fin:
+                    raise
+            self._leer_mas()
+
+    def cargar(self):
+        """Decodificar un objeto JSON completo"""
+        datos = {}
+        self._esperar("{")
+        if self._siguiente() == "}":
+            self._posicion += 1
+            return datos
+        while True:
+            clave = self._valor()
+            self._esperar(":")
+            if self._siguiente() == "[":
+                self._posicion += 1
+                lista = datos[clave] = []
+                if self._siguiente() == "]":
+                    self._posicion += 1
+                else:
+                    while True:
+                        lista.append(self._valor())
+                        if self._esperar(",]") == "]":
+                            break
+            else:
+                datos[clave] = self._valor()
+            if self._esperar(",}") == "}":
+                return datos
+
+def leer_datos(ruta, compresion=""):
+    """Leer un archivo de datos; los errores de formato o de compresión se lanzan como ValueError"""
+    if not compresion:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    import zlib
+
+    errores = (EOFError, zlib.error)
+    if COMPRESION_DATOS[compresion] == "gzip":
+        import gzip
+        errores += (gzip.BadGzipFile,)
+    else:
+        import lzma
+        errores += (lzma.LZMAError,)
+    try:
+        with abrir_datos(ruta, "r", compresion) as f:
+            return LectorJSON(f).cargar()
+    except errores as e:
+        raise ValueError(f"{ruta} está dañado: {e}") from e
+
+def escribir_datos(ruta, datos, compresion=""):
+    """
+    Escribir los datos en `ruta`. El JSON plano se escribe indentado como
+    siempre; el comprimido, compacto. En ambos casos `json.dump` codifica por
+    partes, sin construir el texto completo en memoria.
+    """
+    with abrir_datos(ruta, "w", compresion) as f:
+        if compresion:
+            json.dump(datos, f, ensure_ascii=False, separators=(",", ":"))
+        else:
+            json.dump(datos, f, ensure_ascii=False, indent=2)
+
+_AUSENTE = object()
+
+def fusionar_tres_vias(base, local, externo):
+    """
+    Fusionar dos versiones de un dict que partieron de `base`. Por clave se
+    queda la del lado que la cambió; si cambiaron las dos y ambas son dicts
+    se fusionan igual un nivel más abajo, y si no gana `local`.
+    """
+    fusionado = {}
+    for clave in itertools.chain(local, (c for c in externo if c not in local)):
+        original = base.get(clave, _AUSENTE)
+        nuestro = local.get(clave, _AUSENTE)
+        suyo = externo.get(clave, _AUSENTE)
+        if nuestro == suyo or suyo == original:
+            valor = nuestro
+        elif nuestro == original:
+            valor = suyo
+        elif isinstance(nuestro, dict) and isinstance(suyo, dict):
+            valor = fusionar_tres_vias(original if isinstance(original, dict) else {}, nuestro, suyo)
+        else:
+            valor = nuestro
+        if valor is not _AUSENTE:
+            fusionado[clave] = valor
+    return fusionado
+
+@contextlib.contextmanager
+def bloqueo_archivo(ruta):
+    """
+    Cerrojo exclusivo entre procesos sobre el archivo `ruta` (se crea si no
+    existe). Usa `fcntl.flock` en Linux/macOS y `msvcrt.locking` en Windows,
+    donde se reintenta durante unos 10 s antes de lanzar OSError.
+    """
+    with open(ruta, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def invertir_evento(tipo, datos):
+    """(tipo, datos) del evento que deshace a este"""
+    if tipo == "alta":
+        return "baja", datos
+    if tipo == "baja":
+        return "alta", datos
+    return tipo, {"antes": datos["despues"], "despues": datos["antes"]}
+
+def aplicar_evento_a_datos(datos, tipo, contenido):
+    """
+    Aplicar un evento a un dict de datos en crudo (sin índices). Es
+    idempotente: una alta de un id que ya existe o una baja de uno que no
+    existe no hacen nada, así que reaplicar eventos ya incluidos es seguro.
+    """
+    registros = datos["registros"]
+    if tipo == "alta":
+        existentes = {r.get("id") for r in registros}
+        registros.extend(r for r in contenido["registros"] if r["id"] not in existentes)
+    elif tipo == "baja":
+        ids = {r["id"] for r in contenido["registros"]}
+        datos["registros"] = [r for r in registros if r.get("id") not in ids]
+    elif tipo == "cambios":
+        nuevos = {r["id"]: r for r in contenido["despues"]}
+        datos["registros"] = [nuevos.get(r.get("id"), r) for r in registros]
+    elif tipo == "cambio":
+        for i, registro in enumerate(registros):
+            if registro.get("id") == contenido["despues"]["id"]:
+                registros[i] = contenido["despues"]
+                break
+    elif tipo == "franjas":
+        datos["configuracion"]["franjas_horarias"] = contenido["despues"]
+        for registro in registros:
+            registro.pop("franja", None)  # Se reclasifican al cargar
+
+def describir_evento(evento):
+    """Texto corto de un evento para la interfaz"""
+    contenido = evento["datos"]
+    if evento["tipo"] == "alta":
+        return f"➕ Alta de {len(contenido['registros'])} registro(s)"
+    if evento["tipo"] == "baja":
+        return f"🗑️ Borrado de {len(contenido['registros'])} registro(s)"
+    if evento["tipo"] == "cambios":
+        return f"🏷️ Alimentos de {len(contenido['despues'])} registro(s) renormalizados"
+    if evento["tipo"] == "cambio":
+        return f"✏️ Cambio de '{contenido['despues'].get('nombre_comida', '')}' ({contenido['despues'].get('fecha', '')})"
+    return "🕐 Cambio de horarios"
+
+class VistaHistorica:
+    """
+    Registros tal como estaban en un momento pasado, sin copiar el historial:
+    se recorren los registros actuales sustituyendo los que cambiaron después
+    por su versión anterior (`capa`: id -> registro, o None si aún no existía)
+    y se añaden al final los que se borraron después.
+
+    La lista de registros del almacén solo crece al final: borrar, editar o
+    fusionar ponen una lista nueva en su lugar, así que la vista sigue
+    recorriendo la que había al crearla. Si las franjas de entonces eran
+    otras, `clasificador` (el de esas franjas) da a cada registro la franja
+    que tenía, en una copia.
+    """
+
+    def __init__(self, actuales, capa, franjas, clasificador=None):
+        self._actuales = actuales
+        self._total = len(actuales)  # Lo que se añada después de crear la vista no cuenta
+        self._capa = capa
+        self.franjas = franjas
+        self._clasificador = clasificador
+
+    def __iter__(self):
+        if self._clasificador is None:
+            yield from self._registros()
+            return
+        for registro in self._registros():
+            franja = self._clasificador.clasificar(registro.get("hora"))
+            yield registro if registro.get("franja") == franja else dict(registro, franja=franja)
+
+    def _registros(self):
+        vistos = set()
+        for registro in itertools.islice(self._actuales, self._total):
+            id_registro = registro.get("id")
+            if id_registro in self._capa:
+                vistos.add(id_registro)
+                anterior = self._capa[id_registro]
+                if anterior is not None:
+                    yield anterior
+            else:
+                yield registro
+        for id_registro, anterior in self._capa.items():
+            if anterior is not None and id_registro not in vistos:
+                yield anterior
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+class HistorialEventos:
+    """
+    Registro de eventos (solo se añade) de las modificaciones del almacén.
+
+    Cada línea de `<base>_eventos.jsonl` es un evento con número de secuencia,
+    momento, tipo ("alta", "baja", "cambio", "cambios" o "franjas") y lo necesario para
+    deshacerlo (los registros completos, o el antes y el después). Deshacer y
+    rehacer también son eventos (con "deshace"/"rehace" apuntando al
+    original), así que las pilas se reconstruyen leyendo el registro y
+    sobreviven a un reinicio.
+
+    En memoria solo se guarda un índice (secuencia, momento y posición en el
+    archivo); el contenido se lee cuando hace falta. Cada `INSTANTANEA_CADA`
+    eventos se guarda una instantánea de los datos junto con la posición en
+    el registro y las pilas en ese punto: al arrancar solo se indexa lo
+    posterior a la última, y el estado se puede reconstruir desde ella más
+    esos eventos. Lo anterior se indexa solo si se pide (una vista muy
+    antigua). Al tomar una instantánea, si el registro pasa de
+    `ROTAR_BYTES`, se aparta a `<base>_eventos_antiguos/` y se empieza otro;
+    los apartados no cambian y se conservan para las vistas históricas.
+    """
+
+    INSTANTANEA_CADA = 500
+    INSTANTANEAS_GUARDADAS = 3
+    PROFUNDIDAD_DESHACER = 1000
+    ROTAR_BYTES = 8 * 1024 * 1024
+
+    def __init__(self, base):
+        self.ruta = base + "_eventos.jsonl"
+        self.bloqueo_file = self.ruta + ".lock"
+        self.directorio_instantaneas = base + "_instantaneas"
+        self.directorio_antiguos = base + "_eventos_antiguos"
+        self._indice_antiguos = {}  # ruta de un registro apartado -> su índice (no cambian)
+        self._reiniciar()
+
+    def _reiniciar(self):
+        """Olvidar lo indexado; se vuelve a partir de la última instantánea en la próxima consulta"""
+        self._indice = []  # (seq, momento, posición) desde `_inicio`
+        self._prefijo = None  # Índice de lo anterior a `_inicio`, solo si se ha pedido
+        self._inicio = None
+        self._leido = 0
+        self._inodo = None
+        self._ultimo = 0  # Último seq visto
+        self._deshacer = {}  # seq -> True, en orden: el siguiente a deshacer es el último
+        self._rehacer = {}
+        self._pilas = None
+
+    def _arrancar(self):
+        """Empezar a indexar desde la última instantánea cuyo punto del registro siga siendo válido"""
+        for seq in reversed(self._instantaneas("punto_")):
+            try:
+                with open(self._ruta_punto(seq), 'r', encoding='utf-8') as f:
+                    punto = json.load(f)
+                if not self._punto_valido(seq, punto["posicion"]):
+                    continue
+            except (OSError, ValueError, KeyError):
+                continue
+            self._inicio = self._leido = punto["posicion"]
+            self._ultimo = seq
+            self._deshacer = dict.fromkeys(punto["deshacer"], True)
+            self._rehacer = dict.fromkeys(punto["rehacer"], True)
+            return
+        self._inicio = 0  # Sin punto válido: se indexa todo el registro
+
+    def _punto_valido(self, seq, posicion):
+        """Si en `posicion` del registro empieza el evento siguiente a `seq` (o nada aún)"""
+        try:
+            with open(self.ruta, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < posicion:
+                    return False  # Registro truncado o sustituido
+                f.seek(posicion)
+                siguiente = f.readline()
+        except FileNotFoundError:
+            return posicion == 0  # Recién apartado y aún sin eventos nuevos
+        return not siguiente or json.loads(siguiente)["seq"] == seq + 1
+
+    def _indexar(self, f, posicion, hasta=None):
+        """(índice, posición final) de las líneas completas desde `posicion` (hasta `hasta`)"""
+        indice = []
+        f.seek(posicion)
+        for linea in f:
+            if not linea.endswith(b"\n") or (hasta is not None and posicion >= hasta):
+                break  # Línea a medio escribir por otro proceso
+            try:
+                evento = json.loads(linea)
+                indice.append((evento["seq"], evento["momento"], posicion, evento.get("deshace"), evento.get("rehace")))
+            except (ValueError, KeyError):
+                pass
+            posicion += len(linea)
+        return indice, posicion
+
+    def _actualizar_indice(self):
+        """Indexar las líneas añadidas desde la última lectura (también por otros procesos)"""
+        try:
+            estado = os.stat(self.ruta)
+        except FileNotFoundError:
+            estado = None
+        if self._inicio is not None and (
+                (estado is None and self._leido) or
+                (estado is not None and (self._inodo not in (None, estado.st_ino) or estado.st_size < self._leido))):
+            self._reiniciar()  # Otro proceso lo apartó, o se ha sustituido o truncado
+        if self._inicio is None:
+            self._arrancar()
+        if estado is None or estado.st_size == self._leido:
+            return
+        try:
+            with open(self.ruta, 'rb') as f:
+                inodo = os.fstat(f.fileno()).st_ino
+                if self._inodo not in (None, inodo):
+                    self._reiniciar()  # Apartado entre el stat y el open; en la próxima consulta
+                    return
+                self._inodo = inodo
+                nuevos, self._leido = self._indexar(f, self._leido)
+        except FileNotFoundError:
+            return
+        if nuevos and self._ultimo and nuevos[0][0] != self._ultimo + 1:
+            self._reiniciar()  # Faltan eventos: se apartó el registro antes de que lo leyéramos
+            return self._actualizar_indice()
+        for seq, momento, posicion, deshace, rehace in nuevos:
+            self._indice.append((seq, momento, posicion))
+            self._apilar(seq, deshace, rehace)
+
+    def _apilar(self, seq, deshace, rehace):
+        """Actualizar las pilas con un evento nuevo"""
+        self._ultimo = seq
+        self._pilas = None
+        if deshace is not None:
+            if self._deshacer.pop(deshace, None):
+                self._rehacer[deshace] = True
+        elif rehace is not None:
+            if self._rehacer.pop(rehace, None):
+                self._deshacer[rehace] = True
+        else:
+            self._deshacer[seq] = True
+            self._rehacer.clear()
+        if len(self._deshacer) > self.PROFUNDIDAD_DESHACER:
+            del self._deshacer[next(iter(self._deshacer))]
+
+    def _tramos(self):
+        """(ruta, índice) de lo indexado, de lo más reciente a lo más antiguo; lo antiguo se indexa al llegar"""
+        yield self.ruta, self._indice
+        if self._inicio:
+            if self._prefijo is None:
+                with open(self.ruta, 'rb') as f:
+                    self._prefijo = self._indexar(f, 0, hasta=self._inicio)[0]
+            yield self.ruta, self._prefijo
+        try:
+            nombres = sorted(os.listdir(self.directorio_antiguos), reverse=True)
+        except FileNotFoundError:
+            return
+        for nombre in nombres:
+            if not nombre.endswith(".jsonl"):
+                continue
+            ruta = os.path.join(self.directorio_antiguos, nombre)
+            if ruta not in self._indice_antiguos:
+                with open(ruta, 'rb') as f:
+                    self._indice_antiguos[ruta] = self._indexar(f, 0)[0]
+            yield ruta, self._indice_antiguos[ruta]
+
+    def _hacia_atras(self):
+        """(ruta, seq, momento, posición) de cada evento, del más reciente al más antiguo"""
+        for ruta, indice in self._tramos():
+            for seq, momento, posicion, *_ in reversed(indice):
+                yield ruta, seq, momento, posicion
+
+    def _leer(self, ruta, posicion):
+        with open(ruta, 'rb') as f:
+            f.seek(posicion)
+            return json.loads(f.readline())
+
+    def __len__(self):
+        self._actualizar_indice()
+        return self._ultimo
+
+    def evento(self, seq):
+        """Evento completo con ese número de secuencia"""
+        self._actualizar_indice()
+        for ruta, indice in self._tramos():
+            if indice and indice[0][0] <= seq:
+                posicion = bisect.bisect_left(indice, (seq,))
+                if posicion < len(indice) and indice[posicion][0] == seq:
+                    return self._leer(ruta, indice[posicion][2])
+                break
+        raise KeyError(seq)
+
+    def anotar(self, tipo, datos, instantanea=None, **marca):
+        """
+        Añadir un evento; devuelve su número de secuencia. Si toca
+        instantánea se guarda `instantanea` (los datos tras el evento).
+        """
+        with bloqueo_archivo(self.bloqueo_file):
+            self._actualizar_indice()
+            seq = self._ultimo + 1
+            evento = {"seq": seq, "momento": ahora_iso(), "tipo": tipo, **marca, "datos": datos}
+            linea = (json.dumps(evento, ensure_ascii=False) + "\n").encode("utf-8")
+            with open(self.ruta, 'ab') as f:
+                f.write(linea)
+                self._inodo = os.fstat(f.fileno()).st_ino
+            self._indice.append((seq, evento["momento"], self._leido))
+            self._leido += len(linea)
+            self._apilar(seq, marca.get("deshace"), marca.get("rehace"))
+            if instantanea is not None and self.toca_instantanea(seq):
+                self.guardar_instantanea(seq, instantanea)
+        return seq
+
+    def pilas(self):
+        """(deshacer, rehacer): secuencias de los eventos que se pueden deshacer o rehacer, el siguiente al final"""
+        self._actualizar_indice()
+        if self._pilas is None:
+            self._pilas = (list(self._deshacer), list(self._rehacer))
+        return self._pilas
+
+    def posteriores(self, momento):
+        """Eventos completos posteriores a `momento` (ISO), del más reciente al más antiguo"""
+        self._actualizar_indice()
+        for ruta, _, momento_evento, posicion in self._hacia_atras():
+            if momento_evento <= momento:
+                break
+            yield self._leer(ruta, posicion)
+
+    # --- Instantáneas --------------------------------------------------------
+
+    def _instantaneas(self, prefijo="instantanea_"):
+        try:
+            nombres = os.listdir(self.directorio_instantaneas)
+        except FileNotFoundError:
+            return []
+        return sorted(int(n[len(prefijo):-len(".json")]) for n in nombres
+                      if n.startswith(prefijo) and n.endswith(".json") and n[len(prefijo):-len(".json")].isdigit())
+
+    def _ruta_instantanea(self, seq):
+        return os.path.join(self.directorio_instantaneas, f"instantanea_{seq:08d}.json")
+
+    def _ruta_punto(self, seq):
+        return os.path.join(self.directorio_instantaneas, f"punto_{seq:08d}.json")
+
+    def guardar_instantanea(self, seq, datos):
+        """
+        Guardar los datos tras el evento `seq`, la posición en el registro y
+        las pilas en ese punto (llamar con el cerrojo del registro, justo
+        después de anotar `seq`), apartar el registro si ha crecido mucho y
+        quitar las instantáneas antiguas
+        """
+        os.makedirs(self.directorio_instantaneas, exist_ok=True)
+        rotar = self._leido >= self.ROTAR_BYTES
+        punto = {"seq": seq, "posicion": 0 if rotar else self._leido,
+                 "deshacer": list(self._deshacer), "rehacer": list(self._rehacer)}
+        for ruta, contenido in ((self._ruta_instantanea(seq), datos), (self._ruta_punto(seq), punto)):
+            temporal = ruta + ".tmp"
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump(contenido, f, ensure_ascii=False)
+            os.replace(temporal, ruta)
+        if rotar:
+            # El punto ya dice "posición 0": si esto falla, al arrancar no cuadra y se indexa todo
+            primero = self._indice[0][0] if self._indice else seq
+            os.makedirs(self.directorio_antiguos, exist_ok=True)
+            try:
+                os.replace(self.ruta, os.path.join(self.directorio_antiguos, f"eventos_{primero:08d}.jsonl"))
+            except OSError as e:
+                print(f"No se pudo apartar el registro de eventos: {e}")
+            else:
+                self._indice, self._prefijo = [], None
+                self._inicio = self._leido = 0
+                self._inodo = None
+        for prefijo, ruta in (("instantanea_", self._ruta_instantanea), ("punto_", self._ruta_punto)):
+            for anterior in self._instantaneas(prefijo)[:-self.INSTANTANEAS_GUARDADAS]:
+                os.remove(ruta(anterior))
+
+    def toca_instantanea(self, seq):
+        # La primera recoge también lo que había antes de empezar a registrar eventos
+        return seq == 1 or seq % self.INSTANTANEA_CADA == 0
+
+    def reconstruir(self):
+        """
+        Datos a partir de la última instantánea y los eventos posteriores
+        (como mucho `INSTANTANEA_CADA` eventos que reaplicar); None si no hay
+        instantáneas
+        """
+        instantaneas = self._instantaneas()
+        if not instantaneas:
+            return None
+        desde = instantaneas[-1]
+        with open(self._ruta_instantanea(desde), 'r', encoding='utf-8') as f:
+            datos = json.load(f)
+        self._actualizar_indice()
+        pendientes = []
+        for ruta, seq, _, posicion in self._hacia_atras():
+            if seq <= desde:
+                break
+            pendientes.append((ruta, posicion))
+        for ruta, posicion in reversed(pendientes):
+            evento = self._leer(ruta, posicion)
+            aplicar_evento_a_datos(datos, evento["tipo"], evento["datos"])
+        return datos
+
+class AlmacenRegistros:
+    """
+    Almacén de registros sobre el archivo JSON de datos.
+
+    Carga y migra el archivo, lo guarda, y mantiene al día los índices
+    derivados (alimentos, sugerencias, alertas, franjas) en cada alta o
+    baja. Los índices se construyen la primera vez que se consultan.
+
+    Las altas, bajas y cambios se hacen bajo `cerrojo`, de modo que la
+    interfaz y la API HTTP pueden escribir desde hilos distintos. Los
+    registros no se modifican en el sitio al editarlos (se sustituyen, en una
+    lista nueva), así que una lista obtenida con `rango` o una `vista` se
+    pueden recorrer fuera del cerrojo.
+    `version` aumenta con cada guardado.
+
+    Varios procesos (la app, un script, la línea de comandos) pueden usar el
+    mismo archivo: los guardados toman un cerrojo de archivo (`*.lock`), se
+    escriben de forma atómica y, si otro proceso guardó desde nuestra última
+    lectura, primero se fusionan sus cambios por id de registro (concurrencia
+    optimista con la firma mtime/tamaño/inodo). La configuración (franjas,
+    alias, alertas…) se fusiona por clave frente a la última versión
+    sincronizada. `recargar_si_cambio` aplica los cambios externos sin guardar.
+
+    Cada alta, baja, cambio de registro o de franjas se anota en `eventos`
+    (`HistorialEventos`), compartido entre procesos: de ahí salen `deshacer`,
+    `rehacer`, `vista` (el historial en un momento pasado) y la recuperación
+    del archivo de datos si se corrompe.
+    """
+
+    def __init__(self, datos_file):
+        self.datos_file = datos_file
+        self.bloqueo_file = datos_file + ".lock"
+        self.cerrojo = threading.RLock()
+        self.version = 0
+        self._firma = None  # Firma del archivo en la última lectura o escritura de este proceso
+        self._sincronizados = {}  # id -> actualizado de los registros en esa misma versión
+        self._configuracion_sincronizada = {}  # Copia de la configuración en esa misma versión
+        self.compresion = compresion_datos(datos_file)  # '.gz'/'.xz' = archivo comprimido
+        base = base_datos(datos_file)
+        self.alertas_file = base + "_alertas.jsonl"
+        self.cgm_file = base + "_cgm.bin"
+        self.fotos_dir = base + "_fotos"
+        self.eventos = HistorialEventos(base)
+        self._marca = None  # deshace/rehace del próximo evento (ver `_marcando`)
+        self.analiticas = MotorAnaliticas(lambda: self.datos["registros"])
+        self.correlacion_cgm = CorrelacionCGM(lambda: self.cgm)
+        self._indice_alimentos = None  # Se construye la primera vez que se consulta
+        self._indice_sugerencias = None
+        self._motor_alertas = None
+        self._cgm = None  # Lecturas del sensor continuo, se cargan al primer uso
+        self._fotos = None
+        self.cargar()
+
+    @property
+    def registros(self):
+        return self.datos["registros"]
+
+    @property
+    def configuracion(self):
+        return self.datos["configuracion"]
+
+    def cargar(self):
         """Cargar datos existentes o crear estructura inicial"""
+        recuperado = False
+        with bloqueo_archivo(self.bloqueo_file):
+            try:
+                self.datos, self._firma = self._leer_disco()
+            except ValueError:
+                datos = self._recuperar()
+                if datos is None:
+                    raise  # Sin instantáneas no hay de dónde reconstruir
+                self.datos, self._firma = datos, None
+                recuperado = True
+
+        # Identificadores estables para exportaciones incrementales
+        self.datos["configuracion"].setdefault("marcas_exportacion", {})
+        migrados = asegurar_identificadores(self.datos) + recuperado
+        self._marcar_sincronizados()
+
+        # Alimentos canónicos (relleno único de los registros que aún no los tienen)
+        self.normalizador = NormalizadorAlimentos(self.datos["configuracion"])
+        migrados += self.normalizador.normalizar_registros(self.datos["registros"])
+
+        # Franja horaria de cada registro
+        self._clasificador = None
+        migrados += self.clasificador.reclasificar(r for r in self.datos["registros"] if "franja" not in r)
+
+        self._indice_alimentos = self._indice_sugerencias = self._motor_alertas = None
+        if migrados:
+            self.guardar()
+
+    def _recuperar(self):
+        """
+        Reconstruir los datos desde la última instantánea y los eventos
+        posteriores cuando el archivo está dañado (llamar con el cerrojo de
+        archivo). El archivo dañado se aparta como `*.corrupto`; devuelve
+        None si no hay instantáneas.
+        """
+        datos = self.eventos.reconstruir()
+        if datos is None:
+            return None
+        os.replace(self.datos_file, self.datos_file + ".corrupto")
+        print(f"⚠️ {self.datos_file} estaba dañado; reconstruido desde el historial de eventos")
+        return datos
+
+    def _firma_disco(self):
+        """(mtime, tamaño, inodo) del archivo de datos, o None si no existe"""
         try:
-            with open(self.datos_file, 'r', encoding='utf-8') as f:
-                self.datos = json.load(f)
+            estado = os.stat(self.datos_file)
         except FileNotFoundError:
-            self.datos = {
-                "registros": [],
-                "configuracion": {
-                    "franjas_horarias": {
-                        "desayuno": {"inicio": "06:00", "fin": "10:00"},
-                        "almuerzo": {"inicio": "10:01", "fin": "13:00"},
-                        "comida": {"inicio": "13:01", "fin": "16:00"},
-                        "merienda": {"inicio": "16:01", "fin": "19:00"},
-                        "cena": {"inicio": "19:01", "fin": "23:59"}
-                    }
-                }
+            return None
+        return (estado.st_mtime_ns, estado.st_size, estado.st_ino)
+
+    def _leer_disco(self):
+        """(datos, firma) del archivo tal como está en disco (llamar con el cerrojo de archivo)"""
+        firma = self._firma_disco()
+        try:
+            return leer_datos(self.datos_file, self.compresion), firma
+        except FileNotFoundError:
+            pass
+        if self.compresion:
+            # Recién pasado a comprimido: se parte del JSON plano, que no se toca
+            sin_comprimir = self.datos_file[:-len(self.compresion)]
+            if os.path.exists(sin_comprimir):
+                return leer_datos(sin_comprimir), None
+        return {
+            "registros": [],
+            "configuracion": {
+                "franjas_horarias": copy.deepcopy(FRANJAS_PREDETERMINADAS)
             }
+        }, None
+
+    def _marcar_sincronizados(self, datos=None):
+        """Recordar qué registros y qué configuración hay en disco (por defecto, los de memoria)"""
+        datos = datos or self.datos
+        self._sincronizados = {r["id"]: r.get("actualizado", "") for r in datos["registros"]}
+        self._configuracion_sincronizada = copy.deepcopy(datos["configuracion"])
+
+    def _fusionar(self, disco):
+        """
+        Fusionar por id los registros guardados por otro proceso con los de
+        memoria. Con la foto de la última sincronización se distingue quién
+        añadió o borró cada registro; si ambos lo modificaron gana el de
+        `actualizado` más reciente. Devuelve (añadidos, quitados, cambiados).
+        """
+        asegurar_identificadores(disco)
+        locales = {r["id"]: r for r in self.datos["registros"]}
+        fusionados, añadidos, quitados, cambiados = [], [], [], []
+        for externo in disco.get("registros", []):
+            local = locales.pop(externo["id"], None)
+            if local is None:
+                if externo["id"] not in self._sincronizados:
+                    fusionados.append(externo)  # Nuevo en el otro proceso
+                    añadidos.append(externo)
+                # Si no, lo borramos aquí
+            elif externo.get("actualizado", "") > local.get("actualizado", ""):
+                fusionados.append(externo)
+                cambiados.append((local, externo))
+            else:
+                fusionados.append(local)
+        for id_registro, local in locales.items():
+            if id_registro in self._sincronizados:
+                quitados.append(local)  # Borrado en el otro proceso
+            else:
+                fusionados.append(local)  # Nuevo aquí, aún sin guardar
+
+        configuracion_cambiada = self._fusionar_configuracion(disco.get("configuracion", {}))
+
+        nuevos = añadidos + [externo for _, externo in cambiados]
+        self.normalizador.normalizar_registros(nuevos)
+        if "franjas_horarias" in configuracion_cambiada:
+            fusionados = self._con_franja(fusionados)[0]
+        else:
+            self.clasificador.reclasificar(r for r in nuevos if "franja" not in r)
+        self.datos["registros"] = fusionados
+        self._aplicar_cambios_externos(añadidos, quitados, cambiados)
+        if configuracion_cambiada & {"alimentos_canonicos", "alias_alimentos", "franjas_horarias"}:
+            self._indice_alimentos = None
+        if "alertas" in configuracion_cambiada:
+            self._motor_alertas = None
+        return añadidos, quitados, cambiados
+
+    def _fusionar_configuracion(self, externa):
+        """
+        Fusionar la configuración guardada por otro proceso con la de memoria
+        (`fusionar_tres_vias` frente a la última sincronizada). Devuelve las
+        claves que cambiaron en memoria.
+        """
+        local = self.datos["configuracion"]
+        fusionada = fusionar_tres_vias(self._configuracion_sincronizada, local, externa)
+        # Las marcas de exportación se combinan aparte: gana la más reciente de cada destino
+        marcas = dict(local.get("marcas_exportacion", {}))
+        for destino, marca in externa.get("marcas_exportacion", {}).items():
+            if marca.get("actualizado", "") > marcas.get(destino, {}).get("actualizado", ""):
+                marcas[destino] = marca
+        fusionada["marcas_exportacion"] = marcas
+
+        cambiadas = {clave for clave in set(local) | set(fusionada) if local.get(clave) != fusionada.get(clave)}
+        self.datos["configuracion"] = fusionada
+        if cambiadas & {"alimentos_canonicos", "alias_alimentos"}:
+            self.normalizador = NormalizadorAlimentos(fusionada)
+        if "franjas_horarias" in cambiadas:
+            self._clasificador = None
+        return cambiadas
+
+    def _aplicar_cambios_externos(self, añadidos, quitados, cambiados):
+        """Poner al día los índices con lo que cambió otro proceso, sin reconstruirlos"""
+        if not (añadidos or quitados or cambiados):
+            return
+        salen = quitados + [anterior for anterior, _ in cambiados]
+        entran = añadidos + [nuevo for _, nuevo in cambiados]
+        for registro in salen:
+            if self._indice_alimentos is not None:
+                self._indice_alimentos.quitar(registro)
+            if self._indice_sugerencias is not None:
+                self._indice_sugerencias.quitar(registro.get("nombre_comida"), registro.get("timestamp"))
+        for registro in entran:
+            if self._indice_alimentos is not None:
+                self._indice_alimentos.agregar(registro)
+            if self._indice_sugerencias is not None:
+                self._indice_sugerencias.registrar(registro.get("nombre_comida"), registro.get("timestamp"))
+        self._motor_alertas = None
+        self.analiticas.invalidar()
+
+    def guardar(self):
+        """
+        Guardar datos en archivo JSON, fusionando antes los cambios de otro
+        proceso si el archivo ha cambiado desde nuestra última lectura
+        """
+        with self.cerrojo, bloqueo_archivo(self.bloqueo_file):
+            if self._firma_disco() != self._firma:
+                disco, _ = self._leer_disco()
+                self._fusionar(disco)
+            temporal = self.datos_file + ".tmp"
+            escribir_datos(temporal, self.datos, self.compresion)
+            os.replace(temporal, self.datos_file)  # Atómico: nadie lee un archivo a medio escribir
+            self._firma = self._firma_disco()
+            self._marcar_sincronizados()
+            self.analiticas.invalidar()
+            self.version += 1
+
+    def recargar_si_cambio(self):
+        """
+        Incorporar los cambios que otro proceso haya guardado en el archivo.
+        Solo hace un `stat` si no ha cambiado. Devuelve (añadidos, quitados,
+        cambiados) como número de registros, o None si no había cambios.
+
+        Si ha cambiado se vuelve a leer el archivo entero: el registro de
+        eventos no basta para reconstruir el estado, porque los alias, las
+        marcas de exportación, el resto de la configuración y las migraciones
+        no pasan por él, y otro proceso puede haber guardado sin anotar (una
+        versión anterior del programa, o una edición a mano).
+        """
+        if self._firma_disco() == self._firma:
+            return None
+        with self.cerrojo, bloqueo_archivo(self.bloqueo_file):
+            disco, firma = self._leer_disco()
+            if firma == self._firma:
+                return None
+            añadidos, quitados, cambiados = self._fusionar(disco)
+            self._firma = firma
+            # Lo que quedó solo en memoria (nuevo aquí o más reciente aquí) se guardará en el siguiente guardado
+            self._marcar_sincronizados(disco)
+            self.version += 1
+        return len(añadidos), len(quitados), len(cambiados)
+
+    @property
+    def indice_alimentos(self):
+        """Índice de respuesta glucémica por alimento, construido bajo demanda"""
+        if self._indice_alimentos is None:
+            self._indice_alimentos = IndiceAlimentos(self.normalizador, self.correlacion_cgm.para_registro)
+            self._indice_alimentos.construir(self.datos["registros"])
+        return self._indice_alimentos
+
+    @property
+    def indice_sugerencias(self):
+        """Índice de nombres de comida por frecuencia y recencia, construido bajo demanda"""
+        if self._indice_sugerencias is None:
+            self._indice_sugerencias = IndiceSugerencias()
+            self._indice_sugerencias.construir(self.datos["registros"])
+        return self._indice_sugerencias
+
+    @property
+    def cgm(self):
+        """Almacén de lecturas del sensor continuo, cargado bajo demanda"""
+        if self._cgm is None:
+            self._cgm = AlmacenCGM(self.cgm_file)
+        return self._cgm
+
+    @property
+    def fotos(self):
+        """Almacén de fotos (FOTOS_ORIGINALES=0 guarda solo miniatura y versión para la IA)"""
+        if self._fotos is None:
+            self._fotos = AlmacenFotos(self.fotos_dir, originales=os.getenv('FOTOS_ORIGINALES', '1') != '0')
+        return self._fotos
+
+    @property
+    def motor_alertas(self):
+        """Motor de alertas con el estado al día del historial, construido bajo demanda"""
+        if self._motor_alertas is None:
+            self._motor_alertas = MotorAlertas(self.datos["configuracion"].get("alertas"))
+            self._motor_alertas.construir(self.datos["registros"])
+        return self._motor_alertas
+
+    @property
+    def clasificador(self):
+        """Clasificador de franjas compilado; se recompila si cambió la configuración"""
+        if self._clasificador is None:
+            self._clasificador = ClasificadorFranjas(self.datos["configuracion"]["franjas_horarias"])
+        return self._clasificador
+
+    def determinar_comida_por_hora(self, hora_str):
+        """Determinar la franja horaria de una hora "HH:MM" (None si no cae en ninguna)"""
+        return self.clasificador.clasificar(hora_str)
+
+    def _con_cambios(self, registros, cambios, actualizado=None):
+        """
+        Lista nueva con una copia de cada registro al que `cambios(registro)`
+        (dict de campos) cambia algo, con `actualizado` si se indica. Los
+        demás son los mismos objetos: los registros no se modifican en el
+        sitio, porque las vistas históricas y las listas de `rango` los
+        comparten. Devuelve (lista, número de registros cambiados).
+        """
+        lista, cambiados = [], 0
+        for registro in registros:
+            campos = cambios(registro)
+            if any(registro.get(campo) != valor for campo, valor in campos.items()):
+                registro = dict(registro, **campos)
+                if actualizado:
+                    registro["actualizado"] = actualizado
+                cambiados += 1
+            lista.append(registro)
+        return lista, cambiados
+
+    def _con_franja(self, registros, actualizado=None):
+        """`_con_cambios` con la franja de cada registro según las franjas actuales"""
+        clasificador = self.clasificador
+        return self._con_cambios(registros, lambda r: {"franja": clasificador.clasificar(r.get("hora"))}, actualizado)
+
+    def cambiar_franjas(self, franjas):
+        """Aplicar una nueva configuración de franjas y reclasificar todo el historial"""
+        with self.cerrojo:
+            anteriores = self.datos["configuracion"]["franjas_horarias"]
+            self.datos["configuracion"]["franjas_horarias"] = franjas
+            self._clasificador = None
+            self.datos["registros"], cambiados = self._con_franja(self.datos["registros"], ahora_iso())
+            self.guardar()
+            self._anotar("franjas", {"antes": anteriores, "despues": franjas})
+        return cambiados
+
+    def _cambiar_registros(self, cambios, actualizado):
+        """
+        Aplicar `cambios` (ver `_con_cambios`) a todos los registros, guardar
+        y anotar los cambiados en un solo evento "cambios". Devuelve cuántos
+        cambiaron.
+        """
+        with self.cerrojo:
+            registros = self.datos["registros"]
+            nuevos, cambiados = self._con_cambios(registros, cambios, actualizado)
+            pares = [(antes, despues) for antes, despues in zip(registros, nuevos) if antes is not despues]
+            self.datos["registros"] = nuevos
+            self.guardar()
+            if pares:
+                self._anotar("cambios", {"antes": [a for a, _ in pares], "despues": [d for _, d in pares]})
+            self._indice_alimentos = self._indice_sugerencias = self._motor_alertas = None
+        return cambiados
+
+    def aplicar_alias(self):
+        """
+        Volver a normalizar todos los alimentos tras cambiar la tabla de alias
+        (en copias de los registros que cambian); devuelve cuántos cambiaron
+        """
+        with self.cerrojo:
+            resolver = self.normalizador.resolver
+            return self._cambiar_registros(
+                lambda r: {"alimentos_ids": [resolver(a) for a in r.get("alimentos", [])]}, ahora_iso())
+
+    def crear_registro(self, nombre_comida, alimentos, azucar_antes=None, azucar_despues=None,
+                       metadata=None, foto_path=None, requiere_alimentos=True, foto_hash=None):
+        """
+        Construir un registro validado (sin añadirlo). `azucar_antes` y
+        `azucar_despues` pueden ser texto o número; `metadata` es el resultado
+        de `extraer_fecha_hora_exif` (None = fecha y hora actuales) y
+        `foto_hash` el de la foto en el almacén de fotos.
+        Lanza `ErrorValidacion` si los datos no son válidos.
+        """
+        nombre_comida = (nombre_comida or "").strip()
+        if not nombre_comida:
+            raise ErrorValidacion("Por favor ingresa el nombre de la comida")
+        antes = validar_nivel_azucar(azucar_antes, "antes")
+        despues = validar_nivel_azucar(azucar_despues, "después")
+        if antes is None and despues is None:
+            raise ErrorValidacion("Por favor ingresa al menos un nivel de azúcar (antes o después)")
+        if requiere_alimentos and not alimentos:
+            raise ErrorValidacion("Por favor analiza una foto primero")
+
+        if metadata:
+            # Usar fecha/hora de los metadatos EXIF
+            fecha, hora = metadata['fecha'], metadata['hora']
+            timestamp, fuente_fecha = metadata['datetime'].isoformat(), metadata['fuente']
+        else:
+            ahora = datetime.now()
+            fecha, hora = ahora.strftime("%Y-%m-%d"), ahora.strftime("%H:%M")
+            timestamp, fuente_fecha = ahora.isoformat(), 'Actual'
+
+        return {
+            "id": uuid.uuid4().hex,
+            "actualizado": ahora_iso(),
+            "fecha": fecha,
+            "hora": hora,
+            "nombre_comida": nombre_comida,
+            "azucar_antes": antes,
+            "azucar_despues": despues,
+            "alimentos": list(alimentos),
+            "alimentos_ids": [self.normalizador.resolver(a) for a in alimentos],
+            "foto_path": foto_path,
+            "foto_hash": foto_hash,
+            "timestamp": timestamp,
+            "fuente_fecha": fuente_fecha,  # Indica si la fecha viene de EXIF o es la actual
+            "franja": self.determinar_comida_por_hora(hora)
+        }
+
+    def agregar(self, registro):
+        """Añadir y guardar un registro; devuelve las alertas que dispara"""
+        with self.cerrojo:
+            self.datos["registros"].append(registro)
+            self.guardar()
+            self._anotar("alta", {"registros": [registro]})
+            if self._indice_alimentos is not None:
+                self._indice_alimentos.agregar(registro)
+            if self._indice_sugerencias is not None:
+                self._indice_sugerencias.registrar(registro.get("nombre_comida"), registro.get("timestamp"))
+            alertas = self.motor_alertas.evaluar(registro, self.datos["registros"])
+            self.registrar_alertas(alertas)
+        return alertas
+
+    def agregar_lote(self, registros, alertas=True):
+        """
+        Añadir muchos registros con un único guardado; devuelve las alertas
+        que disparan (ninguna con `alertas=False`, p. ej. al restaurar)
+        """
+        registros = sorted(registros, key=lambda r: r.get("timestamp") or "")
+        evaluar, alertas = alertas, []
+        with self.cerrojo:
+            self.datos["registros"].extend(registros)
+            self.guardar()
+            if registros:
+                self._anotar("alta", {"registros": registros})
+            motor = self.motor_alertas if evaluar else None
+            for registro in registros:
+                if self._indice_alimentos is not None:
+                    self._indice_alimentos.agregar(registro)
+                if self._indice_sugerencias is not None:
+                    self._indice_sugerencias.registrar(registro.get("nombre_comida"), registro.get("timestamp"))
+                if evaluar:
+                    # Sin historial: los registros fuera de orden solo pasan las reglas puntuales
+                    alertas.extend(motor.evaluar(registro))
+            self._motor_alertas = None  # Una sola reconstrucción al final en vez de una por registro
+            self.registrar_alertas(alertas)
+        return alertas
+
+    def borrar(self, registros):
+        """Borrar los registros indicados; devuelve cuántos se borraron"""
+        ids = {r.get("id") for r in registros}
+        with self.cerrojo:
+            quedan, borrados = [], []
+            for registro in self.datos["registros"]:
+                (borrados if registro.get("id") in ids else quedan).append(registro)
+            self.datos["registros"] = quedan
+            self.guardar()
+            if borrados:
+                # Los registros completos, para poder deshacer el borrado
+                self._anotar("baja", {"registros": borrados})
+            for registro in borrados:
+                if self._indice_alimentos is not None:
+                    self._indice_alimentos.quitar(registro)
+                if self._indice_sugerencias is not None:
+                    self._indice_sugerencias.quitar(registro.get("nombre_comida"), registro.get("timestamp"))
+            self._motor_alertas = None  # Las rachas y la media dependen de las lecturas borradas
+        return len(borrados)
+
+    def buscar(self, id_registro):
+        """Registro con ese id (None si no existe)"""
+        with self.cerrojo:
+            return next((r for r in self.datos["registros"] if r.get("id") == id_registro), None)
+
+    def actualizar(self, id_registro, cambios):
+        """
+        Modificar nombre, alimentos o niveles de un registro y guardarlo.
+        El registro se sustituye por una copia; devuelve la nueva versión.
+        Lanza `KeyError` si no existe y `ErrorValidacion` si los datos no son válidos.
+        """
+        with self.cerrojo:
+            anterior = self.buscar(id_registro)
+            if anterior is None:
+                raise KeyError(id_registro)
+            registro = dict(anterior)
+            if "nombre_comida" in cambios:
+                registro["nombre_comida"] = (cambios["nombre_comida"] or "").strip()
+                if not registro["nombre_comida"]:
+                    raise ErrorValidacion("Por favor ingresa el nombre de la comida")
+            if "azucar_antes" in cambios:
+                registro["azucar_antes"] = validar_nivel_azucar(cambios["azucar_antes"], "antes")
+            if "azucar_despues" in cambios:
+                registro["azucar_despues"] = validar_nivel_azucar(cambios["azucar_despues"], "después")
+            if registro.get("azucar_antes") is None and registro.get("azucar_despues") is None \
+                    and registro.get("nivel_azucar") is None:
+                raise ErrorValidacion("Por favor ingresa al menos un nivel de azúcar (antes o después)")
+            if "alimentos" in cambios:
+                registro["alimentos"] = list(cambios["alimentos"] or [])
+                registro["alimentos_ids"] = [self.normalizador.resolver(a) for a in registro["alimentos"]]
+            registro["actualizado"] = ahora_iso()
+            self._sustituir(registro)
+        return registro
+
+    def _sustituir(self, registro):
+        """Sustituir el registro con el mismo id por `registro`, guardar y anotar el cambio"""
+        with self.cerrojo:
+            registros = self.datos["registros"]
+            posicion = next((i for i, r in enumerate(registros) if r.get("id") == registro["id"]), None)
+            if posicion is None:
+                raise KeyError(registro["id"])
+            anterior = registros[posicion]
+            # Lista nueva: las vistas históricas y las copias de `rango` siguen viendo la anterior
+            self.datos["registros"] = registros[:posicion] + [registro] + registros[posicion + 1:]
+            self.guardar()
+            self._anotar("cambio", {"antes": anterior, "despues": registro})
+            if self._indice_alimentos is not None:
+                self._indice_alimentos.quitar(anterior)
+                self._indice_alimentos.agregar(registro)
+            if self._indice_sugerencias is not None:
+                self._indice_sugerencias.quitar(anterior.get("nombre_comida"), anterior.get("timestamp"))
+                self._indice_sugerencias.registrar(registro.get("nombre_comida"), registro.get("timestamp"))
+            self._motor_alertas = None
+
+    def _anotar(self, tipo, datos):
+        """Anotar un evento (con la marca de deshacer/rehacer en curso) y tomar instantánea si toca"""
+        marca, self._marca = self._marca or {}, None
+        try:
+            self.eventos.anotar(tipo, datos, instantanea=self.datos, **marca)
+        except OSError as e:
+            # Los datos ya están guardados; solo se pierde poder deshacer este cambio
+            print(f"Error al anotar evento: {e}")
+
+    @contextlib.contextmanager
+    def _marcando(self, **marca):
+        """
+        Marcar el evento que anote la operación del bloque como deshacer o
+        rehacer de otro. Si la operación no cambió nada se anota un evento
+        vacío igualmente, para que las pilas avancen.
+        """
+        self._marca = marca
+        try:
+            yield
+        finally:
+            if self._marca is not None:
+                self._anotar("alta", {"registros": []})
+
+    def puede_deshacer(self):
+        return bool(self.eventos.pilas()[0])
+
+    def puede_rehacer(self):
+        return bool(self.eventos.pilas()[1])
+
+    def deshacer(self):
+        """Deshacer el último cambio aún no deshecho; devuelve su evento o None si no hay"""
+        with self.cerrojo:
+            pila = self.eventos.pilas()[0]
+            if not pila:
+                return None
+            evento = self.eventos.evento(pila[-1])
+            with self._marcando(deshace=evento["seq"]):
+                self._aplicar_evento(*invertir_evento(evento["tipo"], evento["datos"]))
+        return evento
+
+    def rehacer(self):
+        """Volver a aplicar el último cambio deshecho; devuelve su evento o None si no hay"""
+        with self.cerrojo:
+            pila = self.eventos.pilas()[1]
+            if not pila:
+                return None
+            evento = self.eventos.evento(pila[-1])
+            with self._marcando(rehace=evento["seq"]):
+                self._aplicar_evento(evento["tipo"], evento["datos"])
+        return evento
+
+    def _aplicar_evento(self, tipo, datos):
+        """
+        Aplicar un evento al almacén con las operaciones normales. Lo que ya
+        no aplica (registros que ya existen, o que otro proceso borró) se
+        omite. Los registros restaurados llevan un `actualizado` nuevo para
+        que ganen en la fusión con otros procesos.
+        """
+        if tipo == "franjas":
+            self.cambiar_franjas(datos["despues"])
+            return
+        if tipo == "cambio":
+            if self.buscar(datos["despues"]["id"]) is not None:
+                self._sustituir(dict(datos["despues"], actualizado=ahora_iso()))
+            return
+        if tipo == "cambios":
+            por_id = {r["id"]: r for r in datos["despues"]}
+            self._cambiar_registros(lambda r: por_id.get(r.get("id"), {}), ahora_iso())
+            return
+        ids = {r.get("id") for r in self.datos["registros"]}
+        if tipo == "baja":
+            presentes = [r for r in datos["registros"] if r["id"] in ids]
+            if presentes:
+                self.borrar(presentes)
+        else:
+            ausentes = [dict(r, actualizado=ahora_iso()) for r in datos["registros"] if r["id"] not in ids]
+            if ausentes:
+                self.agregar_lote(ausentes, alertas=False)
+
+    def vista(self, momento):
+        """
+        Registros tal como estaban en `momento` ("AAAA-MM-DDTHH:MM[:SS]").
+        Solo se leen los eventos posteriores a ese momento; los registros
+        actuales no se copian (ver `VistaHistorica`).
+        """
+        with self.cerrojo:
+            capa = {}
+            franjas = self.datos["configuracion"]["franjas_horarias"]
+            for evento in self.eventos.posteriores(momento):
+                contenido = evento["datos"]
+                if evento["tipo"] == "alta":
+                    capa.update((r["id"], None) for r in contenido["registros"])
+                elif evento["tipo"] == "baja":
+                    capa.update((r["id"], r) for r in contenido["registros"])
+                elif evento["tipo"] == "cambios":
+                    capa.update((r["id"], r) for r in contenido["antes"])
+                elif evento["tipo"] == "cambio":
+                    capa[contenido["antes"]["id"]] = contenido["antes"]
+                else:
+                    franjas = contenido["antes"]
+            # Con otras franjas en aquel momento, la franja de cada registro se recalcula al recorrer la vista
+            actuales = self.datos["configuracion"]["franjas_horarias"]
+            clasificador = ClasificadorFranjas(franjas) if franjas != actuales else None
+            return VistaHistorica(self.datos["registros"], capa, franjas, clasificador)
+
+    def rango(self, desde=None, hasta=None):
+        """Registros con fecha entre `desde` y `hasta` ("AAAA-MM-DD", ambos incluidos)"""
+        with self.cerrojo:
+            return [r for r in self.datos["registros"]
+                    if (desde is None or r.get("fecha", "") >= desde) and (hasta is None or r.get("fecha", "") <= hasta)]
+
+    def importar_cgm(self, minutos, decimas):
+        """Añadir lecturas del sensor; devuelve cuántas eran nuevas"""
+        with self.cerrojo:
+            nuevas = self.cgm.agregar_lote(minutos, decimas)
+            if nuevas:
+                self._indice_alimentos = None  # Las respuestas del sensor por alimento han cambiado
+                self.version += 1
+        return nuevas
+
+    def importar_fotos_existentes(self):
+        """
+        Pasar al almacén de fotos las de los registros que solo tienen
+        `foto_path`. Devuelve (importadas, no encontradas).
+        """
+        with self.cerrojo:
+            pendientes = [r for r in self.datos["registros"] if r.get("foto_path") and not r.get("foto_hash")]
+        hashes, fallidas = {}, 0
+        for registro in pendientes:  # Lo lento (leer y reducir fotos) fuera del cerrojo
+            try:
+                hashes[registro["id"]] = self.fotos.importar(registro["foto_path"])
+            except OSError:
+                fallidas += 1
+        if hashes:
+            with self.cerrojo:
+                registros = list(self.datos["registros"])  # Sin tocar la lista que pueda usar una vista
+                for i, registro in enumerate(registros):
+                    foto_hash = hashes.get(registro.get("id"))
+                    if foto_hash and not registro.get("foto_hash"):
+                        registros[i] = dict(registro, foto_hash=foto_hash, actualizado=ahora_iso())
+                self.datos["registros"] = registros
+                self.guardar()
+        return len(hashes), fallidas
+
+    def recolectar_fotos(self, dias=30):
+        """
+        Borrar del almacén las fotos que no usa ningún registro. Se conservan
+        las de registros borrados o editados en los últimos `dias` días, para
+        que deshacer o restaurar desde el historial las recupere. Devuelve
+        (archivos borrados, bytes liberados).
+        """
+        with self.cerrojo:
+            en_uso = {r.get("foto_hash") for r in self.datos["registros"]}
+        desde = (datetime.now() - timedelta(days=dias)).isoformat(timespec="seconds")
+        for evento in self.eventos.posteriores(desde):
+            contenido = evento["datos"]
+            registros = list(contenido.get("registros", []))
+            for lado in (contenido.get("antes"), contenido.get("despues")):
+                registros.extend(lado if isinstance(lado, list) else [lado])  # "cambios" guarda listas
+            for registro in registros:
+                if isinstance(registro, dict):
+                    en_uso.add(registro.get("foto_hash"))
+        en_uso.discard(None)
+        return self.fotos.recolectar(en_uso)
+
+    def registrar_alertas(self, alertas):
+        """Añadir alertas al registro de alertas (una línea JSON por alerta)"""
+        if not alertas:
+            return
+        try:
+            with open(self.alertas_file, 'a', encoding='utf-8') as f:
+                for alerta in alertas:
+                    f.write(json.dumps(alerta, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Error al registrar alertas: {e}")
+
+    def leer_alertas(self, limite=500):
+        """Últimas `limite` alertas registradas, de la más reciente a la más antigua"""
+        recientes = collections.deque(maxlen=limite)
+        try:
+            with open(self.alertas_file, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    if linea.strip():
+                        recientes.append(linea)
+        except FileNotFoundError:
+            return []
+        alertas = []
+        for linea in reversed(recientes):
+            try:
+                alertas.append(json.loads(linea))
+            except ValueError:
+                continue
+        return alertas
+
+class ServicioAnalisis:
+    """Análisis de fotos: metadatos EXIF e identificación de alimentos con Abacus.AI"""
+
+    def __init__(self, almacen):
+        self.almacen = almacen
+        # El cliente de Abacus.AI se crea al analizar la primera foto
+        self._cliente = None
+        self.error_configuracion = AbacusAIClient.error_configuracion()
+
+    @property
+    def cliente(self):
+        """Cliente de Abacus.AI, creado en el primer uso (None si la configuración no es válida)"""
+        if self._cliente is None and self.error_configuracion is None:
+            try:
+                self._cliente = AbacusAIClient()
+            except Exception as e:
+                self.error_configuracion = str(e)
+        return self._cliente
+
+    def metadatos(self, ruta_imagen):
+        """Fecha y hora de la foto (EXIF o, si no hay, las actuales)"""
+        return extraer_fecha_hora_exif(ruta_imagen)
+
+    def identificar_alimentos(self, ruta_imagen):
+        """Alimentos detectados en la foto; lanza excepción si la IA no está disponible o falla"""
+        if not self.cliente:
+            raise ValueError(f"Error al inicializar Abacus.AI: {self.error_configuracion}")
+        return self.cliente.identificar_alimentos(ruta_imagen)
+
+    def canonicos(self, alimentos):
+        """Pares (alimento, nombre canónico si difiere de cómo se escribió o None)"""
+        normalizador = self.almacen.normalizador
+        pares = []
+        for alimento in alimentos:
+            id_alimento = normalizador.resolver(alimento, crear=False)
+            canonico = normalizador.nombre(id_alimento) if id_alimento else None
+            if canonico and normalizar_alimento(canonico) == normalizar_alimento(alimento):
+                canonico = None
+            pares.append((alimento, canonico))
+        return pares
+
+class ServicioEstadisticas:
+    """Estadísticas, impacto por alimento, alertas y gráficos sobre el almacén"""
+
+    def __init__(self, almacen):
+        self.almacen = almacen
+        self.graficos = GraficosTendencias(almacen.analiticas, lambda: almacen.cgm)
+
+    def resumen(self, desde=None, hasta=None, objetivo=OBJETIVO_GLUCOSA):
+        """
+        Resumen de glucosa del rango (ver `MotorAnaliticas.resumen`) con una
+        clave "sensor" con las estadísticas del CGM en el mismo rango (o None)
+        """
+        resumen = dict(self.almacen.analiticas.resumen(desde, hasta, objetivo))
+        cgm = self.almacen.cgm
+        resumen["sensor"] = calcular_estadisticas_glucosa(cgm.valores(desde, hasta), objetivo) if len(cgm) else None
+        return resumen
+
+    def impacto_alimentos(self, ordenar_por="delta_media", descendente=True, minimo_deltas=0):
+        return self.almacen.indice_alimentos.ranking(ordenar_por, descendente, minimo_deltas)
+
+    def alertas(self, limite=500):
+        return self.almacen.leer_alertas(limite)
+
+    def figura(self, desde=None, hasta=None, resolucion="Lecturas", objetivo=OBJETIVO_GLUCOSA):
+        return self.graficos.figura(desde, hasta, resolucion, objetivo)
+
+class ServicioExportacion:
+    """
+    Exportaciones sobre el almacén: síncronas (`exportar`, para scripts) o en
+    segundo plano con la cola (`encolar`), y marcas de exportación incremental.
+    """
+
+    def __init__(self, almacen):
+        self.almacen = almacen
+        self.cola = ColaExportaciones()
+
+    def exportar(self, destinos, registros=None, **opciones):
+        """Exportar en una sola pasada y en este hilo; devuelve el acumulador de estadísticas"""
+        registros = self.almacen.registros if registros is None else registros
+        sumideros = [crear_sumidero(destino, **opciones) for destino in destinos]
+        return ejecutar_exportacion(iter(registros), sumideros, len(registros))
+
+    def encolar(self, descripcion, destinos, registros, mensaje_exito, al_completar=None, **opciones):
+        """Encolar una exportación en segundo plano; devuelve el trabajo"""
+        # Copia superficial: los borrados posteriores no afectan a la exportación
+        trabajo = TrabajoExportacion(descripcion, destinos, list(registros), mensaje_exito, **opciones)
+        trabajo.al_completar = al_completar
+        self.cola.encolar(trabajo)
+        return trabajo
+
+    def cambios(self, destino):
+        """(registros nuevos o modificados desde la última exportación a `destino`, marca anterior)"""
+        marca = self.almacen.configuracion["marcas_exportacion"].get(clave_destino(destino), {}).get("actualizado")
+        return registros_desde_marca(self.almacen.registros, marca), marca
+
+    def confirmar_marca(self, destino, registros, almacen=None):
+        """
+        Guardar la marca de exportación de `destino` tras exportar `registros`
+        en `almacen` (por defecto el actual; pasar el de cuando se encoló, por
+        si entretanto se ha cambiado de perfil)
+        """
+        almacen = almacen or self.almacen
+        nueva_marca = max(r.get("actualizado", "") for r in registros)
+        almacen.configuracion["marcas_exportacion"][clave_destino(destino)] = {
+            "actualizado": nueva_marca, "exportado": ahora_iso()
+        }
+        almacen.guardar()
+
+def _resumen_perfil(datos_file, desde, hasta, objetivo):
+    """
+    Resumen de glucosa de un perfil leyendo su archivo (se ejecuta en un
+    proceso aparte). Solo lee: sin `AlmacenRegistros`, que cargaría el
+    historial y los índices y podría guardar migraciones en el archivo de
+    otro perfil.
+    """
+    compresion = compresion_datos(datos_file)
+    registros = []
+    for ruta, formato in ((datos_file, compresion), (datos_file[:len(datos_file) - len(compresion)], "")):
+        try:
+            registros = leer_datos(ruta, formato).get("registros", [])
+            break
+        except FileNotFoundError:
+            continue  # Recién pasado a comprimido: el JSON plano sigue siendo el bueno
+    resumen = dict(MotorAnaliticas(lambda: registros).resumen(desde, hasta, objetivo))
+    cgm = AlmacenCGM(base_datos(datos_file) + "_cgm.bin")
+    resumen["sensor"] = calcular_estadisticas_glucosa(cgm.valores(desde, hasta), objetivo) if len(cgm) else None
+    return resumen
+
+def combinar_resumenes(resumenes):
+    """Totales de varios resúmenes: lecturas, media ponderada y tiempo en rango conjunto"""
+    glucosas = [r["glucosa"] for r in resumenes if r.get("glucosa")]
+    lecturas = sum(e["lecturas"] for e in glucosas)
+    total = {"registros": sum(r["registros"] for r in resumenes), "lecturas": lecturas}
+    if lecturas:
+        media = sum(e["media"] * e["lecturas"] for e in glucosas) / lecturas
+        bajo = sum(e["bajo_rango"] for e in glucosas)
+        sobre = sum(e["sobre_rango"] for e in glucosas)
+        total.update({
+            "media": media, "gmi": 3.31 + 0.02392 * media,
+            "tir": (lecturas - bajo - sobre) / lecturas * 100,
+            "tbr": bajo / lecturas * 100, "tar": sobre / lecturas * 100,
+        })
+    return total
+
+class GestorPerfiles:
+    """
+    Perfiles (una persona cada uno), cada uno con su propio archivo de datos.
+
+    El perfil "principal" es el archivo de DATA_FILE, así que una instalación
+    sin perfiles sigue igual; los demás viven en `perfiles/<clave>.json` junto
+    a él y cada archivo trae sus propios `*_alertas.jsonl` y `*_cgm.bin`. La
+    lista de perfiles y el activo se guardan en `<base>_perfiles.json`.
+
+    Solo el perfil activo se carga en memoria; las consultas que cruzan
+    perfiles (`resumen_todos`) leen cada archivo en un proceso aparte.
+    """
+
+    PRINCIPAL = "principal"
+
+    def __init__(self, datos_file):
+        self.datos_file = datos_file
+        self.directorio = os.path.dirname(os.path.abspath(datos_file))
+        self.perfiles_file = base_datos(datos_file) + "_perfiles.json"
+        self._almacenes = {}
+        try:
+            with open(self.perfiles_file, 'r', encoding='utf-8') as f:
+                self.configuracion = json.load(f)
+        except FileNotFoundError:
+            self.configuracion = {"activo": self.PRINCIPAL, "perfiles": {}}
+        # El principal siempre apunta al DATA_FILE actual
+        self.configuracion["perfiles"][self.PRINCIPAL] = {
+            "nombre": self.configuracion["perfiles"].get(self.PRINCIPAL, {}).get("nombre", "Principal"),
+            "archivo": os.path.basename(datos_file),
+        }
+        if self.configuracion.get("activo") not in self.configuracion["perfiles"]:
+            self.configuracion["activo"] = self.PRINCIPAL
+
+    def guardar(self):
+        with open(self.perfiles_file, 'w', encoding='utf-8') as f:
+            json.dump(self.configuracion, f, ensure_ascii=False, indent=2)
+
+    @property
+    def activo(self):
+        return self.configuracion["activo"]
+
+    def claves(self):
+        return list(self.configuracion["perfiles"])
+
+    def nombre(self, clave):
+        return self.configuracion["perfiles"][clave]["nombre"]
+
+    def ruta(self, clave):
+        return os.path.join(self.directorio, self.configuracion["perfiles"][clave]["archivo"])
+
+    def buscar(self, texto):
+        """Clave del perfil por clave o por nombre (sin distinguir mayúsculas ni tildes); None si no existe"""
+        buscado = normalizar_alimento(texto)
+        for clave in self.claves():
+            if buscado in (clave, normalizar_alimento(self.nombre(clave))):
+                return clave
+        return None
+
+    def almacen(self, clave=None):
+        """Almacén del perfil (por defecto el activo), cargado la primera vez que se pide"""
+        clave = clave or self.activo
+        if clave not in self._almacenes:
+            self._almacenes[clave] = AlmacenRegistros(self.ruta(clave))
+        return self._almacenes[clave]
+
+    def activar(self, clave):
+        """Hacer activo un perfil, liberar los demás de memoria y devolver su almacén"""
+        if clave not in self.configuracion["perfiles"]:
+            raise KeyError(clave)
+        self._almacenes = {c: a for c, a in self._almacenes.items() if c == clave}
+        if self.configuracion["activo"] != clave:
+            self.configuracion["activo"] = clave
+            self.guardar()
+        return self.almacen(clave)
+
+    def crear(self, nombre):
+        """Dar de alta un perfil vacío; devuelve su clave"""
+        nombre = (nombre or "").strip()
+        if not nombre:
+            raise ErrorValidacion("Por favor ingresa un nombre para el perfil")
+        if self.buscar(nombre):
+            raise ErrorValidacion(f"Ya existe un perfil llamado '{nombre}'")
+        base = "".join(c if c.isalnum() else "_" for c in normalizar_alimento(nombre)).strip("_") or "perfil"
+        clave, numero = base, 2
+        while clave in self.configuracion["perfiles"]:
+            clave, numero = f"{base}_{numero}", numero + 1
+        os.makedirs(os.path.join(self.directorio, "perfiles"), exist_ok=True)
+        self.configuracion["perfiles"][clave] = {"nombre": nombre, "archivo": os.path.join("perfiles", f"{clave}.json{compresion_datos(self.datos_file)}")}
+        self.guardar()
+        return clave
+
+    def eliminar(self, clave):
+        """Quitar un perfil de la lista (sus archivos de datos no se borran)"""
+        if clave == self.PRINCIPAL or clave == self.activo:
+            raise ErrorValidacion("No se puede quitar el perfil principal ni el activo")
+        del self.configuracion["perfiles"][clave]
+        self._almacenes.pop(clave, None)
+        self.guardar()
+
+    def resumen_todos(self, desde=None, hasta=None, objetivo=OBJETIVO_GLUCOSA, procesos=None):
+        """
+        Resumen de glucosa de cada perfil y totales combinados. Cada perfil se
+        lee en su propio proceso (en paralelo); si no hay procesos disponibles
+        se hace uno tras otro. Devuelve {"perfiles": {clave: resumen}, "total": ...}.
+        """
+        claves = self.claves()
+        argumentos = [(self.ruta(clave), desde, hasta, tuple(objetivo)) for clave in claves]
+        resumenes = None
+        if len(claves) > 1:
+            from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+
+            try:
+                with ProcessPoolExecutor(max_workers=min(len(claves), procesos or os.cpu_count() or 1)) as pool:
+                    resumenes = list(pool.map(_resumen_perfil, *zip(*argumentos)))
+            except (OSError, NotImplementedError, BrokenExecutor) as e:
+                print(f"Sin procesos en paralelo ({e}); se calcula perfil a perfil")
+        if resumenes is None:
+            resumenes = [_resumen_perfil(*args) for args in argumentos]
+        return {"perfiles": dict(zip(claves, resumenes)), "total": combinar_resumenes(resumenes)}
+
+class ErrorHTTP(Exception):
+    """Error de una petición a la API con su código de estado"""
+
+    def __init__(self, estado, mensaje):
+        super().__init__(mensaje)
+        self.estado = estado
+
+_MOTIVOS_HTTP = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 401: "Unauthorized",
+                 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+                 500: "Internal Server Error", 502: "Bad Gateway"}
+
+_PAGINA_API = """<!DOCTYPE html>
+<html lang="es"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Control de Azúcar</title>
+<style>body{font-family:sans-serif;max-width:40em;margin:1em auto;padding:0 1em}input{width:6em}
+td{padding:2px 8px;border-bottom:1px solid #ddd}</style></head><body>
+<h2>🍎 Control de Azúcar</h2>
+<form id="f">🍽️ <input name="nombre_comida" placeholder="Comida" style="width:10em">
+📉 <input name="azucar_antes" placeholder="Antes"> 📈 <input name="azucar_despues" placeholder="Después">
+<button>Guardar</button></form><p id="m"></p><table id="t"></table>
+<script>
+// El token se pide una vez y queda en la pestaña (no en la URL, que acaba en el historial y en los registros)
+let token = sessionStorage.getItem("token") || "";
+async function api(ruta, opciones = {}) {
+  for (;;) {
+    const cabeceras = {...(opciones.headers || {}), ...(token ? {"Authorization": "Bearer " + token} : {})};
+    const r = await fetch(ruta, {...opciones, headers: cabeceras});
+    if (r.status !== 401) return r;
+    const nuevo = prompt("🔑 Token de acceso");
+    if (nuevo === null) return r;
+    token = nuevo;
+    sessionStorage.setItem("token", token);
+  }
+}
+async function cargar() {
+  const r = await api("/api/registros?limite=30&orden=desc");
+  const datos = await r.json();
+  document.getElementById("t").innerHTML = (datos.registros || []).map(x =>
+    `<tr><td>${x.fecha} ${x.hora}</td><td>${x.nombre_comida || ""}</td>` +
+    `<td>${x.azucar_antes ?? ""} → ${x.azucar_despues ?? ""}</td></tr>`).join("");
+}
+document.getElementById("f").onsubmit = async e => {
+  e.preventDefault();
+  const cuerpo = Object.fromEntries(new FormData(e.target));
+  const r = await api("/api/registros", {method: "POST", headers: {"Content-Type": "application/json"},
+                                         body: JSON.stringify(cuerpo)});
+  const datos = await r.json();
+  document.getElementById("m").textContent = r.ok ? "✅ Guardado " + (datos.alertas || []).map(a => a.mensaje).join(" ") : "❌ " + datos.error;
+  if (r.ok) { e.target.reset(); cargar(); }
+};
+cargar();
+</script></body></html>
+"""
+
+class ServidorAPI:
+    """
+    API HTTP local (asyncio, sin dependencias) sobre el mismo almacén que la interfaz.
+
+    El servidor corre en su propio hilo con su propio bucle de eventos, así que
+    no bloquea a Tk. Las lecturas (consultas, estadísticas, análisis de fotos)
+    se ejecutan en un pool de hilos y pueden atenderse a la vez; las escrituras
+    pasan por un único hilo escritor, una detrás de otra, y además toman el
+    cerrojo del almacén para no pisarse con la interfaz.
+
+    Rutas:
+        GET    /                          página mínima para el móvil
+        GET    /api/registros             ?desde=&hasta=&limite=&orden=asc|desc
+        POST   /api/registros             {"nombre_comida", "azucar_antes", "azucar_despues", "alimentos", "fecha", "hora", "foto_hash"}
+        GET    /api/registros/<id>
+        PATCH  /api/registros/<id>        (también PUT) campos a cambiar
+        DELETE /api/registros/<id>
+        GET    /api/estadisticas          ?desde=&hasta=
+        GET    /api/alertas               ?limite=
+        POST   /api/analizar              cuerpo = bytes de la imagen (la guarda y devuelve su foto_hash)
+        GET    /api/fotos/<hash>          ?tamano=miniatura|api (JPEG)
+    Si hay `token`, todas las rutas /api piden `Authorization: Bearer <token>`
+    (la página lo pide al usuario). Sin token solo debería escuchar en local.
+    """
+
+    MAXIMO_CUERPO = 20 * 1024 * 1024
+    ESPERA_INACTIVA = 30  # segundos que se mantiene abierta una conexión keep-alive sin peticiones
+
+    def __init__(self, almacen, analisis, estadisticas, host="127.0.0.1", puerto=8765, token=None, lectores=4):
+        self.almacen = almacen
+        self.analisis = analisis
+        self.estadisticas = estadisticas
+        self.host = host
+        self.puerto = puerto
+        self.token = token or None
+        self.peticiones = 0
+        self._lectores = lectores
+        self._bucle = None
+        self._servidor = None
+        self._hilo = None
+        self._rutas = [
+            ("GET", re.compile(r"/api/registros"), self._listar, False),
+            ("POST", re.compile(r"/api/registros"), self._crear, True),
+            ("GET", re.compile(r"/api/registros/(\w+)"), self._obtener, False),
+            ("PATCH", re.compile(r"/api/registros/(\w+)"), self._modificar, True),
+            ("PUT", re.compile(r"/api/registros/(\w+)"), self._modificar, True),
+            ("DELETE", re.compile(r"/api/registros/(\w+)"), self._borrar, True),
+            ("GET", re.compile(r"/api/estadisticas"), self._estadisticas, False),
+            ("GET", re.compile(r"/api/alertas"), self._alertas, False),
+            ("POST", re.compile(r"/api/analizar"), self._analizar, False),
+            ("GET", re.compile(r"/api/fotos/([0-9a-f]{64})"), self._foto, False),
+        ]
+
+    # --- Ciclo de vida -----------------------------------------------------
+
+    def iniciar(self):
+        """Arrancar el servidor en un hilo; lanza OSError si no puede escuchar en el puerto"""
+        listo = threading.Event()
+        arranque = {}
+
+        def ejecutar():
+            import asyncio
+
+            self._bucle = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._bucle)
+            try:
+                self._preparar()
+                self._servidor = self._bucle.run_until_complete(
+                    asyncio.start_server(self._atender, self.host, self.puerto))
+                self.puerto = self._servidor.sockets[0].getsockname()[1]
+            except OSError as e:
+                arranque["error"] = e
+                listo.set()
+                return
+            listo.set()
+            try:
+                self._bucle.run_forever()
+            finally:
+                self._servidor.close()
+                self._bucle.run_until_complete(self._servidor.wait_closed())
+                self._pool_lectura.shutdown(wait=False)
+                self._pool_escritura.shutdown(wait=True)
+                self._bucle.close()
+
+        self._hilo = threading.Thread(target=ejecutar, name="api-http", daemon=True)
+        self._hilo.start()
+        listo.wait()
+        if "error" in arranque:
+            raise arranque["error"]
+        if self.expuesta:
+            print(f"⚠️ La API escucha en {self.host} sin token: cualquiera en la red puede leer y modificar "
+                  f"los registros (define API_TOKEN o --token)", file=sys.stderr)
+        return self
+
+    def _preparar(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._pool_lectura = ThreadPoolExecutor(max_workers=self._lectores, thread_name_prefix="api-lector")
+        self._pool_escritura = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-escritor")
+
+    def detener(self, espera=5):
+        """Parar el servidor (las escrituras en curso terminan antes)"""
+        if self._bucle is not None and self._hilo.is_alive():
+            self._bucle.call_soon_threadsafe(self._bucle.stop)
+            self._hilo.join(espera)
+
+    def esperar(self):
+        """Bloquear hasta que el servidor se detenga"""
+        while self._hilo is not None and self._hilo.is_alive():
+            self._hilo.join(0.5)
+
+    @property
+    def direccion(self):
+        return f"http://{self.host}:{self.puerto}/"
+
+    @property
+    def expuesta(self):
+        """Si escucha fuera del propio equipo sin pedir token"""
+        import ipaddress
+
+        if self.token:
+            return False
+        try:
+            return not ipaddress.ip_address(self.host).is_loopback
+        except ValueError:
+            return self.host != "localhost"
+
+    # --- HTTP --------------------------------------------------------------
+
+    async def _atender(self, lector, escritor):
+        """Atender las peticiones de una conexión (HTTP/1.1 con keep-alive)"""
+        import asyncio
+
+        try:
+            while True:
+                linea = await asyncio.wait_for(lector.readline(), self.ESPERA_INACTIVA)
+                if not linea.strip():
+                    break
+                cabeceras = {}
+                while True:
+                    cabecera = await asyncio.wait_for(lector.readline(), self.ESPERA_INACTIVA)
+                    if cabecera in (b"\r\n", b"\n", b""):
+                        break
+                    nombre, _, valor = cabecera.decode("latin-1").partition(":")
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+
+                seguir = True
+                try:
+                    metodo, objetivo, version = linea.decode("latin-1").split()
+                    seguir = version == "HTTP/1.1" and cabeceras.get("connection", "").lower() != "close"
+                    longitud = int(cabeceras.get("content-length") or 0)
+                    if longitud > self.MAXIMO_CUERPO:
+                        seguir = False
+                        raise ErrorHTTP(413, "El cuerpo de la petición es demasiado grande")
+                    cuerpo = await lector.readexactly(longitud) if longitud else b""
+                    estado, tipo, contenido = await self._despachar(metodo, objetivo, cabeceras, cuerpo)
+                except ErrorHTTP as e:
+                    estado, tipo, contenido = e.estado, *self._json({"error": str(e)})
+                except ValueError:
+                    seguir = False
+                    estado, tipo, contenido = 400, *self._json({"error": "Petición mal formada"})
+
+                self.peticiones += 1
+                encabezado = (f"HTTP/1.1 {estado} {_MOTIVOS_HTTP.get(estado, '')}\r\n"
+                              f"Content-Type: {tipo}\r\nContent-Length: {len(contenido)}\r\n"
+                              f"Connection: {'keep-alive' if seguir else 'close'}\r\n\r\n")
+                escritor.write(encabezado.encode("latin-1") + contenido)
+                await escritor.drain()
+                if not seguir:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            escritor.close()
+
+    @staticmethod
+    def _json(datos):
+        return "application/json; charset=utf-8", json.dumps(datos, ensure_ascii=False, default=str).encode("utf-8")
+
+    def _autorizada(self, cabeceras):
+        import hmac
+
+        # En tiempo constante, para no dar pistas del token por lo que tarda en rechazarlo
+        return hmac.compare_digest(cabeceras.get("authorization", "").encode("utf-8"),
+                                   f"Bearer {self.token}".encode("utf-8"))
+
+    async def _despachar(self, metodo, objetivo, cabeceras, cuerpo):
+        """Encaminar una petición; devuelve (estado, tipo de contenido, bytes)"""
+        from urllib.parse import urlsplit, parse_qs
+
+        partes = urlsplit(objetivo)
+        if partes.path == "/" and metodo == "GET":
+            return 200, "text/html; charset=utf-8", _PAGINA_API.encode("utf-8")
+        if self.token and not self._autorizada(cabeceras):
+            raise ErrorHTTP(401, "Falta el token de acceso o no es válido")
+
+        metodos_permitidos = False
+        for metodo_ruta, patron, funcion, escribe in self._rutas:
+            coincidencia = patron.fullmatch(partes.path)
+            if not coincidencia:
+                continue
+            metodos_permitidos = True
+            if metodo_ruta != metodo:
+                continue
+            consulta = {clave: valores[-1] for clave, valores in parse_qs(partes.query).items()}
+            peticion = {"parametros": coincidencia.groups(), "consulta": consulta,
+                        "cabeceras": cabeceras, "cuerpo": cuerpo}
+            pool = self._pool_escritura if escribe else self._pool_lectura
+            estado, datos = await self._bucle.run_in_executor(pool, self._ejecutar, funcion, peticion, escribe)
+            if isinstance(datos, bytes):
+                return estado, "image/jpeg", datos
+            return (estado, *self._json(datos)) if datos is not None else (estado, "application/json", b"")
+        if metodos_permitidos:
+            raise ErrorHTTP(405, f"Método {metodo} no permitido en {partes.path}")
+        raise ErrorHTTP(404, f"No existe la ruta {partes.path}")
+
+    def _ejecutar(self, funcion, peticion, escribe):
+        """Ejecutar un manejador en el pool traduciendo los errores a códigos HTTP"""
+        try:
+            if not escribe:
+                # Las lecturas ven lo que hayan guardado otros procesos (las escrituras ya lo fusionan)
+                self.almacen.recargar_si_cambio()
+            return funcion(peticion)
+        except ErrorHTTP as e:
+            return e.estado, {"error": str(e)}
+        except ErrorValidacion as e:
+            return 400, {"error": str(e)}
+        except Exception as e:
+            print(f"Error en la API: {e}")
+            return 500, {"error": str(e)}
+
+    @staticmethod
+    def _cuerpo_json(peticion):
+        try:
+            datos = json.loads(peticion["cuerpo"] or b"{}")
+        except ValueError:
+            raise ErrorHTTP(400, "El cuerpo no es JSON válido")
+        if not isinstance(datos, dict):
+            raise ErrorHTTP(400, "El cuerpo debe ser un objeto JSON")
+        return datos
+
+    @staticmethod
+    def _validar_campos(datos):
+        """Tipos de los campos de texto de un registro recibido (lanza ErrorValidacion)"""
+        for campo in ("nombre_comida", "fecha", "hora", "foto_hash"):
+            if datos.get(campo) is not None and not isinstance(datos[campo], str):
+                raise ErrorValidacion(f"'{campo}' debe ser un texto")
+        alimentos = datos.get("alimentos")
+        if alimentos is not None and (not isinstance(alimentos, list) or
+                                      not all(isinstance(a, str) for a in alimentos)):
+            raise ErrorValidacion("'alimentos' debe ser una lista de textos")
+
+    @staticmethod
+    def _fecha(consulta, clave):
+        valor = consulta.get(clave)
+        if valor is None:
+            return None
+        try:
+            datetime.strptime(valor, "%Y-%m-%d")
+        except ValueError:
+            raise ErrorHTTP(400, f"'{clave}' debe tener el formato AAAA-MM-DD")
+        return valor
+
+    # --- Manejadores (se ejecutan en los pools de hilos) --------------------
+
+    def _listar(self, peticion):
+        consulta = peticion["consulta"]
+        registros = self.almacen.rango(self._fecha(consulta, "desde"), self._fecha(consulta, "hasta"))
+        if consulta.get("orden") == "desc":
+            registros.reverse()
+        total = len(registros)
+        if consulta.get("limite"):
+            try:
+                registros = registros[:max(int(consulta["limite"]), 0)]
+            except ValueError:
+                raise ErrorHTTP(400, "'limite' debe ser un número entero")
+        return 200, {"total": total, "registros": registros}
+
+    def _obtener(self, peticion):
+        registro = self.almacen.buscar(peticion["parametros"][0])
+        if registro is None:
+            raise ErrorHTTP(404, "Registro no encontrado")
+        return 200, registro
+
+    def _crear(self, peticion):
+        datos = self._cuerpo_json(peticion)
+        self._validar_campos(datos)
+        metadata = None
+        if datos.get("fecha") or datos.get("hora"):
+            ahora = datetime.now()
+            try:
+                momento = datetime.strptime(f"{datos.get('fecha') or ahora.strftime('%Y-%m-%d')} "
+                                            f"{datos.get('hora') or ahora.strftime('%H:%M')}", "%Y-%m-%d %H:%M")
+            except ValueError:
+                raise ErrorValidacion("La fecha debe ser AAAA-MM-DD y la hora HH:MM")
+            metadata = {"fecha": momento.strftime("%Y-%m-%d"), "hora": momento.strftime("%H:%M"),
+                        "datetime": momento, "fuente": "API"}
+        nombre = datos.get("nombre_comida") or ""
+        if not nombre.strip():
+            franja = self.almacen.determinar_comida_por_hora((metadata or {}).get("hora") or datetime.now().strftime("%H:%M"))
+            nombre = franja.capitalize() if franja else "Lectura"
+        foto_hash = datos.get("foto_hash")
+        if foto_hash and not self.almacen.fotos.existe(foto_hash):
+            raise ErrorValidacion("foto_hash no corresponde a ninguna foto (súbela antes con /api/analizar)")
+        registro = self.almacen.crear_registro(nombre, datos.get("alimentos") or [], datos.get("azucar_antes"),
+                                               datos.get("azucar_despues"), metadata, requiere_alimentos=False,
+                                               foto_hash=foto_hash or None)
+        alertas = self.almacen.agregar(registro)
+        return 201, {"registro": registro, "alertas": alertas}
+
+    def _modificar(self, peticion):
+        datos = self._cuerpo_json(peticion)
+        self._validar_campos(datos)
+        try:
+            registro = self.almacen.actualizar(peticion["parametros"][0], datos)
+        except KeyError:
+            raise ErrorHTTP(404, "Registro no encontrado")
+        return 200, registro
+
+    def _borrar(self, peticion):
+        registro = self.almacen.buscar(peticion["parametros"][0])
+        if registro is None:
+            raise ErrorHTTP(404, "Registro no encontrado")
+        self.almacen.borrar([registro])
+        return 204, None
+
+    def _estadisticas(self, peticion):
+        # Sin el cerrojo del almacén: las analíticas trabajan sobre una copia de la lista de registros
+        consulta = peticion["consulta"]
+        return 200, self.estadisticas.resumen(self._fecha(consulta, "desde"), self._fecha(consulta, "hasta"))
+
+    def _alertas(self, peticion):
+        try:
+            limite = int(peticion["consulta"].get("limite", 100))
+        except ValueError:
+            raise ErrorHTTP(400, "'limite' debe ser un número entero")
+        return 200, {"alertas": self.estadisticas.alertas(limite)}
+
+    def _analizar(self, peticion):
+        import tempfile
+
+        if not peticion["cuerpo"]:
+            raise ErrorHTTP(400, "Envía la imagen en el cuerpo de la petición")
+        tipo = peticion["cabeceras"].get("content-type", "image/jpeg").split(";")[0].strip()
+        extension = {"image/png": ".png", "image/gif": ".gif", "image/bmp": ".bmp"}.get(tipo, ".jpg")
+        descriptor, ruta = tempfile.mkstemp(suffix=extension, prefix="api_foto_")
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                f.write(peticion["cuerpo"])
+            metadatos = self.analisis.metadatos(ruta)
+            try:
+                foto_hash = self.almacen.fotos.importar(ruta)
+            except OSError:
+                raise ErrorHTTP(400, "El cuerpo no es una imagen válida")
+            try:
+                alimentos = self.analisis.identificar_alimentos(self.almacen.fotos.ruta_api(foto_hash))
+            except Exception as e:
+                raise ErrorHTTP(502, f"No se pudieron identificar los alimentos: {e}")
+        finally:
+            os.remove(ruta)
+        return 200, {
+            "foto_hash": foto_hash,
+            "alimentos": alimentos,
+            "canonicos": [canonico for _, canonico in self.analisis.canonicos(alimentos)],
+            "fecha": metadatos["fecha"], "hora": metadatos["hora"], "fuente_fecha": metadatos["fuente"],
+        }
+
+    def _foto(self, peticion):
+        foto_hash, = peticion["parametros"]
+        tamano = peticion["consulta"].get("tamano", "miniatura")
+        if tamano not in ("miniatura", "api"):
+            raise ErrorHTTP(400, "tamano debe ser miniatura o api")
+        fotos = self.almacen.fotos
+        ruta = fotos.ruta_miniatura(foto_hash) if tamano == "miniatura" else fotos.ruta_api(foto_hash)
+        if ruta is None:
+            raise ErrorHTTP(404, "No existe esa foto")
+        with open(ruta, 'rb') as f:
+            return 200, f.read()
+
+def registro_rotativo(nombre, ruta, max_bytes, copias=3):
+    """Logger que escribe cada mensaje como una línea de `ruta`, rotando a `ruta.1` … `ruta.<copias>`"""
+    import logging
+    from logging.handlers import RotatingFileHandler
+
+    registro = logging.getLogger(nombre)
+    registro.setLevel(logging.INFO)
+    registro.propagate = False
+    for manejador in list(registro.handlers):
+        registro.removeHandler(manejador)
+        manejador.close()
+    manejador = RotatingFileHandler(ruta, maxBytes=max_bytes, backupCount=copias, encoding="utf-8", delay=True)
+    manejador.setFormatter(logging.Formatter("%(message)s"))
+    registro.addHandler(manejador)
+    return registro
+
+class Perfilador:
+    """
+    Medición opcional de las acciones de la interfaz (se activa con PERFILADO).
+
+    Cada invocación envuelta con `envolver` registra su tiempo de reloj y,
+    según los modos, las funciones más costosas (cProfile) y la memoria
+    asignada (tracemalloc). Las entradas se guardan como JSON, una por línea,
+    en un archivo que rota al superar el tamaño máximo, y las últimas quedan
+    en memoria para el diálogo de rendimiento. Si una acción llama a otra
+    envuelta, cProfile y tracemalloc solo se aplican a la exterior.
+
+        PERFILADO=1                     solo tiempos
+        PERFILADO=cprofile,tracemalloc  tiempos más perfil y memoria
+        PERFILADO_MAX_KB=1024           tamaño antes de rotar (3 copias)
+    """
+
+    MODOS = ("tiempo", "cprofile", "tracemalloc")
+
+    def __init__(self, ruta, modos=("tiempo",), max_bytes=1024 * 1024, copias=3, recientes=200, funciones=15):
+        self.ruta = ruta
+        self.modos = {"tiempo"} | set(modos)
+        self.recientes = collections.deque(maxlen=recientes)
+        self.funciones = funciones
+        self._registro = registro_rotativo("control_azucar.rendimiento", ruta, max_bytes, copias)
+        self._profundidad = 0
+
+    @classmethod
+    def desde_entorno(cls, base):
+        """Perfilador configurado con PERFILADO (None si no está activado)"""
+        valor = os.getenv('PERFILADO', '').strip().lower()
+        if valor in ('', '0', 'no', 'false'):
+            return None
+        modos = {modo.strip() for modo in valor.split(",") if modo.strip() in cls.MODOS}
+        return cls(base + "_rendimiento.jsonl", modos,
+                   max_bytes=int(os.getenv('PERFILADO_MAX_KB', '1024')) * 1024)
+
+    def envolver(self, nombre, funcion):
+        """Devolver `funcion` envuelta para medir cada llamada bajo `nombre`"""
+        import functools
+
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            return self.medir(nombre, funcion, *args, **kwargs)
+        return envoltura
+
+    def medir(self, nombre, funcion, *args, **kwargs):
+        """Ejecutar `funcion` y registrar lo que ha costado"""
+        exterior = self._profundidad == 0
+        perfil = None
+        if exterior and "cprofile" in self.modos:
+            import cProfile
+            perfil = cProfile.Profile()
+        memoria = False
+        if exterior and "tracemalloc" in self.modos:
+            import tracemalloc
+            memoria = not tracemalloc.is_tracing()
+            if memoria:
+                tracemalloc.start()
+
+        self._profundidad += 1
+        error = None
+        inicio = time.perf_counter()
+        try:
+            if perfil is not None:
+                return perfil.runcall(funcion, *args, **kwargs)
+            return funcion(*args, **kwargs)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            segundos = time.perf_counter() - inicio
+            self._profundidad -= 1
+            entrada = {"momento": ahora_iso(), "accion": nombre, "segundos": round(segundos, 4)}
+            if not exterior:
+                entrada["anidada"] = True
+            if error:
+                entrada["error"] = error
+            if perfil is not None:
+                entrada["cprofile"] = self._resumen_cprofile(perfil)
+            if memoria:
+                entrada["memoria"] = self._resumen_memoria()
+            self.recientes.append(entrada)
+            try:
+                self._registro.info(json.dumps(entrada, ensure_ascii=False))
+            except Exception as e:
+                print(f"Error al escribir la traza de rendimiento: {e}")
+
+    def _resumen_cprofile(self, perfil):
+        """Funciones con más tiempo acumulado"""
+        import pstats
+
+        estadisticas = pstats.Stats(perfil)
+        estadisticas.sort_stats("cumulative")
+        funciones = []
+        for clave in estadisticas.fcn_list[:self.funciones]:
+            _, llamadas, propio, acumulado, _ = estadisticas.stats[clave]
+            archivo, linea, nombre = clave
+            funciones.append({"funcion": f"{os.path.basename(archivo)}:{linea}({nombre})", "llamadas": llamadas,
+                              "propio": round(propio, 4), "acumulado": round(acumulado, 4)})
+        return funciones
+
+    @staticmethod
+    def _resumen_memoria(lineas=10):
+        """Pico y memoria retenida de la acción, con las líneas que más retienen; detiene tracemalloc"""
+        import tracemalloc
+
+        actual, pico = tracemalloc.get_traced_memory()
+        instantanea = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        return {
+            "pico_kb": pico // 1024,
+            "retenida_kb": actual // 1024,
+            "lineas": [{"linea": str(e.traceback[0]), "kb": e.size // 1024}
+                       for e in instantanea.statistics("lineno")[:lineas]],
+        }
+
+    def mas_lentas(self, cantidad=30):
+        """Las invocaciones recientes más lentas"""
+        return heapq.nlargest(cantidad, self.recientes, key=lambda e: e["segundos"])
+
+class VigilanteBloqueos:
+    """
+    Detector de bloqueos del bucle principal de Tk (se activa con VIGILANTE_BLOQUEOS).
 
-    def guardar_datos(self):
-        """Guardar datos en archivo JSON"""
-        with open(self.datos_file, 'w', encoding='utf-8') as f:
-            json.dump(self.datos, f, ensure_ascii=False, indent=2)
-
-    # NOTA: Esta función ya no se usa, ahora se usan nombres personalizados
-    # def determinar_comida_por_hora(self, hora_str):
-    #     """Determinar tipo de comida según la hora (OBSOLETO)"""
-    #     hora = datetime.strptime(hora_str, "%H:%M").time()
-    #     franjas = self.datos["configuracion"]["franjas_horarias"]
-    #
-    #     for comida, franja in franjas.items():
-    #         inicio = datetime.strptime(franja["inicio"], "%H:%M").time()
-    #         fin = datetime.strptime(franja["fin"], "%H:%M").time()
-    #
-    #         if inicio <= hora <= fin:
-    #             return comida
-    #
-    #     return "otro"
+    Un latido con `after()` anota la hora cada `intervalo` segundos y un hilo
+    vigilante comprueba que siga llegando. Si el latido se retrasa más de
+    `umbral`, el vigilante captura la pila del hilo de Tk en ese momento (lo
+    que lo está bloqueando); cuando el latido vuelve se registra la duración
+    total del bloqueo en el histograma y en `<base>_bloqueos.jsonl` (rotativo).
+
+        VIGILANTE_BLOQUEOS=1     umbral de 250 ms
+        VIGILANTE_BLOQUEOS=500   umbral en milisegundos
+    """
+
+    LIMITES_HISTOGRAMA = (0.25, 0.5, 1, 2, 5, 10, 30)  # segundos; el último tramo es "más de 30 s"
+
+    def __init__(self, root, ruta, umbral=0.25, intervalo=0.05, max_bytes=1024 * 1024, copias=3, recientes=100):
+        self.root = root
+        self.ruta = ruta
+        self.umbral = umbral
+        self.intervalo = intervalo
+        self.histograma = [0] * (len(self.LIMITES_HISTOGRAMA) + 1)
+        self.recientes = collections.deque(maxlen=recientes)
+        self.tiempo_bloqueado = 0.0
+        self._registro = registro_rotativo("control_azucar.bloqueos", ruta, max_bytes, copias)
+        self._hilo_tk = threading.get_ident()
+        self._cerrojo = threading.Lock()
+        self._parar = threading.Event()
+        self._ultimo_latido = time.perf_counter()
+        self._pila = None  # Pila capturada durante el bloqueo en curso
+
+    @classmethod
+    def desde_entorno(cls, root, base):
+        """Vigilante configurado con VIGILANTE_BLOQUEOS (None si no está activado)"""
+        valor = os.getenv('VIGILANTE_BLOQUEOS', '').strip().lower()
+        if valor in ('', '0', 'no', 'false'):
+            return None
+        umbral = 0.25 if valor in ('1', 'si', 'sí', 'true') else float(valor) / 1000
+        return cls(root, base + "_bloqueos.jsonl", umbral=umbral)
+
+    def iniciar(self):
+        """Arrancar el latido y el hilo vigilante (llamar desde el hilo de Tk)"""
+        self._hilo_tk = threading.get_ident()
+        self._ultimo_latido = time.perf_counter()
+        self.root.after(int(self.intervalo * 1000), self._latido)
+        threading.Thread(target=self._vigilar, name="vigilante-bloqueos", daemon=True).start()
+        return self
+
+    def detener(self):
+        self._parar.set()
+
+    def _latido(self):
+        ahora = time.perf_counter()
+        with self._cerrojo:
+            retraso = ahora - self._ultimo_latido - self.intervalo
+            pila, self._pila = self._pila, None
+            self._ultimo_latido = ahora
+        if retraso >= self.umbral:
+            self._registrar(retraso, pila)
+        if not self._parar.is_set():
+            self.root.after(int(self.intervalo * 1000), self._latido)
+
+    def _vigilar(self):
+        import traceback
+
+        while not self._parar.wait(self.intervalo):
+            with self._cerrojo:
+                retraso = time.perf_counter() - self._ultimo_latido - self.intervalo
+                if retraso < self.umbral or self._pila is not None:
+                    continue
+                marco = sys._current_frames().get(self._hilo_tk)
+                self._pila = traceback.format_stack(marco) if marco is not None else []
+
+    def _registrar(self, segundos, pila):
+        tramo = bisect.bisect_left(self.LIMITES_HISTOGRAMA, segundos)
+        self.histograma[tramo] += 1
+        self.tiempo_bloqueado += segundos
+        entrada = {"momento": ahora_iso(), "segundos": round(segundos, 3),
+                   "pila": [linea.rstrip() for linea in (pila or [])[-20:]]}
+        self.recientes.append(entrada)
+        try:
+            self._registro.info(json.dumps(entrada, ensure_ascii=False))
+        except Exception as e:
+            print(f"Error al escribir el registro de bloqueos: {e}")
+
+    def tramos(self):
+        """[(etiqueta, cuenta)] del histograma de duraciones"""
+        etiquetas = []
+        anterior = self.umbral
+        for limite in self.LIMITES_HISTOGRAMA:
+            if limite > anterior:
+                etiquetas.append(f"{anterior:g}–{limite:g} s")
+                anterior = limite
+            else:
+                etiquetas.append(f"≤ {limite:g} s")
+        etiquetas.append(f"> {self.LIMITES_HISTOGRAMA[-1]:g} s")
+        return list(zip(etiquetas, self.histograma))
+
+    def informe(self):
+        """Texto con el histograma de bloqueos"""
+        total = sum(self.histograma)
+        lineas = [f"🧊 Bloqueos del bucle principal (> {self.umbral * 1000:.0f} ms): {total}, "
+                  f"{self.tiempo_bloqueado:.1f} s en total"]
+        maximo = max(self.histograma) or 1
+        for etiqueta, cuenta in self.tramos():
+            if cuenta:
+                lineas.append(f"  {etiqueta:>12} {cuenta:6}  {'█' * max(1, round(cuenta / maximo * 30))}")
+        return "\n".join(lineas)
+
+class ControlAzucarApp:
+    INTERVALO_VIGILANCIA = 2000  # ms entre comprobaciones del archivo de datos
+
+    # Acciones que mide el perfilador (además de todos los `exportar_*`)
+    ACCIONES_PERFILADAS = (
+        "seleccionar_foto", "analizar_foto", "guardar_registro", "mostrar_historial", "borrar_checkboxes",
+        "guardar_horarios", "mostrar_estadisticas", "mostrar_tendencias", "importar_cgm",
+        "deshacer", "rehacer", "mostrar_historial_en_fecha",
+    )
+    def __init__(self, root):
+        self.root = root
+        self.root.title(os.getenv('APP_NAME', 'Control de Azúcar y Alimentación'))
+        self.root.geometry("850x700")
+
+        # Núcleo: datos y servicios (la ventana solo los presenta)
+        inicio = time.perf_counter()
+        self.perfiles = GestorPerfiles(os.getenv('DATA_FILE', 'control_alimentacion.json'))
+        self.almacen = self.perfiles.activar(self.perfiles.activo)
+        TIEMPOS_ARRANQUE["cargar datos"] = time.perf_counter() - inicio
+        if self.perfiles.activo != GestorPerfiles.PRINCIPAL:
+            self.root.title(f"{self.root.title()} — {self.perfiles.nombre(self.perfiles.activo)}")
+        self.analisis = ServicioAnalisis(self.almacen)
+        self.estadisticas = ServicioEstadisticas(self.almacen)
+        self.exportacion = ServicioExportacion(self.almacen)
+        self._exportaciones_after = None
+        self.servidor_api = None
+
+        # Perfilado opcional: se envuelven los métodos antes de que los botones los referencien
+        self.perfilador = Perfilador.desde_entorno(base_datos(self.perfiles.datos_file))
+        if self.perfilador:
+            self.instrumentar()
+            print(f"📈 Perfilado activo ({', '.join(sorted(self.perfilador.modos))}): {self.perfilador.ruta}",
+                  file=sys.stderr)
+        self.vigilante = VigilanteBloqueos.desde_entorno(self.root, base_datos(self.perfiles.datos_file))
+
+        inicio = time.perf_counter()
+        self.crear_interfaz()
+        TIEMPOS_ARRANQUE["crear interfaz"] = time.perf_counter() - inicio
+
+        if os.getenv('API_PUERTO'):
+            self.iniciar_api()
+
+        if self.vigilante:
+            self.vigilante.iniciar()
+            print(f"🧊 Vigilante de bloqueos activo (> {self.vigilante.umbral * 1000:.0f} ms): {self.vigilante.ruta}",
+                  file=sys.stderr)
+
+        # Cambios guardados por otra instancia (otro .exe, un script, la línea de comandos)
+        self.sincronizacion_label = ttk.Label(self.root, text="", foreground="gray", font=("Arial", 9))
+        self.root.after(self.INTERVALO_VIGILANCIA, self.vigilar_archivo)
 
     def crear_interfaz(self):
         """Crear la interfaz gráfica"""
@@ -265,10 +4497,22 @@ class ControlAzucarApp:
         # Título
         titulo = ttk.Label(main_frame, text="🍎 Control de Azúcar y Alimentación con IA", 
                           font=("Arial", 18, "bold"))
-        titulo.pack(pady=(0, 25))
-
-        # Estado de la API
-        if self.ai_client:
+        titulo.pack(pady=(0, 10))
+
+        # Selector de perfil
+        perfil_frame = ttk.Frame(main_frame)
+        perfil_frame.pack(pady=(0, 15))
+        ttk.Label(perfil_frame, text="👤 Perfil:").pack(side=tk.LEFT)
+        self.perfil_var = tk.StringVar(value=self.perfiles.nombre(self.perfiles.activo))
+        self.perfil_combo = ttk.Combobox(perfil_frame, textvariable=self.perfil_var, state="readonly", width=20)
+        self.perfil_combo.pack(side=tk.LEFT, padx=(10, 5))
+        self.perfil_combo.bind("<<ComboboxSelected>>", lambda e: self.cambiar_perfil())
+        self.actualizar_lista_perfiles()
+        ttk.Button(perfil_frame, text="➕ Nuevo", command=self.crear_perfil).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(perfil_frame, text="👥 Comparar", command=self.mostrar_perfiles).pack(side=tk.LEFT)
+
+        # Estado de la API (solo se comprueba la configuración; el cliente se crea al analizar)
+        if self.analisis.error_configuracion is None:
             estado_api = ttk.Label(main_frame, text="✅ Conectado con Abacus.AI", 
                                  foreground="green", font=("Arial", 10))
         else:
@@ -286,8 +4530,10 @@ class ControlAzucarApp:
 
         ttk.Label(nombre_comida_frame, text="🍽️ Nombre de la comida:").pack(side=tk.LEFT)
         self.nombre_comida_var = tk.StringVar()
-        nombre_comida_entry = ttk.Entry(nombre_comida_frame, textvariable=self.nombre_comida_var, width=25)
-        nombre_comida_entry.pack(side=tk.LEFT, padx=(10, 5))
+        self.nombre_comida_entry = ttk.Combobox(nombre_comida_frame, textvariable=self.nombre_comida_var, width=25,
+                                                postcommand=self.actualizar_completado_comida)
+        self.nombre_comida_entry.pack(side=tk.LEFT, padx=(10, 5))
+        self.nombre_comida_entry.bind("<KeyRelease>", self.autocompletar_nombre_comida)
         
         # Botón para sugerencias
         ttk.Button(nombre_comida_frame, text="💡", width=3,
@@ -364,6 +4610,32 @@ class ControlAzucarApp:
         botones_frame.pack(fill=tk.X, pady=(10, 0), anchor="e")
         ttk.Button(botones_frame, text="Guardar Registro", command=self.guardar_registro).pack(side=tk.RIGHT, padx=(5, 0))
         ttk.Button(botones_frame, text="Mostrar Historial", command=self.mostrar_historial).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(botones_frame, text="Estadísticas", command=self.mostrar_estadisticas).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(botones_frame, text="Tendencias", command=self.mostrar_tendencias).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(botones_frame, text="Alimentos", command=self.mostrar_impacto_alimentos).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(botones_frame, text="Horarios", command=self.configurar_horarios).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(botones_frame, text="Alertas", command=self.mostrar_alertas).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(botones_frame, text="Importar CGM", command=self.importar_cgm).pack(side=tk.RIGHT, padx=(5, 0))
+        if self.perfilador or self.vigilante:
+            ttk.Button(botones_frame, text="Rendimiento", command=self.mostrar_rendimiento).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(botones_frame, text="↩️ Deshacer", command=self.deshacer).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(botones_frame, text="↪️ Rehacer", command=self.rehacer).pack(side=tk.LEFT, padx=(0, 5))
+        self.root.bind("<Control-z>", lambda e: self.deshacer())
+        self.root.bind("<Control-y>", lambda e: self.rehacer())
+
+        # Panel de exportaciones en segundo plano (solo visible mientras hay trabajos)
+        self.exportacion_frame = ttk.LabelFrame(main_frame, text="📤 Exportaciones", padding="10")
+        self.exportacion_label = ttk.Label(self.exportacion_frame, text="", font=("Arial", 9))
+        self.exportacion_label.pack(fill=tk.X)
+        progreso_frame = ttk.Frame(self.exportacion_frame)
+        progreso_frame.pack(fill=tk.X, pady=(5, 0))
+        self.exportacion_progress = ttk.Progressbar(progreso_frame, mode='determinate')
+        self.exportacion_progress.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        ttk.Button(progreso_frame, text="⏹️ Cancelar",
+                  command=self.cancelar_exportacion_actual).pack(side=tk.LEFT, padx=(10, 0))
+
+        # Estado de la API HTTP (solo visible si está activa)
+        self.api_label = ttk.Label(main_frame, text="", foreground="gray", font=("Arial", 9))
 
         # Configurar scroll
         canvas.pack(side="left", fill="both", expand=True)
@@ -371,6 +4643,7 @@ class ControlAzucarApp:
 
         # Variables para la foto
         self.foto_path = None
+        self.foto_hash = None
         self.alimentos_detectados = []
 
     def seleccionar_foto(self):
@@ -387,7 +4660,7 @@ class ControlAzucarApp:
 
         if self.foto_path:
             # Extraer fecha y hora de los metadatos EXIF
-            self.metadata_foto = self.extraer_fecha_hora_exif(self.foto_path)
+            self.metadata_foto = self.analisis.metadatos(self.foto_path)
             
             # Mostrar información de los metadatos
             if hasattr(self, 'info_metadata_label'):
@@ -400,23 +4673,32 @@ class ControlAzucarApp:
                 
                 self.info_metadata_label.configure(text=texto_info, foreground=color_info)
                 self.info_metadata_label.pack(pady=(5, 0))
+
+            # Proponer la comida de la franja horaria de la foto si no hay nombre
+            if not self.nombre_comida_var.get().strip():
+                franja = self.almacen.determinar_comida_por_hora(self.metadata_foto['hora'])
+                if franja:
+                    self.nombre_comida_var.set(franja.capitalize())
             
-            # Mostrar miniatura de la imagen
+            # Guardar la foto en el almacén (una sola vez) y mostrar su miniatura
             try:
-                imagen = Image.open(self.foto_path)
-                imagen.thumbnail((300, 300))
-                photo = ImageTk.PhotoImage(imagen)
+                from PIL import Image, ImageTk
+
+                self.foto_hash = self.almacen.fotos.importar(self.foto_path)
+                with Image.open(self.almacen.fotos.ruta_miniatura(self.foto_hash)) as imagen:
+                    photo = ImageTk.PhotoImage(imagen)
 
                 self.imagen_label.configure(image=photo, text="")
                 self.imagen_label.image = photo  # Mantener referencia
 
                 # Habilitar botón de análisis
-                if self.ai_client:
+                if self.analisis.error_configuracion is None:
                     self.btn_analizar.configure(state="normal")
 
             except Exception as e:
                 messagebox.showerror("Error", f"No se pudo cargar la imagen: {str(e)}")
                 self.metadata_foto = None
+                self.foto_hash = None
 
     def analizar_foto(self):
         """Analizar foto con IA de Abacus.AI"""
@@ -424,8 +4706,10 @@ class ControlAzucarApp:
             messagebox.showwarning("Advertencia", "Por favor selecciona una foto primero")
             return
 
-        if not self.ai_client:
-            messagebox.showerror("Error", "Cliente de Abacus.AI no disponible")
+        if not self.analisis.cliente:
+            messagebox.showerror("Error de Configuración",
+                               f"Error al inicializar Abacus.AI: {self.analisis.error_configuracion}\n\n"
+                               "Verifica tu archivo .env")
             return
 
         # Mostrar progress bar
@@ -434,13 +4718,18 @@ class ControlAzucarApp:
         self.root.update()
 
         try:
-            # Llamar a la API de Abacus.AI
-            self.alimentos_detectados = self.ai_client.identificar_alimentos(self.foto_path)
+            # Llamar a la API de Abacus.AI con la versión reducida de la foto
+            foto_hash = getattr(self, 'foto_hash', None)
+            ruta = (self.almacen.fotos.ruta_api(foto_hash) if foto_hash else None) or self.foto_path
+            self.alimentos_detectados = self.analisis.identificar_alimentos(ruta)
 
             # Mostrar alimentos en la lista
             self.alimentos_listbox.delete(0, tk.END)
-            for i, alimento in enumerate(self.alimentos_detectados, 1):
-                self.alimentos_listbox.insert(tk.END, f"{i}. {alimento}")
+            for i, (alimento, canonico) in enumerate(self.analisis.canonicos(self.alimentos_detectados), 1):
+                if canonico:
+                    self.alimentos_listbox.insert(tk.END, f"{i}. {alimento}  → {canonico}")
+                else:
+                    self.alimentos_listbox.insert(tk.END, f"{i}. {alimento}")
 
             messagebox.showinfo("✅ Análisis Completado", 
                                f"Se detectaron {len(self.alimentos_detectados)} alimentos")
@@ -457,72 +4746,24 @@ class ControlAzucarApp:
 
     def guardar_registro(self):
         """Guardar registro completo"""
-        nombre_comida = self.nombre_comida_var.get().strip()
-        if not nombre_comida:
-            messagebox.showwarning("⚠️ Advertencia", "Por favor ingresa el nombre de la comida")
-            return
-
-        azucar_antes = self.azucar_antes_var.get().strip()
-        azucar_despues = self.azucar_despues_var.get().strip()
-        
-        # Validar que al menos uno de los campos tenga valor
-        if not azucar_antes and not azucar_despues:
-            messagebox.showwarning("⚠️ Advertencia", "Por favor ingresa al menos un nivel de azúcar (antes o después)")
-            return
-
-        if not self.alimentos_detectados:
-            messagebox.showwarning("⚠️ Advertencia", "Por favor analiza una foto primero")
-            return
-
-        # Validar y convertir valores de azúcar
-        azucar_antes_valor = None
-        azucar_despues_valor = None
-        
         try:
-            if azucar_antes:
-                azucar_antes_valor = float(azucar_antes)
-                if azucar_antes_valor < 0 or azucar_antes_valor > 1000:
-                    messagebox.showwarning("⚠️ Advertencia", "El nivel de azúcar antes debe estar entre 0 y 1000 mg/dL")
-                    return
-            
-            if azucar_despues:
-                azucar_despues_valor = float(azucar_despues)
-                if azucar_despues_valor < 0 or azucar_despues_valor > 1000:
-                    messagebox.showwarning("⚠️ Advertencia", "El nivel de azúcar después debe estar entre 0 y 1000 mg/dL")
-                    return
-        except ValueError:
-            messagebox.showerror("❌ Error", "Los niveles de azúcar deben ser números válidos")
+            registro = self.almacen.crear_registro(
+                self.nombre_comida_var.get(),
+                self.alimentos_detectados,
+                self.azucar_antes_var.get(),
+                self.azucar_despues_var.get(),
+                metadata=getattr(self, 'metadata_foto', None),
+                foto_path=getattr(self, 'foto_path', None),
+                foto_hash=getattr(self, 'foto_hash', None)
+            )
+        except ErrorValidacion as e:
+            messagebox.showwarning("⚠️ Advertencia", str(e))
             return
 
-        # Crear registro usando metadatos de la foto si están disponibles
-        if hasattr(self, 'metadata_foto') and self.metadata_foto:
-            # Usar fecha/hora de los metadatos EXIF
-            fecha_registro = self.metadata_foto['fecha']
-            hora_registro = self.metadata_foto['hora']
-            timestamp_registro = self.metadata_foto['datetime'].isoformat()
-            fuente_fecha = self.metadata_foto['fuente']
-        else:
-            # Usar fecha/hora actual como fallback
-            ahora = datetime.now()
-            fecha_registro = ahora.strftime("%Y-%m-%d")
-            hora_registro = ahora.strftime("%H:%M")
-            timestamp_registro = ahora.isoformat()
-            fuente_fecha = 'Actual'
-
-        registro = {
-            "fecha": fecha_registro,
-            "hora": hora_registro,
-            "nombre_comida": nombre_comida,
-            "azucar_antes": azucar_antes_valor,
-            "azucar_despues": azucar_despues_valor,
-            "alimentos": self.alimentos_detectados.copy(),
-            "foto_path": self.foto_path if hasattr(self, 'foto_path') else None,
-            "timestamp": timestamp_registro,
-            "fuente_fecha": fuente_fecha  # Nuevo campo para indicar si viene de EXIF o es actual
-        }
-
-        self.datos["registros"].append(registro)
-        self.guardar_datos()
+        alertas = self.almacen.agregar(registro)
+        nombre_comida = registro["nombre_comida"]
+        azucar_antes_valor, azucar_despues_valor = registro["azucar_antes"], registro["azucar_despues"]
+        fecha_registro, hora_registro, fuente_fecha = registro["fecha"], registro["hora"], registro["fuente_fecha"]
 
         # Crear mensaje de éxito con información de azúcar
         mensaje_azucar = ""
@@ -547,6 +4788,10 @@ class ControlAzucarApp:
                            f"🍽️ Alimentos detectados: {len(self.alimentos_detectados)}\n"
                            f"{mensaje_fecha}")
 
+        if alertas:
+            messagebox.showwarning("🔔 Alertas de glucosa",
+                                   "\n".join(alerta["mensaje"] for alerta in alertas))
+
         # Limpiar formulario
         self.limpiar_formulario()
 
@@ -583,19 +4828,13 @@ class ControlAzucarApp:
                       command=lambda s=sugerencia: self.seleccionar_sugerencia(s, sugerencias_window)).pack(side=tk.LEFT, padx=(0, 5))
 
         # Frame para historial
-        historial_frame = ttk.LabelFrame(main_frame, text="Tu Historial Reciente", padding="10")
+        historial_frame = ttk.LabelFrame(main_frame, text="Tus Comidas Frecuentes y Recientes", padding="10")
         historial_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 15))
 
-        # Obtener nombres únicos del historial
-        nombres_historial = set()
-        for registro in self.datos["registros"]:
-            nombre = registro.get("nombre_comida")
-            if nombre:
-                nombres_historial.add(nombre)
+        # Los 10 nombres con mejor puntuación de frecuencia y recencia
+        historial_lista = self.almacen.indice_sugerencias.top(10)
 
-        if nombres_historial:
-            historial_lista = sorted(list(nombres_historial))[-10:]  # Últimos 10 únicos
-            
+        if historial_lista:
             canvas = tk.Canvas(historial_frame, height=150)
             scrollbar = ttk.Scrollbar(historial_frame, orient="vertical", command=canvas.yview)
             scrollable_frame = ttk.Frame(canvas)
@@ -622,6 +4861,27 @@ class ControlAzucarApp:
         ttk.Button(main_frame, text="❌ Cerrar", 
                   command=sugerencias_window.destroy).pack(pady=(10, 0))
 
+    def actualizar_completado_comida(self):
+        """Rellenar el desplegable con los nombres que empiezan por lo escrito"""
+        self.nombre_comida_entry.configure(values=self.almacen.indice_sugerencias.completar(self.nombre_comida_var.get()))
+
+    def autocompletar_nombre_comida(self, event):
+        """Completar en línea el nombre de la comida con la mejor sugerencia"""
+        if event.keysym in ("BackSpace", "Delete", "Left", "Right", "Up", "Down", "Home", "End",
+                            "Return", "Escape", "Tab", "Shift_L", "Shift_R"):
+            return
+        entry = self.nombre_comida_entry
+        escrito = entry.get()[:entry.index(tk.INSERT)]
+        if not escrito.strip():
+            return
+        sugerencias = self.almacen.indice_sugerencias.completar(escrito, 1)
+        if not sugerencias or len(sugerencias[0]) <= len(escrito):
+            return
+        # Mantener lo escrito y dejar seleccionado el resto sugerido
+        self.nombre_comida_var.set(escrito + sugerencias[0][len(escrito):])
+        entry.icursor(len(escrito))
+        entry.selection_range(len(escrito), tk.END)
+
     def seleccionar_sugerencia(self, sugerencia, window):
         """Seleccionar una sugerencia y cerrar ventana"""
         # Limpiar emojis y texto extra
@@ -638,6 +4898,7 @@ class ControlAzucarApp:
         self.imagen_label.configure(image="", text="📷 No hay imagen seleccionada")
         self.imagen_label.image = None
         self.foto_path = None
+        self.foto_hash = None
         self.alimentos_detectados = []
         self.btn_analizar.configure(state="disabled")
         
@@ -668,9 +4929,9 @@ class ControlAzucarApp:
                  font=("Arial", 14, "bold")).pack(side=tk.LEFT)
         
         # Estadísticas rápidas
-        total_registros = len(self.datos["registros"])
+        total_registros = len(self.almacen.registros)
         if total_registros > 0:
-            fechas_unicas = len(set(r['fecha'] for r in self.datos["registros"]))
+            fechas_unicas = len(set(r['fecha'] for r in self.almacen.registros))
             promedio_por_dia = total_registros / fechas_unicas if fechas_unicas > 0 else 0
             ttk.Label(titulo_frame, 
                      text=f"📈 {total_registros} registros • {fechas_unicas} días • {promedio_por_dia:.1f} reg/día",
@@ -688,11 +4949,12 @@ class ControlAzucarApp:
         tree = ttk.Treeview(tree_frame, show="tree headings", height=25, selectmode="none")
         
         # Configurar columnas con checkbox
-        tree["columns"] = ("checkbox", "Hora", "Azúcar", "Alimentos", "Fuente")
+        tree["columns"] = ("checkbox", "Hora", "Azúcar", "Sensor", "Alimentos", "Fuente")
         tree.heading("#0", text="📅 Fecha / 🍽️ Registros", anchor="w")
         tree.heading("checkbox", text="☑️", anchor="center")
         tree.heading("Hora", text="🕐 Hora")
         tree.heading("Azúcar", text="📊 Azúcar")
+        tree.heading("Sensor", text="📡 Sensor (CGM)")
         tree.heading("Alimentos", text="🥗 Alimentos")
         tree.heading("Fuente", text="📷 Origen")
 
@@ -701,12 +4963,13 @@ class ControlAzucarApp:
         tree.column("checkbox", width=50, minwidth=50, anchor="center")
         tree.column("Hora", width=80, minwidth=60)
         tree.column("Azúcar", width=120, minwidth=80)
+        tree.column("Sensor", width=190, minwidth=80)
         tree.column("Alimentos", width=280, minwidth=200)
         tree.column("Fuente", width=100, minwidth=80)
 
         # Agrupar registros por fecha
         registros_por_fecha = {}
-        for registro in self.datos["registros"]:
+        for registro in self.almacen.registros:
             fecha = registro["fecha"]
             if fecha not in registros_por_fecha:
                 registros_por_fecha[fecha] = []
@@ -769,7 +5032,7 @@ class ControlAzucarApp:
             texto_dia = f"📅 {fecha_formateada}"
             estadisticas_dia = f"📊 Promedio: {promedio_dia:.0f} mg/dL (↓{min_dia} ↑{max_dia}) • {len(registros_del_dia)} registros"
             
-            dia_id = tree.insert("", "end", text=texto_dia, values=("", "", estadisticas_dia, "", "", ""), open=True)
+            dia_id = tree.insert("", "end", text=texto_dia, values=("", "", estadisticas_dia, "", "", "", ""), open=True)
             
             # Inicializar mapeo si es necesario
             if not hasattr(self, '_tree_registro_map'):
@@ -825,6 +5088,7 @@ class ControlAzucarApp:
                                "☐",  # Checkbox inicial (sin marcar)
                                registro["hora"],
                                azucar_texto,
+                               CorrelacionCGM.texto(self.almacen.correlacion_cgm.para_registro(registro)),
                                alimentos_str,
                                icono_fuente
                            ))
@@ -852,6 +5116,13 @@ class ControlAzucarApp:
         
         tree.bind("<Button-1>", on_tree_click)
 
+        def on_tree_double_click(event):
+            item = tree.identify_row(event.y)
+            if item in self._tree_registro_map:
+                self.mostrar_foto(self._tree_registro_map[item], historial_window)
+
+        tree.bind("<Double-1>", on_tree_double_click)
+
         # Scrollbars (modificadas para el nuevo layout)
         v_scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=tree.yview)
         h_scrollbar = ttk.Scrollbar(tree_frame, orient=tk.HORIZONTAL, command=tree.xview)
@@ -870,7 +5141,7 @@ class ControlAzucarApp:
         botones_frame.pack(side=tk.RIGHT, fill=tk.Y)
         
         ttk.Label(botones_frame, text="📁 Opciones", font=("Arial", 12, "bold")).pack(pady=(0, 10))
-        ttk.Label(botones_frame, text="💡 Marca los registros\ncon ☑️ para usarlos", 
+        ttk.Label(botones_frame, text="💡 Marca los registros\ncon ☑️ para usarlos\n🖼️ Doble clic: ver foto", 
                  font=("Arial", 9, "italic"), foreground="gray", justify=tk.CENTER).pack(pady=(0, 15))
         
         # Botones principales (verticales)
@@ -878,8 +5149,14 @@ class ControlAzucarApp:
                   command=lambda: self.exportar_excel_checkboxes()).pack(pady=(0, 8))
         ttk.Button(botones_frame, text="📄 Exportar a CSV", width=18,
                   command=lambda: self.exportar_csv_checkboxes()).pack(pady=(0, 8))
+        ttk.Button(botones_frame, text="📦 Varios formatos", width=18,
+                  command=lambda: self.exportar_varios_formatos()).pack(pady=(0, 8))
+        ttk.Button(botones_frame, text="🔁 Exportar cambios", width=18,
+                  command=lambda: self.exportar_cambios()).pack(pady=(0, 8))
         ttk.Button(botones_frame, text="🗑️ Borrar registros", width=18,
                   command=lambda: self.borrar_checkboxes(historial_window)).pack(pady=(0, 8))
+        ttk.Button(botones_frame, text="🕒 Ver en otra fecha", width=18,
+                  command=lambda: self.mostrar_historial_en_fecha(historial_window)).pack(pady=(0, 8))
         
         # Separador
         ttk.Separator(botones_frame, orient='horizontal').pack(fill=tk.X, pady=15)
@@ -897,6 +5174,348 @@ class ControlAzucarApp:
         # Guardar referencia al tree para los métodos
         self.current_tree = tree
 
+    def mostrar_estadisticas(self):
+        """Ventana de estadísticas de glucosa por rango de fechas"""
+        stats_window = tk.Toplevel(self.root)
+        stats_window.title("📈 Estadísticas de Glucosa")
+        stats_window.geometry("700x600")
+
+        main_frame = ttk.Frame(stats_window, padding="15")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(main_frame, text="📈 Estadísticas de Glucosa",
+                 font=("Arial", 14, "bold")).pack(pady=(0, 15))
+
+        # Filtros de rango y objetivo
+        filtros_frame = ttk.Frame(main_frame)
+        filtros_frame.pack(fill=tk.X, pady=(0, 10))
+
+        desde_var = tk.StringVar()
+        hasta_var = tk.StringVar()
+        bajo_var = tk.StringVar(value=str(OBJETIVO_GLUCOSA[0]))
+        alto_var = tk.StringVar(value=str(OBJETIVO_GLUCOSA[1]))
+
+        ttk.Label(filtros_frame, text="Desde:").pack(side=tk.LEFT)
+        ttk.Entry(filtros_frame, textvariable=desde_var, width=11).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(filtros_frame, text="Hasta:").pack(side=tk.LEFT)
+        ttk.Entry(filtros_frame, textvariable=hasta_var, width=11).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(filtros_frame, text="Objetivo:").pack(side=tk.LEFT)
+        ttk.Entry(filtros_frame, textvariable=bajo_var, width=5).pack(side=tk.LEFT, padx=(5, 2))
+        ttk.Label(filtros_frame, text="-").pack(side=tk.LEFT)
+        ttk.Entry(filtros_frame, textvariable=alto_var, width=5).pack(side=tk.LEFT, padx=(2, 10))
+
+        ttk.Label(main_frame, text="(fechas en formato AAAA-MM-DD; vacío = todo el historial)",
+                 foreground="gray", font=("Arial", 8)).pack(anchor="w")
+
+        resumen_label = ttk.Label(main_frame, text="", font=("Consolas", 10), justify=tk.LEFT)
+        resumen_label.pack(fill=tk.X, pady=(10, 10), anchor="w")
+
+        comidas_frame = ttk.LabelFrame(main_frame, text="🍽️ Variación antes → después por comida", padding="10")
+        comidas_frame.pack(fill=tk.BOTH, expand=True)
+
+        tree = ttk.Treeview(comidas_frame, columns=("Pares", "Media", "Mediana", "Máxima"), show="tree headings", height=8)
+        tree.heading("#0", text="Comida", anchor="w")
+        for columna in ("Pares", "Media", "Mediana", "Máxima"):
+            tree.heading(columna, text=columna)
+            tree.column(columna, width=90, anchor="center")
+        tree.pack(fill=tk.BOTH, expand=True)
+
+        def calcular():
+            try:
+                desde = desde_var.get().strip() or None
+                hasta = hasta_var.get().strip() or None
+                for fecha in (desde, hasta):
+                    if fecha:
+                        datetime.strptime(fecha, "%Y-%m-%d")
+                objetivo = (float(bajo_var.get()), float(alto_var.get()))
+                if objetivo[0] >= objetivo[1]:
+                    raise ValueError("el límite inferior debe ser menor que el superior")
+            except ValueError as e:
+                messagebox.showerror("❌ Error", f"Filtros inválidos: {str(e)}", parent=stats_window)
+                return
+
+            try:
+                resumen = self.estadisticas.resumen(desde, hasta, objetivo)
+            except ImportError:
+                messagebox.showerror("❌ Error", "Las estadísticas necesitan numpy y pandas.\nEjecuta: pip install numpy pandas",
+                                     parent=stats_window)
+                return
+
+            e = resumen["glucosa"]
+            if not e:
+                resumen_label.configure(text=f"Sin lecturas en el rango ({resumen['registros']} registros)")
+            else:
+                p = e["percentiles"]
+                resumen_label.configure(text=(
+                    f"Registros: {resumen['registros']}   Lecturas: {e['lecturas']}\n"
+                    f"Media: {e['media']:.1f} mg/dL   DE: {e['desviacion']:.1f}   CV: {e['cv']:.1f}%   GMI: {e['gmi']:.1f}%\n"
+                    f"Mín/Máx: {e['minimo']:g} / {e['maximo']:g}   P5 {p[5]:.0f} · P25 {p[25]:.0f} · "
+                    f"P50 {p[50]:.0f} · P75 {p[75]:.0f} · P95 {p[95]:.0f}\n"
+                    f"En rango: {e['tir']:.1f}%   Bajo: {e['tbr']:.1f}%   Alto: {e['tar']:.1f}%"
+                ))
+
+            sensor = resumen["sensor"]
+            if sensor:
+                resumen_label.configure(text=resumen_label.cget("text") + (
+                    f"\n📡 Sensor: {sensor['lecturas']} lecturas   Media: {sensor['media']:.1f} mg/dL   "
+                    f"CV: {sensor['cv']:.1f}%   En rango: {sensor['tir']:.1f}%   Bajo: {sensor['tbr']:.1f}%   Alto: {sensor['tar']:.1f}%"
+                ))
+
+            tree.delete(*tree.get_children())
+            for fila in resumen["por_comida"]:
+                tree.insert("", "end", text=fila["comida"], values=(
+                    fila["pares"], f"{fila['delta_media']:+.1f}",
+                    f"{fila['delta_mediana']:+.1f}", f"{fila['delta_maxima']:+.1f}"
+                ))
+
+        ttk.Button(filtros_frame, text="🔄 Calcular", command=calcular).pack(side=tk.LEFT)
+        ttk.Button(main_frame, text="❌ Cerrar", command=stats_window.destroy).pack(pady=(10, 0))
+        calcular()
+
+    def mostrar_tendencias(self):
+        """Ventana con gráficos de tendencia de glucosa antes y después de comer"""
+        try:
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        except ImportError:
+            messagebox.showerror("❌ Error", "Los gráficos necesitan matplotlib.\nEjecuta: pip install matplotlib")
+            return
+
+        tendencias_window = tk.Toplevel(self.root)
+        tendencias_window.title("📉 Tendencias de Glucosa")
+        tendencias_window.geometry("1050x650")
+
+        main_frame = ttk.Frame(tendencias_window, padding="10")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        controles_frame = ttk.Frame(main_frame)
+        controles_frame.pack(fill=tk.X, pady=(0, 10))
+
+        desde_var = tk.StringVar()
+        hasta_var = tk.StringVar()
+        resolucion_var = tk.StringVar(value="Diaria")
+
+        ttk.Label(controles_frame, text="Desde:").pack(side=tk.LEFT)
+        ttk.Entry(controles_frame, textvariable=desde_var, width=11).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(controles_frame, text="Hasta:").pack(side=tk.LEFT)
+        ttk.Entry(controles_frame, textvariable=hasta_var, width=11).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(controles_frame, text="Resolución:").pack(side=tk.LEFT)
+        ttk.Combobox(controles_frame, textvariable=resolucion_var, state="readonly", width=10,
+                     values=list(GraficosTendencias.RESOLUCIONES)).pack(side=tk.LEFT, padx=(5, 10))
+
+        grafico_frame = ttk.Frame(main_frame)
+        grafico_frame.pack(fill=tk.BOTH, expand=True)
+        actual = {"canvas": None, "toolbar": None}
+
+        def dibujar():
+            desde = desde_var.get().strip() or None
+            hasta = hasta_var.get().strip() or None
+            try:
+                for fecha in (desde, hasta):
+                    if fecha:
+                        datetime.strptime(fecha, "%Y-%m-%d")
+            except ValueError:
+                messagebox.showerror("❌ Error", "Fechas inválidas. Use AAAA-MM-DD", parent=tendencias_window)
+                return
+
+            figura = self.estadisticas.figura(desde, hasta, resolucion_var.get())
+
+            if actual["canvas"] is not None:
+                actual["toolbar"].destroy()
+                actual["canvas"].get_tk_widget().destroy()
+            canvas = FigureCanvasTkAgg(figura, master=grafico_frame)
+            toolbar = NavigationToolbar2Tk(canvas, grafico_frame, pack_toolbar=False)
+            toolbar.update()
+            toolbar.pack(side=tk.BOTTOM, fill=tk.X)
+            canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+            canvas.draw_idle()
+            actual["canvas"], actual["toolbar"] = canvas, toolbar
+
+        ttk.Button(controles_frame, text="📈 Dibujar", command=dibujar).pack(side=tk.LEFT)
+        ttk.Label(controles_frame, text="(AAAA-MM-DD; vacío = todo)", foreground="gray",
+                 font=("Arial", 8)).pack(side=tk.LEFT, padx=(10, 0))
+        dibujar()
+
+    def mostrar_impacto_alimentos(self):
+        """Ventana con los alimentos ordenados por su impacto en el azúcar"""
+        alimentos_window = tk.Toplevel(self.root)
+        alimentos_window.title("🍎 Alimentos por impacto")
+        alimentos_window.geometry("1080x550")
+
+        main_frame = ttk.Frame(alimentos_window, padding="10")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(main_frame, text="🍎 Alimentos por impacto en el azúcar",
+                 font=("Arial", 14, "bold")).pack(pady=(0, 5))
+        ttk.Label(main_frame, text="Subida = azúcar después − azúcar antes de comer. Pico/AUC sensor: curva del CGM en las 3 h siguientes. "
+                      "Haz click en una columna para ordenar.",
+                 foreground="gray", font=("Arial", 9)).pack(pady=(0, 10))
+
+        buscar_frame = ttk.Frame(main_frame)
+        buscar_frame.pack(fill=tk.X, pady=(0, 10))
+        ttk.Label(buscar_frame, text="🔍 Buscar:").pack(side=tk.LEFT)
+        buscar_var = tk.StringVar()
+        ttk.Entry(buscar_frame, textvariable=buscar_var, width=30).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(buscar_frame, text="✏️ Alias de alimentos",
+                  command=lambda: self.editar_alias_alimentos(alimentos_window)).pack(side=tk.RIGHT)
+
+        columnas = (
+            ("apariciones", "Veces", 70), ("con_delta", "Medidas", 70), ("delta_media", "Subida media", 100),
+            ("delta_mediana", "Mediana", 80), ("delta_p90", "P90", 70), ("delta_maxima", "Máxima", 80),
+            ("cgm_subida_media", "Pico sensor", 90), ("cgm_auc_media", "AUC sensor", 90),
+            ("ultima_vez", "Última vez", 140),
+        )
+        tree = ttk.Treeview(main_frame, columns=[c[0] for c in columnas], show="tree headings")
+        tree.heading("#0", text="Alimento", anchor="w", command=lambda: ordenar("alimento"))
+        tree.column("#0", width=200)
+        for clave, texto, ancho in columnas:
+            tree.heading(clave, text=texto, command=lambda c=clave: ordenar(c))
+            tree.column(clave, width=ancho, anchor="center")
+        scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        orden = {"clave": "delta_media", "descendente": True}
+
+        def formatear(clave, valor):
+            if valor is None:
+                return "-"
+            if clave.startswith("delta") or clave == "cgm_subida_media":
+                return f"{valor:+.1f}"
+            if clave == "cgm_auc_media":
+                return f"{valor:.0f}"
+            if clave == "ultima_vez":
+                return valor[:16].replace("T", " ")
+            return valor
+
+        def refrescar(*_):
+            filtro = normalizar_alimento(buscar_var.get())
+            if orden["clave"] == "alimento":
+                filas = sorted(self.estadisticas.impacto_alimentos(),
+                               key=lambda r: normalizar_alimento(r["alimento"]), reverse=orden["descendente"])
+            else:
+                filas = self.estadisticas.impacto_alimentos(orden["clave"], orden["descendente"])
+            tree.delete(*tree.get_children())
+            for fila in filas:
+                if filtro and filtro not in normalizar_alimento(fila["alimento"]):
+                    continue
+                tree.insert("", "end", text=fila["alimento"],
+                            values=[formatear(clave, fila[clave]) for clave, _, _ in columnas])
+
+        def ordenar(clave):
+            if orden["clave"] == clave:
+                orden["descendente"] = not orden["descendente"]
+            else:
+                orden["clave"], orden["descendente"] = clave, clave != "alimento"
+            refrescar()
+
+        buscar_var.trace_add("write", refrescar)
+        refrescar()
+
+    def mostrar_alertas(self):
+        """Ventana con las alertas de glucosa registradas"""
+        alertas_window = tk.Toplevel(self.root)
+        alertas_window.title("🔔 Alertas de Glucosa")
+        alertas_window.geometry("750x450")
+
+        main_frame = ttk.Frame(alertas_window, padding="10")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(main_frame, text="🔔 Alertas de Glucosa",
+                 font=("Arial", 14, "bold")).pack(pady=(0, 5))
+
+        c = self.almacen.motor_alertas.configuracion
+        media = self.almacen.motor_alertas.media_movil()
+        texto_media = f"{media:.0f} mg/dL" if media is not None else "sin lecturas"
+        ttk.Label(main_frame,
+                 text=f"Límites: < {c['limite_bajo']} / > {c['limite_alto']} mg/dL · "
+                      f"Subida máxima: {c['subida_posprandial']} mg/dL · "
+                      f"Racha: {self.almacen.motor_alertas.racha_altos}/{c['altos_consecutivos']} · "
+                      f"Media {c['ventana_horas']} h: {texto_media}",
+                 foreground="gray", font=("Arial", 9)).pack(pady=(0, 10))
+
+        tree = ttk.Treeview(main_frame, columns=("Regla", "Mensaje"), show="tree headings")
+        tree.heading("#0", text="Fecha", anchor="w")
+        tree.column("#0", width=130)
+        tree.heading("Regla", text="Regla")
+        tree.column("Regla", width=140, anchor="center")
+        tree.heading("Mensaje", text="Mensaje", anchor="w")
+        tree.column("Mensaje", width=420)
+        tree.tag_configure("grave", foreground="#C92A2A")
+        scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        for alerta in self.estadisticas.alertas():
+            tree.insert("", "end", text=alerta.get("momento", "").replace("T", " "),
+                        values=(alerta.get("regla", ""), alerta.get("mensaje", "")),
+                        tags=(alerta.get("nivel", ""),))
+
+    def editar_alias_alimentos(self, ventana_impacto=None):
+        """Ventana para editar la tabla de alias de alimentos"""
+        alias_window = tk.Toplevel(self.root)
+        alias_window.title("✏️ Alias de alimentos")
+        alias_window.geometry("550x450")
+
+        main_frame = ttk.Frame(alias_window, padding="15")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(main_frame, text="✏️ Alias de alimentos", font=("Arial", 14, "bold")).pack(pady=(0, 5))
+        ttk.Label(main_frame, text="Un alias hace que un nombre de la IA se cuente como otro alimento.",
+                 foreground="gray", font=("Arial", 9)).pack(pady=(0, 10))
+
+        tree = ttk.Treeview(main_frame, columns=("canonico",), show="tree headings", height=12)
+        tree.heading("#0", text="Alias", anchor="w")
+        tree.heading("canonico", text="Alimento canónico", anchor="w")
+        tree.pack(fill=tk.BOTH, expand=True)
+
+        def refrescar():
+            tree.delete(*tree.get_children())
+            for alias, id_alimento in sorted(self.almacen.normalizador.alias.items()):
+                tree.insert("", "end", iid=alias, text=alias, values=(self.almacen.normalizador.nombre(id_alimento),))
+
+        agregar_frame = ttk.Frame(main_frame)
+        agregar_frame.pack(fill=tk.X, pady=(10, 0))
+        alias_var = tk.StringVar()
+        canonico_var = tk.StringVar()
+        ttk.Label(agregar_frame, text="Alias:").pack(side=tk.LEFT)
+        ttk.Entry(agregar_frame, textvariable=alias_var, width=18).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(agregar_frame, text="→").pack(side=tk.LEFT)
+        ttk.Combobox(agregar_frame, textvariable=canonico_var, width=20,
+                     values=sorted(self.almacen.normalizador.canonicos.values())).pack(side=tk.LEFT, padx=(10, 0))
+
+        def aplicar_cambios():
+            # Recalcular los ids de todo el historial con la tabla nueva
+            self.almacen.aplicar_alias()
+            refrescar()
+            if ventana_impacto is not None and ventana_impacto.winfo_exists():
+                ventana_impacto.destroy()
+                self.mostrar_impacto_alimentos()
+                alias_window.lift()
+
+        def agregar():
+            alias, canonico = alias_var.get().strip(), canonico_var.get().strip()
+            if not alias or not canonico:
+                messagebox.showwarning("⚠️ Advertencia", "Indica el alias y el alimento canónico", parent=alias_window)
+                return
+            self.almacen.normalizador.agregar_alias(alias, canonico)
+            alias_var.set("")
+            aplicar_cambios()
+
+        def quitar():
+            for alias in tree.selection():
+                self.almacen.normalizador.quitar_alias(alias)
+            aplicar_cambios()
+
+        ttk.Button(agregar_frame, text="➕", width=3, command=agregar).pack(side=tk.LEFT, padx=(10, 0))
+
+        botones_frame = ttk.Frame(main_frame)
+        botones_frame.pack(pady=(15, 0))
+        ttk.Button(botones_frame, text="🗑️ Quitar seleccionados", command=quitar).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(botones_frame, text="❌ Cerrar", command=alias_window.destroy).pack(side=tk.LEFT)
+        refrescar()
+
     def configurar_horarios(self):
         """Ventana para configurar franjas horarias con nombres personalizables"""
         config_window = tk.Toplevel(self.root)
@@ -934,7 +5553,7 @@ class ControlAzucarApp:
         ttk.Label(headers_frame, text="Hora Fin", width=10, font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=(0, 10))
         ttk.Label(headers_frame, text="Acciones", width=10, font=("Arial", 10, "bold")).pack(side=tk.LEFT)
 
-        for comida, franja in self.datos["configuracion"]["franjas_horarias"].items():
+        for comida, franja in self.almacen.configuracion["franjas_horarias"].items():
             frame = ttk.Frame(scrollable_frame)
             frame.pack(fill=tk.X, pady=3)
 
@@ -1033,17 +5652,12 @@ class ControlAzucarApp:
     def restaurar_horarios_predeterminados(self, window):
         """Restaurar horarios a valores predeterminados"""
         resultado = messagebox.askyesno("↺ Restaurar Predeterminados", 
-                                      "¿Está seguro de restaurar todos los horarios a los valores predeterminados?\n\nEsto eliminará todas las comidas personalizadas.")
+                                      "¿Está seguro de restaurar todos los horarios a los valores predeterminados?\n\nEsto eliminará todas las comidas personalizadas "
+                                      "(se pueden recuperar con ↩️ Deshacer).")
         if resultado:
-            self.datos["configuracion"]["franjas_horarias"] = {
-                "desayuno": {"inicio": "06:00", "fin": "10:00"},
-                "almuerzo": {"inicio": "10:01", "fin": "13:00"},
-                "comida": {"inicio": "13:01", "fin": "16:00"},
-                "merienda": {"inicio": "16:01", "fin": "19:00"},
-                "cena": {"inicio": "19:01", "fin": "23:59"}
-            }
-            self.guardar_datos()
-            messagebox.showinfo("✅ Restaurado", "Horarios restaurados a valores predeterminados")
+            cambiados = self.almacen.cambiar_franjas(copy.deepcopy(FRANJAS_PREDETERMINADAS))
+            messagebox.showinfo("✅ Restaurado", "Horarios restaurados a valores predeterminados\n"
+                                               f"🔄 {cambiados} registro(s) reclasificados")
             window.destroy()
 
     def guardar_horarios(self, window):
@@ -1052,6 +5666,7 @@ class ControlAzucarApp:
             # Crear nueva configuración
             nueva_configuracion = {}
             nombres_usados = set()
+            horarios_lista = []
 
             for comida_key in list(self.horarios_vars.keys()):
                 nuevo_nombre = self.nombres_vars[comida_key].get().strip().lower()
@@ -1067,16 +5682,16 @@ class ControlAzucarApp:
                     messagebox.showerror("❌ Error", f"El nombre '{nuevo_nombre}' ya está en uso")
                     return
 
-                # Validar formato de hora
+                # Validar formato de hora (cada hora se interpreta una sola vez)
                 try:
-                    datetime.strptime(inicio, "%H:%M")
-                    datetime.strptime(fin, "%H:%M")
+                    inicio_min = minutos_del_dia(inicio)
+                    fin_min = minutos_del_dia(fin)
                 except ValueError:
                     messagebox.showerror("❌ Error", f"Formato de hora inválido en '{nuevo_nombre}'. Use HH:MM")
                     return
 
                 # Validar que hora inicio sea menor que hora fin
-                if datetime.strptime(inicio, "%H:%M").time() >= datetime.strptime(fin, "%H:%M").time():
+                if inicio_min >= fin_min:
                     messagebox.showerror("❌ Error", f"La hora de inicio debe ser menor que la hora de fin en '{nuevo_nombre}'")
                     return
 
@@ -1085,24 +5700,19 @@ class ControlAzucarApp:
                     "inicio": inicio,
                     "fin": fin
                 }
+                horarios_lista.append((inicio_min, fin_min, nuevo_nombre))
 
             # Verificar que no haya solapamientos de horarios
-            horarios_lista = []
-            for nombre, horario in nueva_configuracion.items():
-                inicio = datetime.strptime(horario["inicio"], "%H:%M").time()
-                fin = datetime.strptime(horario["fin"], "%H:%M").time()
-                horarios_lista.append((inicio, fin, nombre))
-
             horarios_lista.sort()
             for i in range(len(horarios_lista) - 1):
                 if horarios_lista[i][1] >= horarios_lista[i + 1][0]:
                     messagebox.showwarning("⚠️ Advertencia", 
                                          f"Hay solapamiento entre '{horarios_lista[i][2]}' y '{horarios_lista[i + 1][2]}'.\n\nSe guardará de todas formas, pero podría causar confusión.")
 
-            # Guardar configuración
-            self.datos["configuracion"]["franjas_horarias"] = nueva_configuracion
-            self.guardar_datos()
-            messagebox.showinfo("✅ Éxito", "Horarios y nombres guardados correctamente")
+            # Guardar configuración y reclasificar el historial
+            cambiados = self.almacen.cambiar_franjas(nueva_configuracion)
+            messagebox.showinfo("✅ Éxito", "Horarios y nombres guardados correctamente\n"
+                                           f"🔄 {cambiados} registro(s) reclasificados")
             window.destroy()
 
         except Exception as e:
@@ -1110,7 +5720,7 @@ class ControlAzucarApp:
 
     def exportar_csv(self):
         """Exportar historial a CSV"""
-        if not self.datos["registros"]:
+        if not self.almacen.registros:
             messagebox.showwarning("⚠️ Advertencia", "No hay registros para exportar")
             return
 
@@ -1121,29 +5731,10 @@ class ControlAzucarApp:
         )
 
         if filename:
-            try:
-                import csv
-                with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-                    fieldnames = ['Fecha', 'Hora', 'Nombre_Comida', 'Azucar_Antes_mg/dL', 'Azucar_Despues_mg/dL', 'Nivel_Azucar_Legacy_mg/dL', 'Alimentos_Detectados']
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-                    writer.writeheader()
-                    for registro in self.datos["registros"]:
-                        # Usar nombre_comida si existe, sino usar tipo_comida para compatibilidad
-                        nombre_comida = registro.get("nombre_comida", registro.get("tipo_comida", "Sin nombre"))
-                        writer.writerow({
-                            'Fecha': registro['fecha'],
-                            'Hora': registro['hora'],
-                            'Nombre_Comida': nombre_comida,
-                            'Azucar_Antes_mg/dL': registro.get('azucar_antes', ''),
-                            'Azucar_Despues_mg/dL': registro.get('azucar_despues', ''),
-                            'Nivel_Azucar_Legacy_mg/dL': registro.get('nivel_azucar', ''),
-                            'Alimentos_Detectados': ', '.join(registro['alimentos'])
-                        })
-
-                messagebox.showinfo("✅ Éxito", f"📄 Datos exportados correctamente a:\n{filename}")
-            except Exception as e:
-                messagebox.showerror("❌ Error", f"Error al exportar: {str(e)}")
+            self.encolar_exportacion(
+                "📄 Historial a CSV", [filename], self.almacen.registros,
+                f"📄 Datos exportados correctamente a:\n{filename}"
+            )
 
     def marcar_todos_checkboxes(self, marcar=True):
         """Marcar o desmarcar todos los checkboxes"""
@@ -1210,16 +5801,144 @@ class ControlAzucarApp:
             
         if not messagebox.askyesno("Confirmar borrado", 
                                   f"¿Seguro que deseas borrar {len(registros)} registro(s)?\n\n"
-                                  "Esta acción no se puede deshacer."):
+                                  "💡 Podrás recuperarlos con ↩️ Deshacer (Ctrl+Z)."):
             return
             
         # Eliminar registros
-        self.datos["registros"] = [r for r in self.datos["registros"] if r not in registros]
-        self.guardar_datos()
+        self.almacen.borrar(registros)
         messagebox.showinfo("✅ Borrado", f"Se han borrado {len(registros)} registro(s)")
         ventana.destroy()
         self.mostrar_historial()
 
+    def mostrar_foto(self, registro, parent=None):
+        """Ver la foto de un registro (del almacén de fotos, o del archivo original si es antiguo)"""
+        from PIL import Image, ImageTk
+
+        foto_hash = registro.get("foto_hash")
+        ruta = self.almacen.fotos.ruta_api(foto_hash) if foto_hash else None
+        if ruta is None and registro.get("foto_path") and os.path.exists(registro["foto_path"]):
+            ruta = registro["foto_path"]
+        if ruta is None:
+            messagebox.showinfo("🖼️ Foto", "Este registro no tiene foto o ya no está disponible", parent=parent)
+            return
+        try:
+            with Image.open(ruta) as imagen:
+                imagen.draft("RGB", (700, 700))
+                imagen.thumbnail((700, 700))
+                photo = ImageTk.PhotoImage(imagen)
+        except OSError as e:
+            messagebox.showerror("Error", f"No se pudo cargar la imagen: {str(e)}", parent=parent)
+            return
+
+        foto_window = tk.Toplevel(parent or self.root)
+        foto_window.title(f"🖼️ {registro.get('nombre_comida', '')} · {registro.get('fecha', '')} {registro.get('hora', '')}")
+        etiqueta = ttk.Label(foto_window, image=photo)
+        etiqueta.image = photo  # Mantener referencia
+        etiqueta.pack(padx=10, pady=10)
+
+    def deshacer(self):
+        """Deshacer el último cambio del historial (altas, borrados, ediciones y horarios)"""
+        try:
+            evento = self.almacen.deshacer()
+        except (OSError, ValueError) as e:
+            messagebox.showerror("❌ Error", f"No se pudo deshacer: {e}")
+            return
+        if evento is None:
+            messagebox.showinfo("↩️ Deshacer", "No hay nada que deshacer")
+            return
+        self.actualizar_completado_comida()
+        messagebox.showinfo("↩️ Deshecho", describir_evento(evento))
+
+    def rehacer(self):
+        """Volver a aplicar el último cambio deshecho"""
+        try:
+            evento = self.almacen.rehacer()
+        except (OSError, ValueError) as e:
+            messagebox.showerror("❌ Error", f"No se pudo rehacer: {e}")
+            return
+        if evento is None:
+            messagebox.showinfo("↪️ Rehacer", "No hay nada que rehacer")
+            return
+        self.actualizar_completado_comida()
+        messagebox.showinfo("↪️ Rehecho", describir_evento(evento))
+
+    def mostrar_historial_en_fecha(self, ventana_historial=None):
+        """Ver los registros tal como estaban en un momento pasado y restaurar los que faltan"""
+        from tkinter import simpledialog
+
+        texto = simpledialog.askstring("🕒 Ver en otra fecha", "Momento (AAAA-MM-DD HH:MM):",
+                                       initialvalue=datetime.now().strftime("%Y-%m-%d %H:%M"),
+                                       parent=ventana_historial or self.root)
+        if not texto:
+            return
+        try:
+            momento = datetime.strptime(texto.strip(), "%Y-%m-%d %H:%M")
+        except ValueError:
+            messagebox.showerror("❌ Error", "Usa el formato AAAA-MM-DD HH:MM")
+            return
+        vista = self.almacen.vista(momento.isoformat(timespec="seconds"))
+        registros = sorted(vista, key=lambda r: (r.get("fecha", ""), r.get("hora", "")), reverse=True)
+        actuales = {r.get("id") for r in self.almacen.registros}
+
+        vista_window = tk.Toplevel(self.root)
+        vista_window.title(f"🕒 Historial a {texto.strip()}")
+        vista_window.geometry("850x500")
+
+        main_frame = ttk.Frame(vista_window, padding="10")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        faltan = sum(1 for r in registros if r.get("id") not in actuales)
+        ttk.Label(main_frame, text=f"🕒 Historial a {texto.strip()}",
+                 font=("Arial", 14, "bold")).pack(pady=(0, 5))
+        ttk.Label(main_frame, text=f"{len(registros)} registros · {faltan} ya no están en el historial actual (en rojo)",
+                 foreground="gray", font=("Arial", 9)).pack(pady=(0, 10))
+
+        botones_frame = ttk.Frame(main_frame)
+        botones_frame.pack(side=tk.BOTTOM, pady=(10, 0))
+
+        tree = ttk.Treeview(main_frame, columns=("Hora", "Azúcar", "Alimentos"), show="tree headings")
+        tree.heading("#0", text="📅 Fecha / 🍽️ Comida", anchor="w")
+        tree.column("#0", width=220)
+        tree.heading("Hora", text="🕐 Hora")
+        tree.column("Hora", width=70, anchor="center")
+        tree.heading("Azúcar", text="📊 Antes → Después")
+        tree.column("Azúcar", width=130, anchor="center")
+        tree.heading("Alimentos", text="🥗 Alimentos", anchor="w")
+        tree.column("Alimentos", width=360)
+        tree.tag_configure("borrado", foreground="#C92A2A")
+        scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        por_item = {}
+        for registro in registros:
+            niveles = (registro.get("azucar_antes"), registro.get("azucar_despues"))
+            azucar = " → ".join("-" if n is None else f"{n:g}" for n in niveles)
+            if registro.get("nivel_azucar") is not None and niveles == (None, None):
+                azucar = f"{registro['nivel_azucar']:g}"
+            item = tree.insert("", "end", text=f"{registro.get('fecha', '')} · {registro.get('nombre_comida', registro.get('tipo_comida', ''))}",
+                               values=(registro.get("hora", ""), azucar, ", ".join(registro.get("alimentos", []))),
+                               tags=("borrado",) if registro.get("id") not in actuales else ())
+            por_item[item] = registro
+
+        def restaurar():
+            seleccion = [por_item[i] for i in tree.selection() if por_item[i].get("id") not in actuales]
+            if not seleccion:
+                messagebox.showwarning("⚠️ Sin selección", "Selecciona registros en rojo (los que ya no están)",
+                                       parent=vista_window)
+                return
+            self.almacen.agregar_lote([dict(r, actualizado=ahora_iso()) for r in seleccion], alertas=False)
+            messagebox.showinfo("✅ Restaurado", f"Se han restaurado {len(seleccion)} registro(s)\n"
+                                               "💡 Se puede deshacer con ↩️ Deshacer", parent=vista_window)
+            vista_window.destroy()
+            if ventana_historial is not None and ventana_historial.winfo_exists():
+                ventana_historial.destroy()
+                self.mostrar_historial()
+
+        ttk.Button(botones_frame, text="♻️ Restaurar seleccionados", command=restaurar).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(botones_frame, text="❌ Cerrar", command=vista_window.destroy).pack(side=tk.LEFT)
+
     def exportar_excel_filtrado(self, registros_filtrados):
         """Exportar lista específica de registros a Excel"""
         if not registros_filtrados:
@@ -1233,75 +5952,11 @@ class ControlAzucarApp:
         )
 
         if filename:
-            try:
-                from openpyxl import Workbook
-                from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-                from openpyxl.utils import get_column_letter
-                from datetime import datetime as dt
-
-                # Crear libro
-                wb = Workbook()
-                ws = wb.active
-                ws.title = "Registros Marcados"
-
-                # Estilos
-                header_font = Font(bold=True, color="FFFFFF")
-                header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-                border = Border(
-                    left=Side(style='thin'), right=Side(style='thin'),
-                    top=Side(style='thin'), bottom=Side(style='thin')
-                )
-
-                # Título
-                ws['A1'] = "📊 REGISTROS SELECCIONADOS"
-                ws['A1'].font = Font(bold=True, size=16, color="4472C4")
-                ws.merge_cells('A1:F1')
-                ws['A1'].alignment = Alignment(horizontal='center')
-
-                # Info
-                ws['A2'] = f"📅 Generado: {dt.now().strftime('%d/%m/%Y %H:%M')}"
-                ws['A3'] = f"📊 Registros: {len(registros_filtrados)}"
-
-                # Encabezados
-                headers = ['📅 Fecha', '🕐 Hora', '🍽️ Comida', '📉 Azúcar Antes', '📈 Azúcar Después', '🥗 Alimentos']
-                for col, header in enumerate(headers, 1):
-                    cell = ws.cell(row=5, column=col, value=header)
-                    cell.font = header_font
-                    cell.fill = header_fill
-                    cell.alignment = Alignment(horizontal='center')
-                    cell.border = border
-
-                # Datos
-                for row, registro in enumerate(registros_filtrados, start=6):
-                    nombre_comida = registro.get("nombre_comida", registro.get("tipo_comida", "Sin nombre"))
-                    alimentos_str = ', '.join(registro['alimentos'])
-                    
-                    azucar_antes = registro.get('azucar_antes', '')
-                    azucar_despues = registro.get('azucar_despues', '')
-                    
-                    azucar_antes_str = f"{azucar_antes} mg/dL" if azucar_antes else "-"
-                    azucar_despues_str = f"{azucar_despues} mg/dL" if azucar_despues else "-"
-
-                    datos_fila = [
-                        registro['fecha'], registro['hora'], nombre_comida,
-                        azucar_antes_str, azucar_despues_str, alimentos_str
-                    ]
-
-                    for col, valor in enumerate(datos_fila, 1):
-                        cell = ws.cell(row=row, column=col, value=valor)
-                        cell.border = border
-
-                # Ajustar anchos
-                for col, width in enumerate([12, 8, 20, 15, 15, 40], 1):
-                    ws.column_dimensions[get_column_letter(col)].width = width
-
-                wb.save(filename)
-                messagebox.showinfo("✅ Éxito", f"📊 {len(registros_filtrados)} registros exportados a Excel")
-                
-            except ImportError:
-                messagebox.showerror("❌ Error", "Librería openpyxl no instalada.\nEjecuta: pip install openpyxl")
-            except Exception as e:
-                messagebox.showerror("❌ Error", f"Error al exportar: {str(e)}")
+            self.encolar_exportacion(
+                "📊 Registros marcados a Excel", [filename], registros_filtrados,
+                f"📊 {len(registros_filtrados)} registros exportados a Excel",
+                titulo="📊 REGISTROS SELECCIONADOS", titulo_hoja="Registros Marcados"
+            )
 
     def exportar_csv_filtrado(self, registros_filtrados):
         """Exportar lista específica de registros a CSV"""
@@ -1316,37 +5971,14 @@ class ControlAzucarApp:
         )
 
         if filename:
-            try:
-                import csv
-                with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-                    writer = csv.writer(csvfile)
-                    
-                    # Encabezados
-                    writer.writerow(['Fecha', 'Hora', 'Comida', 'Azúcar Antes', 'Azúcar Después', 'Alimentos'])
-                    
-                    # Datos
-                    for registro in registros_filtrados:
-                        nombre_comida = registro.get("nombre_comida", registro.get("tipo_comida", "Sin nombre"))
-                        alimentos_str = ', '.join(registro['alimentos'])
-                        
-                        azucar_antes = registro.get('azucar_antes', '')
-                        azucar_despues = registro.get('azucar_despues', '')
-                        
-                        writer.writerow([
-                            registro['fecha'], registro['hora'], nombre_comida,
-                            azucar_antes if azucar_antes else '',
-                            azucar_despues if azucar_despues else '',
-                            alimentos_str
-                        ])
-
-                messagebox.showinfo("✅ Éxito", f"📄 {len(registros_filtrados)} registros exportados a CSV")
-                
-            except Exception as e:
-                messagebox.showerror("❌ Error", f"Error al exportar: {str(e)}")
+            self.encolar_exportacion(
+                "📄 Registros marcados a CSV", [filename], registros_filtrados,
+                f"📄 {len(registros_filtrados)} registros exportados a CSV"
+            )
 
     def exportar_excel(self):
         """Exportar historial a Excel con formato mejorado"""
-        if not self.datos["registros"]:
+        if not self.almacen.registros:
             messagebox.showwarning("⚠️ Advertencia", "No hay registros para exportar")
             return
 
@@ -1357,198 +5989,885 @@ class ControlAzucarApp:
         )
 
         if filename:
+            self.encolar_exportacion(
+                "📊 Historial a Excel", [filename], self.almacen.registros,
+                f"📊 Datos exportados correctamente a Excel:\n{filename}\n\nSe incluyeron:\n• Hoja principal con datos\n• Hoja de estadísticas\n• Formato con colores según niveles"
+            )
+
+    def exportar_varios_formatos(self):
+        """Exportar a varios formatos a la vez leyendo los registros una sola vez"""
+        marcados = self.obtener_registros_marcados()
+        registros = marcados or self.almacen.registros
+        if not registros:
+            messagebox.showwarning("⚠️ Advertencia", "No hay registros para exportar")
+            return
+
+        formatos_window = tk.Toplevel(self.root)
+        formatos_window.title("📦 Exportar en varios formatos")
+        formatos_window.resizable(False, False)
+
+        main_frame = ttk.Frame(formatos_window, padding="15")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        origen = "registros marcados" if marcados else "todo el historial"
+        ttk.Label(main_frame, text=f"📦 {len(registros)} registros ({origen})",
+                 font=("Arial", 12, "bold")).pack(pady=(0, 10))
+
+        formatos_vars = {}
+        for extension, texto in ((".xlsx", "📊 Excel (.xlsx)"), (".csv", "📄 CSV (.csv)"), (".jsonl", "🧾 JSON Lines (.jsonl)")):
+            formatos_vars[extension] = tk.BooleanVar(value=extension != ".jsonl")
+            ttk.Checkbutton(main_frame, text=texto, variable=formatos_vars[extension]).pack(anchor="w")
+
+        def exportar():
+            extensiones = [ext for ext, var in formatos_vars.items() if var.get()]
+            if not extensiones:
+                messagebox.showwarning("⚠️ Advertencia", "Selecciona al menos un formato", parent=formatos_window)
+                return
+            base = filedialog.asksaveasfilename(
+                parent=formatos_window,
+                filetypes=[("All files", "*.*")],
+                title="Nombre base de los archivos exportados"
+            )
+            if not base:
+                return
+            base = os.path.splitext(base)[0]
+            destinos = [base + ext for ext in extensiones]
+            formatos_window.destroy()
+            self.encolar_exportacion(
+                "📦 Exportación múltiple", destinos, registros,
+                f"📦 {len(registros)} registros exportados a:\n" + "\n".join(destinos)
+            )
+
+        botones_frame = ttk.Frame(main_frame)
+        botones_frame.pack(pady=(15, 0))
+        ttk.Button(botones_frame, text="📤 Exportar", command=exportar).pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Button(botones_frame, text="❌ Cancelar", command=formatos_window.destroy).pack(side=tk.LEFT)
+
+    def exportar_cambios(self):
+        """Exportar solo los registros nuevos o modificados desde la última exportación a ese destino"""
+        filename = filedialog.asksaveasfilename(
+            defaultextension=".csv",
+            filetypes=[("CSV files", "*.csv"), ("JSON Lines", "*.jsonl"), ("Excel files", "*.xlsx"), ("All files", "*.*")],
+            title="Exportar cambios desde la última exportación",
+            confirmoverwrite=False
+        )
+        if not filename:
+            return
+
+        try:
+            clase = clase_sumidero(filename)
+        except ValueError as e:
+            messagebox.showerror("❌ Error", str(e))
+            return
+
+        registros, marca = self.exportacion.cambios(filename)
+
+        if not registros:
+            messagebox.showinfo("ℹ️ Sin cambios", f"No hay registros nuevos ni modificados desde la última exportación\n({marca})")
+            return
+
+        anexar = False
+        if clase.admite_anexar and os.path.exists(filename):
+            anexar = messagebox.askyesno("🔁 Exportar cambios",
+                                         f"{len(registros)} registro(s) nuevos o modificados.\n\n"
+                                         "¿Añadirlos al final del archivo existente?\n"
+                                         "(No = reescribir el archivo solo con los cambios)")
+        elif os.path.exists(filename) and not messagebox.askyesno("🔁 Exportar cambios",
+                                                                  f"Se reescribirá {os.path.basename(filename)} con "
+                                                                  f"{len(registros)} registro(s) nuevos o modificados.\n¿Continuar?"):
+            return
+
+        almacen = self.almacen  # El perfil de ahora, aunque se cambie antes de que termine
+
+        def guardar_marca():
+            self.exportacion.confirmar_marca(filename, registros, almacen)
+
+        self.encolar_exportacion(
+            "🔁 Cambios", [filename], registros,
+            f"🔁 {len(registros)} registro(s) nuevos o modificados exportados a:\n{filename}",
+            al_completar=guardar_marca, anexar=anexar
+        )
+
+    def encolar_exportacion(self, descripcion, destinos, registros, mensaje_exito, al_completar=None, **opciones):
+        """Encolar una exportación para ejecutarla en segundo plano"""
+        self.exportacion.encolar(descripcion, destinos, registros, mensaje_exito, al_completar, **opciones)
+        if self._exportaciones_after is None:
+            self.actualizar_exportaciones()
+
+    def actualizar_exportaciones(self):
+        """Refrescar el progreso y notificar las exportaciones terminadas"""
+        terminados = self.exportacion.cola.recoger_terminados()
+        pendientes = self.exportacion.cola.pendientes()
+
+        if pendientes:
+            actual = pendientes[0]
+            texto = f"{actual.descripcion}: {actual.escritos}/{actual.total} filas"
+            if len(pendientes) > 1:
+                texto += f" • {len(pendientes) - 1} en cola"
+            self.exportacion_label.configure(text=texto)
+            self.exportacion_progress.configure(maximum=max(actual.total, 1), value=actual.escritos)
+            if not self.exportacion_frame.winfo_ismapped():
+                self.exportacion_frame.pack(fill=tk.X, pady=(15, 0))
+            self._exportaciones_after = self.root.after(150, self.actualizar_exportaciones)
+        else:
+            self.exportacion_frame.pack_forget()
+            self._exportaciones_after = None
+
+        for trabajo in terminados:
+            if trabajo.estado == "completado":
+                if trabajo.al_completar:
+                    trabajo.al_completar()
+                messagebox.showinfo("✅ Éxito", trabajo.mensaje_exito)
+            elif trabajo.estado == "cancelado":
+                messagebox.showinfo("⏹️ Cancelada", f"{trabajo.descripcion}: exportación cancelada.\nNo se ha dejado ningún archivo parcial.")
+            else:
+                messagebox.showerror("❌ Error", trabajo.error)
+
+    def cancelar_exportacion_actual(self):
+        """Cancelar la exportación que se está ejecutando"""
+        pendientes = self.exportacion.cola.pendientes()
+        if pendientes:
+            pendientes[0].cancelar.set()
+
+    def iniciar_api(self):
+        """Arrancar la API HTTP local (API_PUERTO, API_HOST y API_TOKEN del .env)"""
+        try:
+            self.servidor_api = ServidorAPI(
+                self.almacen, self.analisis, self.estadisticas,
+                host=os.getenv('API_HOST', '127.0.0.1'), puerto=int(os.getenv('API_PUERTO')),
+                token=os.getenv('API_TOKEN')
+            ).iniciar()
+        except (OSError, ValueError) as e:
+            messagebox.showerror("❌ API", f"No se pudo arrancar la API HTTP:\n{str(e)}")
+            return
+        if self.servidor_api.expuesta:
+            messagebox.showwarning("⚠️ API", f"La API escucha en {self.servidor_api.host} sin API_TOKEN: "
+                                             "cualquiera en la red puede leer y modificar tus registros.")
+        self.api_label.pack(fill=tk.X, pady=(10, 0))
+        self._version_vista = self.almacen.version
+        self.vigilar_api()
+
+    def vigilar_api(self):
+        """Mostrar en la ventana los cambios que llegan por la API"""
+        if self.almacen.version != self._version_vista:
+            self._version_vista = self.almacen.version
+            self.api_label.configure(text=f"🌐 API en {self.servidor_api.direccion} • "
+                                          f"último cambio {datetime.now().strftime('%H:%M:%S')}")
+        elif not self.api_label.cget("text"):
+            self.api_label.configure(text=f"🌐 API en {self.servidor_api.direccion}")
+        self.root.after(1000, self.vigilar_api)
+
+    def instrumentar(self):
+        """Sustituir las acciones de la interfaz por versiones medidas por el perfilador"""
+        nombres = set(self.ACCIONES_PERFILADAS)
+        nombres.update(n for n in dir(type(self)) if n.startswith("exportar_"))
+        for nombre in sorted(nombres):
+            setattr(self, nombre, self.perfilador.envolver(nombre, getattr(self, nombre)))
+
+    def mostrar_rendimiento(self):
+        """Mostrar las acciones más lentas (perfilador) y los bloqueos del bucle principal (vigilante)"""
+        ventana = tk.Toplevel(self.root)
+        ventana.title("📈 Rendimiento")
+        ventana.geometry("900x600")
+        notebook = ttk.Notebook(ventana)
+        notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        if self.perfilador:
+            pestana = ttk.Frame(notebook, padding="10")
+            notebook.add(pestana, text="📈 Acciones")
+            self._pestana_acciones(pestana)
+        if self.vigilante:
+            pestana = ttk.Frame(notebook, padding="10")
+            notebook.add(pestana, text="🧊 Bloqueos")
+            self._pestana_bloqueos(pestana)
+
+    def _pestana_acciones(self, main_frame):
+        ttk.Label(main_frame, text="📈 Acciones más lentas", font=("Arial", 14, "bold")).pack(anchor="w")
+        ttk.Label(main_frame, text=f"Traza completa: {self.perfilador.ruta}   "
+                                   "(el tiempo incluye la espera en los diálogos que abre la acción)",
+                  foreground="gray", font=("Arial", 9)).pack(anchor="w", pady=(0, 10))
+
+        tree = ttk.Treeview(main_frame, columns=("segundos", "momento", "memoria", "error"), height=12)
+        tree.heading("#0", text="Acción")
+        tree.heading("segundos", text="Duración")
+        tree.heading("momento", text="Cuándo")
+        tree.heading("memoria", text="Pico memoria")
+        tree.heading("error", text="Error")
+        tree.column("#0", width=220)
+        tree.column("segundos", width=90, anchor="e")
+        tree.column("momento", width=160, anchor="center")
+        tree.column("memoria", width=110, anchor="e")
+        tree.column("error", width=250)
+        tree.pack(fill=tk.BOTH, expand=True)
+
+        detalle = tk.Text(main_frame, height=12, font=("Courier", 9), wrap="none")
+        detalle.pack(fill=tk.BOTH, expand=True, pady=(10, 0))
+
+        entradas = {}
+
+        def cargar():
+            tree.delete(*tree.get_children())
+            entradas.clear()
+            for entrada in self.perfilador.mas_lentas():
+                memoria = entrada.get("memoria")
+                item = tree.insert("", "end", text=entrada["accion"], values=(
+                    f"{entrada['segundos'] * 1000:.0f} ms", entrada["momento"][:19].replace("T", " "),
+                    f"{memoria['pico_kb']} KB" if memoria else "", entrada.get("error", "")
+                ))
+                entradas[item] = entrada
+
+        def mostrar_detalle(event=None):
+            seleccion = tree.selection()
+            detalle.delete("1.0", tk.END)
+            if not seleccion:
+                return
+            entrada = entradas[seleccion[0]]
+            lineas = []
+            if entrada.get("cprofile"):
+                lineas.append(f"{'acumulado':>10} {'propio':>10} {'llamadas':>9}  función")
+                lineas += [f"{f['acumulado']:10.4f} {f['propio']:10.4f} {f['llamadas']:9}  {f['funcion']}"
+                           for f in entrada["cprofile"]]
+            if entrada.get("memoria"):
+                lineas.append(f"\nMemoria retenida: {entrada['memoria']['retenida_kb']} KB")
+                lineas += [f"{l['kb']:8} KB  {l['linea']}" for l in entrada["memoria"]["lineas"]]
+            if not lineas:
+                lineas.append("Activa PERFILADO=cprofile,tracemalloc para ver funciones y memoria de cada acción")
+            detalle.insert("1.0", "\n".join(lineas))
+
+        tree.bind("<<TreeviewSelect>>", mostrar_detalle)
+        ttk.Button(main_frame, text="🔄 Actualizar", command=cargar).pack(anchor="e", pady=(10, 0))
+        cargar()
+
+    def _pestana_bloqueos(self, main_frame):
+        ttk.Label(main_frame, text="🧊 Bloqueos del bucle principal", font=("Arial", 14, "bold")).pack(anchor="w")
+        ttk.Label(main_frame, text=f"Registro completo: {self.vigilante.ruta}",
+                  foreground="gray", font=("Arial", 9)).pack(anchor="w", pady=(0, 10))
+        histograma = ttk.Label(main_frame, text="", font=("Courier", 9), justify=tk.LEFT)
+        histograma.pack(anchor="w", pady=(0, 10))
+
+        tree = ttk.Treeview(main_frame, columns=("segundos", "donde"), height=8)
+        tree.heading("#0", text="Cuándo")
+        tree.heading("segundos", text="Duración")
+        tree.heading("donde", text="Código en ejecución")
+        tree.column("#0", width=160)
+        tree.column("segundos", width=90, anchor="e")
+        tree.column("donde", width=580)
+        tree.pack(fill=tk.BOTH, expand=True)
+
+        detalle = tk.Text(main_frame, height=12, font=("Courier", 9), wrap="none")
+        detalle.pack(fill=tk.BOTH, expand=True, pady=(10, 0))
+
+        entradas = {}
+
+        def cargar():
+            histograma.configure(text=self.vigilante.informe())
+            tree.delete(*tree.get_children())
+            entradas.clear()
+            for entrada in reversed(self.vigilante.recientes):
+                # La última línea de la pila suele ser la más útil: dónde estaba parado el hilo de Tk
+                donde = entrada["pila"][-1].strip().splitlines()[0] if entrada["pila"] else ""
+                item = tree.insert("", "end", text=entrada["momento"][:19].replace("T", " "),
+                                   values=(f"{entrada['segundos'] * 1000:.0f} ms", donde))
+                entradas[item] = entrada
+
+        def mostrar_detalle(event=None):
+            seleccion = tree.selection()
+            detalle.delete("1.0", tk.END)
+            if seleccion:
+                detalle.insert("1.0", "\n".join(entradas[seleccion[0]]["pila"]) or "(sin pila capturada)")
+
+        tree.bind("<<TreeviewSelect>>", mostrar_detalle)
+        ttk.Button(main_frame, text="🔄 Actualizar", command=cargar).pack(anchor="e", pady=(10, 0))
+        cargar()
+
+    def actualizar_lista_perfiles(self):
+        self._claves_perfil = self.perfiles.claves()
+        self.perfil_combo.configure(values=[self.perfiles.nombre(c) for c in self._claves_perfil])
+        self.perfil_var.set(self.perfiles.nombre(self.perfiles.activo))
+
+    def cambiar_perfil(self, clave=None):
+        """Pasar a otro perfil: se carga su archivo y el anterior se libera de memoria"""
+        if clave is None:
+            clave = self._claves_perfil[self.perfil_combo.current()]
+        if clave == self.perfiles.activo:
+            return
+        try:
+            self.almacen = self.perfiles.activar(clave)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("❌ Error", f"No se pudo cargar el perfil:\n{str(e)}")
+            self.actualizar_lista_perfiles()
+            return
+        self.analisis.almacen = self.almacen
+        self.estadisticas = ServicioEstadisticas(self.almacen)
+        self.exportacion.almacen = self.almacen  # La cola sigue con los trabajos ya encolados
+        if self.servidor_api is not None:
+            self.servidor_api.almacen, self.servidor_api.estadisticas = self.almacen, self.estadisticas
+            self._version_vista = self.almacen.version
+        self.limpiar_formulario()
+        self.actualizar_lista_perfiles()
+        self.root.title(f"{os.getenv('APP_NAME', 'Control de Azúcar y Alimentación')} — {self.perfiles.nombre(clave)}")
+
+    def crear_perfil(self):
+        """Dar de alta un perfil nuevo y pasar a él"""
+        from tkinter import simpledialog
+
+        nombre = simpledialog.askstring("👤 Nuevo perfil", "Nombre de la persona:", parent=self.root)
+        if nombre is None:
+            return
+        try:
+            clave = self.perfiles.crear(nombre)
+        except (ErrorValidacion, OSError) as e:
+            messagebox.showerror("❌ Error", str(e))
+            return
+        self.cambiar_perfil(clave)
+
+    def mostrar_perfiles(self):
+        """Comparar las estadísticas de todos los perfiles (calculadas en paralelo)"""
+        ventana = tk.Toplevel(self.root)
+        ventana.title("👥 Comparar perfiles")
+        ventana.geometry("760x320")
+        main_frame = ttk.Frame(ventana, padding="10")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+        estado = ttk.Label(main_frame, text="⏳ Calculando...", font=("Arial", 10, "italic"))
+        estado.pack(anchor="w", pady=(0, 10))
+
+        columnas = (("registros", "Registros", 80), ("lecturas", "Lecturas", 80), ("media", "Media", 80),
+                    ("tir", "En rango", 80), ("tbr", "Bajo", 70), ("tar", "Alto", 70), ("gmi", "GMI", 70))
+        tree = ttk.Treeview(main_frame, columns=[c for c, _, _ in columnas], height=10)
+        tree.heading("#0", text="👤 Perfil")
+        tree.column("#0", width=160)
+        for clave, texto, ancho in columnas:
+            tree.heading(clave, text=texto)
+            tree.column(clave, width=ancho, anchor="center")
+        tree.pack(fill=tk.BOTH, expand=True)
+
+        resultado = {}
+
+        def calcular():
             try:
-                from openpyxl import Workbook
-                from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-                from openpyxl.utils import get_column_letter
-                from datetime import datetime as dt
-
-                # Crear libro de trabajo
-                wb = Workbook()
-                ws = wb.active
-                ws.title = "Control de Azúcar"
-
-                # Configurar estilos
-                header_font = Font(bold=True, color="FFFFFF")
-                header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-                border = Border(
-                    left=Side(style='thin'),
-                    right=Side(style='thin'),
-                    top=Side(style='thin'),
-                    bottom=Side(style='thin')
-                )
-
-                # Título del documento
-                ws['A1'] = "📊 CONTROL DE AZÚCAR Y ALIMENTACIÓN"
-                ws['A1'].font = Font(bold=True, size=16, color="4472C4")
-                ws.merge_cells('A1:F1')
-                ws['A1'].alignment = Alignment(horizontal='center')
-
-                # Información del reporte
-                ws['A2'] = f"📅 Generado el: {dt.now().strftime('%d/%m/%Y %H:%M')}"
-                ws['A2'].font = Font(size=10, italic=True)
-                ws['A3'] = f"📊 Total de registros: {len(self.datos['registros'])}"
-                ws['A3'].font = Font(size=10, italic=True)
-
-                # Encabezados de la tabla (fila 5)
-                headers = ['📅 Fecha', '🕐 Hora', '🍽️ Comida', '� Azúcar Antes', '�📈 Azúcar Después', '🥗 Alimentos', '📊 Estado']
-                for col, header in enumerate(headers, 1):
-                    cell = ws.cell(row=5, column=col, value=header)
-                    cell.font = header_font
-                    cell.fill = header_fill
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-                    cell.border = border
-
-                # Datos de los registros
-                for row, registro in enumerate(self.datos["registros"], start=6):
-                    # Usar nombre_comida si existe, sino usar tipo_comida para compatibilidad
-                    nombre_comida = registro.get("nombre_comida", registro.get("tipo_comida", "Sin nombre"))
-                    alimentos_str = ', '.join(registro['alimentos'])
-                    
-                    # Obtener valores de azúcar
-                    azucar_antes = registro.get('azucar_antes', '')
-                    azucar_despues = registro.get('azucar_despues', '')
-                    nivel_azucar_legacy = registro.get('nivel_azucar')  # Para compatibilidad
-                    
-                    # Determinar estado del azúcar basado en cualquier valor disponible
-                    niveles_para_estado = []
-                    if azucar_antes:
-                        niveles_para_estado.append(azucar_antes)
-                    if azucar_despues:
-                        niveles_para_estado.append(azucar_despues)
-                    if nivel_azucar_legacy and not niveles_para_estado:
-                        niveles_para_estado.append(nivel_azucar_legacy)
-                    
-                    if niveles_para_estado:
-                        nivel_para_estado = max(niveles_para_estado)  # Usar el más alto para determinar estado
-                        if nivel_para_estado < 70:
-                            estado = "🔻 Bajo"
-                            estado_color = "FF6B6B"
-                        elif nivel_para_estado <= 140:
-                            estado = "✅ Normal"
-                            estado_color = "51CF66"
-                        elif nivel_para_estado <= 200:
-                            estado = "⚠️ Alto"
-                            estado_color = "FFD43B"
-                        else:
-                            estado = "🔴 Muy Alto"
-                            estado_color = "FF6B6B"
-                    else:
-                        estado = "❓ Sin datos"
-                        estado_color = "CCCCCC"
+                resultado["datos"] = self.perfiles.resumen_todos()
+            except Exception as e:
+                resultado["error"] = e
+
+        hilo = threading.Thread(target=calcular, daemon=True)
+        hilo.start()
+
+        def fila(nombre, datos, **opciones):
+            valores = [datos.get("registros", ""), datos.get("lecturas", "")]
+            if datos.get("media") is not None:
+                valores += [f"{datos['media']:.1f}", f"{datos['tir']:.1f}%", f"{datos['tbr']:.1f}%",
+                            f"{datos['tar']:.1f}%", f"{datos['gmi']:.1f}%"]
+            tree.insert("", "end", text=nombre, values=valores, **opciones)
+
+        def comprobar():
+            if not ventana.winfo_exists():
+                return
+            if hilo.is_alive():
+                ventana.after(100, comprobar)
+                return
+            if "error" in resultado:
+                estado.configure(text=f"❌ {resultado['error']}")
+                return
+            datos = resultado["datos"]
+            for clave, resumen in datos["perfiles"].items():
+                fila(self.perfiles.nombre(clave), {"registros": resumen["registros"], **(resumen["glucosa"] or {})})
+            tree.tag_configure("total", font=("Arial", 10, "bold"))
+            fila("Σ Todos", datos["total"], tags=("total",))
+            estado.configure(text=f"📊 {len(datos['perfiles'])} perfiles")
+
+        comprobar()
+
+    def vigilar_archivo(self):
+        """Recargar en caliente los cambios que otro proceso guarde en el archivo de datos"""
+        try:
+            cambios = self.almacen.recargar_si_cambio()
+        except (OSError, ValueError) as e:
+            # Archivo bloqueado o a medio copiar por otro programa: se reintenta en la siguiente vuelta
+            print(f"Error al recargar datos: {e}")
+            cambios = None
+        if cambios:
+            añadidos, quitados, cambiados = cambios
+            self.sincronizacion_label.configure(
+                text=f"🔄 {datetime.now().strftime('%H:%M:%S')} cambios de otra instancia: "
+                     f"+{añadidos} −{quitados} ✏️{cambiados}")
+            if not self.sincronizacion_label.winfo_ismapped():
+                self.sincronizacion_label.pack(side=tk.BOTTOM, fill=tk.X, before=self.root.pack_slaves()[0])
+        self.root.after(self.INTERVALO_VIGILANCIA, self.vigilar_archivo)
+
+    def importar_cgm(self):
+        """Importar un CSV de sensor continuo al almacén de series temporales"""
+        filename = filedialog.askopenfilename(
+            title="Importar lecturas del sensor (CGM)",
+            filetypes=[("Archivos CSV", "*.csv"), ("Archivos de texto", "*.txt"), ("Todos los archivos", "*.*")]
+        )
+        if not filename:
+            return
 
-                    # Formatear valores para mostrar
-                    azucar_antes_str = f"{azucar_antes} mg/dL" if azucar_antes else "-"
-                    azucar_despues_str = f"{azucar_despues} mg/dL" if azucar_despues else "-"
-                    
-                    # Para compatibilidad con registros antiguos
-                    if nivel_azucar_legacy and not azucar_antes and not azucar_despues:
-                        azucar_antes_str = f"{nivel_azucar_legacy} mg/dL (legacy)"
-                        azucar_despues_str = "-"
-
-                    # Escribir datos
-                    datos_fila = [
-                        registro['fecha'],
-                        registro['hora'],
-                        nombre_comida,
-                        azucar_antes_str,
-                        azucar_despues_str,
-                        alimentos_str,
-                        estado
-                    ]
-
-                    for col, valor in enumerate(datos_fila, 1):
-                        cell = ws.cell(row=row, column=col, value=valor)
-                        cell.border = border
-                        cell.alignment = Alignment(vertical='center')
-                        
-                        # Colorear la celda de estado según el nivel de azúcar
-                        if col == 7:  # Columna de estado (ahora es la 7ª columna)
-                            cell.fill = PatternFill(start_color=estado_color, end_color=estado_color, fill_type="solid")
-                            cell.font = Font(bold=True, color="FFFFFF")
-                            cell.alignment = Alignment(horizontal='center', vertical='center')
-
-                # Ajustar ancho de columnas
-                column_widths = [12, 8, 20, 15, 15, 40, 12]
-                for col, width in enumerate(column_widths, 1):
-                    ws.column_dimensions[get_column_letter(col)].width = width
-
-                # Agregar hoja de estadísticas
-                stats_ws = wb.create_sheet("📊 Estadísticas")
-                
-                # Estadísticas básicas - recopilar todos los niveles de azúcar
-                todos_los_niveles = []
-                for r in self.datos["registros"]:
-                    if r.get('azucar_antes'):
-                        todos_los_niveles.append(r['azucar_antes'])
-                    if r.get('azucar_despues'):
-                        todos_los_niveles.append(r['azucar_despues'])
-                    if r.get('nivel_azucar') and not r.get('azucar_antes') and not r.get('azucar_despues'):
-                        todos_los_niveles.append(r['nivel_azucar'])
-                
-                if todos_los_niveles:
-                    promedio = sum(todos_los_niveles) / len(todos_los_niveles)
-                    maximo = max(todos_los_niveles)
-                    minimo = min(todos_los_niveles)
-                    
-                    normal_count = len([n for n in todos_los_niveles if 70 <= n <= 140])
-                    alto_count = len([n for n in todos_los_niveles if n > 140])
-                    bajo_count = len([n for n in todos_los_niveles if n < 70])
-
-                    stats_data = [
-                        ["📊 ESTADÍSTICAS DE AZÚCAR", ""],
-                        ["", ""],
-                        ["📈 Nivel promedio", f"{promedio:.1f} mg/dL"],
-                        ["🔺 Nivel máximo", f"{maximo} mg/dL"],
-                        ["🔻 Nivel mínimo", f"{minimo} mg/dL"],
-                        ["", ""],
-                        ["📊 DISTRIBUCIÓN", ""],
-                        ["✅ Registros normales (70-140)", normal_count],
-                        ["⚠️ Registros altos (>140)", alto_count],
-                        ["🔻 Registros bajos (<70)", bajo_count],
-                        ["", ""],
-                        ["📈 Porcentaje normal", f"{(normal_count/len(todos_los_niveles)*100):.1f}%"],
-                        ["⚠️ Porcentaje alto", f"{(alto_count/len(todos_los_niveles)*100):.1f}%"],
-                        ["🔻 Porcentaje bajo", f"{(bajo_count/len(todos_los_niveles)*100):.1f}%"]
-                    ]
-
-                    for row, (label, value) in enumerate(stats_data, 1):
-                        stats_ws.cell(row=row, column=1, value=label).font = Font(bold=True)
-                        stats_ws.cell(row=row, column=2, value=value)
-                    
-                    # Ajustar anchos
-                    stats_ws.column_dimensions['A'].width = 25
-                    stats_ws.column_dimensions['B'].width = 15
+        # El CSV se lee en un hilo; la fusión en el almacén se hace en el hilo de Tk
+        resultado = {}
+        inicio = time.perf_counter()
 
-                # Guardar archivo
-                wb.save(filename)
-                messagebox.showinfo("✅ Éxito", f"📊 Datos exportados correctamente a Excel:\n{filename}\n\nSe incluyeron:\n• Hoja principal con datos\n• Hoja de estadísticas\n• Formato con colores según niveles")
-                
-            except ImportError:
-                messagebox.showerror("❌ Error", "La librería openpyxl no está instalada.\nEjecuta: pip install openpyxl")
+        def leer():
+            try:
+                resultado["lecturas"] = leer_csv_cgm(filename)
             except Exception as e:
-                messagebox.showerror("❌ Error", f"Error al exportar a Excel: {str(e)}")
+                resultado["error"] = e
+
+        hilo = threading.Thread(target=leer, daemon=True)
+        hilo.start()
+        self.root.config(cursor="watch")
+
+        def comprobar():
+            if hilo.is_alive():
+                self.root.after(100, comprobar)
+                return
+            self.root.config(cursor="")
+            if "error" in resultado:
+                messagebox.showerror("❌ Error", f"No se pudo importar el archivo:\n{resultado['error']}")
+                return
+            minutos, decimas, descartadas = resultado["lecturas"]
+            try:
+                nuevas = self.almacen.importar_cgm(minutos, decimas)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("❌ Error", f"No se pudo guardar el almacén CGM:\n{str(e)}")
+                return
+            messagebox.showinfo("✅ Importación completada",
+                                f"📡 Lecturas en el archivo: {len(minutos)}\n"
+                                f"➕ Nuevas: {nuevas}   🔁 Ya importadas: {len(minutos) - nuevas}\n"
+                                f"⚠️ Filas descartadas: {descartadas}\n"
+                                f"⏱️ {time.perf_counter() - inicio:.1f} s · {len(self.almacen.cgm)} lecturas en total")
+
+        comprobar()
+
+# ---------------------------------------------------------------------------
+# Línea de comandos: python control_azucar_app.py ingest|query|export|stats
+# ---------------------------------------------------------------------------
+
+# Códigos de salida
+SALIDA_OK = 0
+SALIDA_ERROR = 1             # error de E/S, archivo corrupto, exportación fallida
+SALIDA_USO = 2               # argumentos inválidos (el mismo que usa argparse)
+SALIDA_FILAS_RECHAZADAS = 3  # ingest: alguna fila no se pudo importar
+SALIDA_SIN_DATOS = 4         # query/export/stats: ningún registro en el filtro
+SALIDA_INTERRUMPIDA = 130    # Ctrl+C
+
+SUBCOMANDOS = ("ingest", "query", "export", "stats", "serve", "fotos")
+
+_FORMATOS_FECHA_GLUCOMETRO = _FORMATOS_FECHA_CGM + ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%m/%d/%Y")
+
+def _columna(cabecera, *claves):
+    """Índice de la primera columna cuyo nombre normalizado contiene alguna clave"""
+    for i, nombre in enumerate(cabecera):
+        if any(clave in nombre for clave in claves):
+            return i
+    return None
+
+def leer_csv_glucometro(archivo, como="antes"):
+    """
+    Leer en streaming un CSV de glucómetro y generar `(linea, datos, error)`.
+
+    Reconoce columnas de fecha y hora (juntas o separadas), azúcar antes y
+    después, o una única columna de glucosa que se guarda como `como`
+    ("antes" o "despues"), y opcionalmente comida y alimentos (separados por
+    ";" o "|"). `datos` es un dict con los argumentos de `crear_registro`.
+    """
+    import csv
+
+    lector = csv.reader(archivo)
+    cabecera = [normalizar_alimento(c) for c in next(lector, [])]
+    col_fecha = _columna(cabecera, "fecha", "date", "timestamp")
+    col_hora = _columna(cabecera, "hora", "time")
+    if col_hora == col_fecha:
+        col_hora = None
+    col_antes = _columna(cabecera, "antes", "before", "pre")
+    col_despues = _columna(cabecera, "despues", "after", "post")
+    col_glucosa = _columna(cabecera, "glucosa", "glucose", "nivel", "valor", "mg/dl", "resultado")
+    col_comida = _columna(cabecera, "comida", "meal", "nombre")
+    col_alimentos = _columna(cabecera, "alimentos", "foods")
+    if col_fecha is None or (col_antes is None and col_despues is None and col_glucosa is None):
+        raise ValueError("El CSV necesita una columna de fecha y otra de glucosa (o antes/después)")
+    if col_antes is None and col_despues is None:
+        col_antes, col_despues = (col_glucosa, None) if como == "antes" else (None, col_glucosa)
+
+    formato = None
+    for linea, fila in enumerate(lector, start=2):
+        if not any(campo.strip() for campo in fila):
+            continue
+        try:
+            texto = fila[col_fecha].strip()
+            if col_hora is not None and fila[col_hora].strip():
+                texto = f"{texto} {fila[col_hora].strip()}"
+            try:
+                momento = datetime.fromisoformat(texto)
+            except ValueError:
+                momento = None
+                for candidato in ((formato,) if formato else ()) + _FORMATOS_FECHA_GLUCOMETRO:
+                    try:
+                        momento = datetime.strptime(texto, candidato)
+                        formato = candidato
+                        break
+                    except ValueError:
+                        continue
+            if momento is None:
+                raise ErrorValidacion(f"Fecha no reconocida: {texto!r}")
+            alimentos = []
+            if col_alimentos is not None and fila[col_alimentos].strip():
+                alimentos = [a.strip() for a in fila[col_alimentos].replace("|", ";").split(";") if a.strip()]
+            yield linea, {
+                "nombre_comida": fila[col_comida].strip() if col_comida is not None else "",
+                "alimentos": alimentos,
+                "azucar_antes": fila[col_antes].replace(",", ".") if col_antes is not None else None,
+                "azucar_despues": fila[col_despues].replace(",", ".") if col_despues is not None else None,
+                "metadata": {"fecha": momento.strftime("%Y-%m-%d"), "hora": momento.strftime("%H:%M"),
+                             "datetime": momento, "fuente": "Importado"},
+            }, None
+        except (IndexError, ErrorValidacion) as e:
+            yield linea, None, str(e) if isinstance(e, ErrorValidacion) else "Faltan columnas"
+
+def _abrir_entrada(ruta):
+    if ruta == "-":
+        return sys.stdin
+    return open(ruta, 'r', encoding='utf-8-sig', newline='')
+
+def _filtrar(almacen, args):
+    """Generador de los registros que cumplen los filtros comunes de query/export"""
+    comida = normalizar_alimento(args.comida) if getattr(args, "comida", None) else None
+    alimento = None
+    if getattr(args, "alimento", None):
+        alimento = almacen.normalizador.resolver(args.alimento, crear=False) or normalizar_alimento(args.alimento)
+    if getattr(args, "en", None):
+        # Historial tal como estaba en ese momento
+        registros = (r for r in almacen.vista(args.en)
+                     if (args.desde is None or r.get("fecha", "") >= args.desde)
+                     and (args.hasta is None or r.get("fecha", "") <= args.hasta))
+    else:
+        registros = almacen.rango(args.desde, args.hasta)
+    for registro in registros:
+        if comida and comida not in normalizar_alimento(registro.get("nombre_comida") or ""):
+            continue
+        if alimento and alimento not in (registro.get("alimentos_ids") or []):
+            continue
+        yield registro
+
+def _cli_ingest(almacen, args):
+    if args.cgm:
+        total_nuevas = 0
+        for ruta in args.archivos:
+            minutos, decimas, descartadas = leer_csv_cgm(ruta)
+            nuevas = almacen.importar_cgm(minutos, decimas)
+            total_nuevas += nuevas
+            print(f"📡 {ruta}: {len(minutos)} lecturas, {nuevas} nuevas, {descartadas} filas descartadas", file=sys.stderr)
+        return SALIDA_OK
+
+    existentes = {(r.get("timestamp", "")[:16], r.get("azucar_antes"), r.get("azucar_despues"))
+                  for r in almacen.registros}
+    nuevos, rechazadas, duplicadas = [], 0, 0
+    for ruta in args.archivos:
+        with _abrir_entrada(ruta) as archivo:
+            for linea, datos, error in leer_csv_glucometro(archivo, args.como):
+                try:
+                    if error:
+                        raise ErrorValidacion(error)
+                    if not datos["nombre_comida"]:
+                        franja = almacen.determinar_comida_por_hora(datos["metadata"]["hora"])
+                        datos["nombre_comida"] = franja.capitalize() if franja else "Lectura"
+                    registro = almacen.crear_registro(**datos, requiere_alimentos=False)
+                except ErrorValidacion as e:
+                    rechazadas += 1
+                    print(f"⚠️ {ruta}:{linea}: {e}", file=sys.stderr)
+                    continue
+                clave = (registro["timestamp"][:16], registro["azucar_antes"], registro["azucar_despues"])
+                if clave in existentes:
+                    duplicadas += 1
+                    continue
+                existentes.add(clave)
+                nuevos.append(registro)
+
+    if rechazadas and args.estricto:
+        print(f"❌ {rechazadas} fila(s) rechazadas; no se ha importado nada (--estricto)", file=sys.stderr)
+        return SALIDA_FILAS_RECHAZADAS
+    alertas = almacen.agregar_lote(nuevos) if nuevos else []
+    print(f"✅ {len(nuevos)} registro(s) importados, {duplicadas} duplicados, {rechazadas} rechazados, "
+          f"{len(alertas)} alerta(s)", file=sys.stderr)
+    return SALIDA_FILAS_RECHAZADAS if rechazadas else SALIDA_OK
+
+def _cli_query(almacen, args):
+    registros = _filtrar(almacen, args)
+    if args.limite is not None:
+        registros = itertools.islice(registros, args.limite)
+    if args.formato == "tabla":
+        escritos = 0
+        for registro in registros:
+            fila = materializar_fila(registro)
+            niveles = f"{'' if fila['azucar_antes'] is None else fila['azucar_antes']:>6} → " \
+                      f"{'' if fila['azucar_despues'] is None else fila['azucar_despues']:<6}"
+            print(f"{fila['fecha']} {fila['hora']}  {fila['nombre_comida'][:20]:20}  {niveles}  {fila['alimentos_str']}")
+            escritos += 1
+    else:
+        contador = {"escritos": 0}
+
+        def contar(registros):
+            for registro in registros:
+                contador["escritos"] += 1
+                yield registro
+
+        sumidero = SumideroCSV("-") if args.formato == "csv" else SumideroJSONL("-")
+        ejecutar_exportacion(contar(registros), [sumidero], None)
+        escritos = contador["escritos"]
+    return SALIDA_OK if escritos else SALIDA_SIN_DATOS
+
+def _cli_export(almacen, args):
+    servicio = ServicioExportacion(almacen)
+    try:
+        for destino in args.destinos:
+            clase_sumidero(destino)
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return SALIDA_USO
+    if args.cambios:
+        if len(args.destinos) != 1:
+            print("❌ --cambios necesita un único destino", file=sys.stderr)
+            return SALIDA_USO
+        registros, _ = servicio.cambios(args.destinos[0])
+    else:
+        registros = list(_filtrar(almacen, args))
+    if not registros:
+        print("ℹ️ No hay registros para exportar", file=sys.stderr)
+        return SALIDA_SIN_DATOS
+
+    trabajo = servicio.encolar("export", args.destinos, registros, "", anexar=args.anexar)
+    try:
+        while trabajo.estado in ("en cola", "exportando"):
+            time.sleep(0.2)
+            if sys.stderr.isatty():
+                print(f"\r📤 {trabajo.escritos}/{trabajo.total}", end="", file=sys.stderr)
+    except KeyboardInterrupt:
+        servicio.cola.cancelar_todo()
+        print("\n⏹️ Exportación cancelada", file=sys.stderr)
+        return SALIDA_INTERRUMPIDA
+    if sys.stderr.isatty():
+        print(file=sys.stderr)
+    if trabajo.estado != "completado":
+        print(f"❌ {trabajo.error}", file=sys.stderr)
+        return SALIDA_ERROR
+    if args.cambios:
+        servicio.confirmar_marca(args.destinos[0], registros)
+    print(f"✅ {trabajo.total} registro(s) exportados a {', '.join(args.destinos)}", file=sys.stderr)
+    return SALIDA_OK
+
+def _cli_stats_perfiles(perfiles, args):
+    datos = perfiles.resumen_todos(args.desde, args.hasta, tuple(args.objetivo))
+    if args.json:
+        print(json.dumps(datos, ensure_ascii=False, indent=2, default=str))
+    else:
+        filas = [(perfiles.nombre(c), {"registros": r["registros"], **(r["glucosa"] or {})})
+                 for c, r in datos["perfiles"].items()] + [("Σ Todos", datos["total"])]
+        for nombre, e in filas:
+            linea = f"👤 {nombre[:20]:20} {e['registros']:7} registros"
+            if e.get("media") is not None:
+                linea += f"   media {e['media']:6.1f}   en rango {e['tir']:5.1f}%   GMI {e['gmi']:.1f}%"
+            print(linea)
+    return SALIDA_OK if datos["total"]["lecturas"] else SALIDA_SIN_DATOS
+
+def _cli_stats(almacen, args):
+    resumen = ServicioEstadisticas(almacen).resumen(args.desde, args.hasta, tuple(args.objetivo))
+    if args.json:
+        print(json.dumps(resumen, ensure_ascii=False, indent=2, default=str))
+    else:
+        e = resumen["glucosa"]
+        print(f"📊 Registros: {resumen['registros']}")
+        if e:
+            p = e["percentiles"]
+            print(f"Lecturas: {e['lecturas']}   Media: {e['media']:.1f} mg/dL   DE: {e['desviacion']:.1f}   "
+                  f"CV: {e['cv']:.1f}%   GMI: {e['gmi']:.1f}%")
+            print(f"P5 {p[5]:.0f} · P25 {p[25]:.0f} · P50 {p[50]:.0f} · P75 {p[75]:.0f} · P95 {p[95]:.0f}")
+            print(f"En rango: {e['tir']:.1f}%   Bajo: {e['tbr']:.1f}%   Alto: {e['tar']:.1f}%")
+        for fila in resumen["por_comida"]:
+            print(f"  {fila['comida'][:25]:25} {fila['pares']:5} pares   subida media {fila['delta_media']:+.1f}")
+        sensor = resumen["sensor"]
+        if sensor:
+            print(f"📡 Sensor: {sensor['lecturas']} lecturas   Media: {sensor['media']:.1f} mg/dL   "
+                  f"En rango: {sensor['tir']:.1f}%")
+    return SALIDA_OK if resumen["glucosa"] or resumen["sensor"] else SALIDA_SIN_DATOS
+
+def _cli_serve(almacen, args):
+    servidor = ServidorAPI(almacen, ServicioAnalisis(almacen), ServicioEstadisticas(almacen),
+                           host=args.host, puerto=args.puerto, token=args.token).iniciar()
+    print(f"🌐 API en {servidor.direccion} (Ctrl+C para parar)", file=sys.stderr)
+    try:
+        servidor.esperar()
+    finally:
+        servidor.detener()
+    return SALIDA_OK
+
+def _cli_fotos(almacen, args):
+    if not (args.importar or args.limpiar):
+        print("❌ Indica --importar y/o --limpiar", file=sys.stderr)
+        return SALIDA_USO
+    if args.importar:
+        importadas, fallidas = almacen.importar_fotos_existentes()
+        print(f"🖼️ {importadas} foto(s) pasadas al almacén, {fallidas} no encontradas", file=sys.stderr)
+    if args.limpiar:
+        borrados, liberados = almacen.recolectar_fotos(args.dias)
+        print(f"🧹 {borrados} archivo(s) sin usar borrados, {liberados / 1024 / 1024:.1f} MB liberados", file=sys.stderr)
+    return SALIDA_OK
+
+def crear_parser_cli():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="control_azucar_app.py",
+                                     description="Control de Azúcar y Alimentación (línea de comandos)")
+    parser.add_argument("--datos", default=os.getenv('DATA_FILE', 'control_alimentacion.json'),
+                        help="archivo de datos JSON (por defecto DATA_FILE)")
+    parser.add_argument("--perfil", help="perfil (nombre o clave); por defecto el activo en la app")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    def fecha(texto):
+        datetime.strptime(texto, "%Y-%m-%d")
+        return texto
+
+    def momento(texto):
+        return datetime.fromisoformat(texto).isoformat(timespec="seconds")
+
+    def filtros(sub):
+        sub.add_argument("--desde", type=fecha, help="AAAA-MM-DD")
+        sub.add_argument("--hasta", type=fecha, help="AAAA-MM-DD (incluida)")
+        sub.add_argument("--comida", help="texto contenido en el nombre de la comida")
+        sub.add_argument("--alimento", help="alimento (cualquier grafía o alias)")
+
+    ingest = subparsers.add_parser("ingest", help="importar CSV de glucómetro o de sensor continuo")
+    ingest.add_argument("archivos", nargs="+", help="archivos CSV ('-' = entrada estándar)")
+    ingest.add_argument("--como", choices=("antes", "despues"), default="antes",
+                        help="dónde guardar una columna única de glucosa")
+    ingest.add_argument("--cgm", action="store_true", help="los archivos son exportaciones de un sensor continuo")
+    ingest.add_argument("--estricto", action="store_true", help="no importar nada si alguna fila es inválida")
+
+    query = subparsers.add_parser("query", help="consultar registros")
+    filtros(query)
+    query.add_argument("--formato", choices=("jsonl", "csv", "tabla"), default="jsonl")
+    query.add_argument("--limite", type=int)
+    query.add_argument("--en", type=momento, metavar="MOMENTO",
+                       help="el historial tal como estaba en ese momento (AAAA-MM-DD[ HH:MM])")
+
+    export = subparsers.add_parser("export", help="exportar registros a .xlsx, .csv o .jsonl")
+    export.add_argument("destinos", nargs="+")
+    filtros(export)
+    export.add_argument("--cambios", action="store_true", help="solo lo nuevo o modificado desde la última exportación")
+    export.add_argument("--anexar", action="store_true", help="añadir al final de un .csv/.jsonl existente")
+
+    stats = subparsers.add_parser("stats", help="estadísticas de glucosa")
+    stats.add_argument("--desde", type=fecha)
+    stats.add_argument("--hasta", type=fecha)
+    stats.add_argument("--objetivo", type=float, nargs=2, default=list(OBJETIVO_GLUCOSA), metavar=("BAJO", "ALTO"))
+    stats.add_argument("--json", action="store_true")
+    stats.add_argument("--perfiles", action="store_true", help="comparar todos los perfiles (en paralelo)")
+
+    serve = subparsers.add_parser("serve", help="servir la API HTTP local")
+    serve.add_argument("--host", default=os.getenv('API_HOST', '127.0.0.1'),
+                       help="interfaz de escucha (0.0.0.0 = toda la red de casa)")
+    serve.add_argument("--puerto", type=int, default=int(os.getenv('API_PUERTO') or 8765))
+    serve.add_argument("--token", default=os.getenv('API_TOKEN'), help="token exigido en Authorization: Bearer")
+
+    fotos = subparsers.add_parser("fotos", help="mantenimiento del almacén de fotos")
+    fotos.add_argument("--importar", action="store_true", help="pasar al almacén las fotos de registros antiguos")
+    fotos.add_argument("--limpiar", action="store_true", help="borrar las fotos que no usa ningún registro")
+    fotos.add_argument("--dias", type=int, default=30,
+                       help="conservar las fotos de registros borrados hace menos de estos días (para deshacer)")
+    return parser
+
+def ejecutar_cli(argv):
+    """Ejecutar un subcomando y devolver el código de salida"""
+    args = crear_parser_cli().parse_args(argv)
+    try:
+        perfiles = GestorPerfiles(args.datos)
+        if args.comando == "stats" and args.perfiles:
+            return _cli_stats_perfiles(perfiles, args)
+        clave = perfiles.activo
+        if args.perfil:
+            clave = perfiles.buscar(args.perfil)
+            if clave is None:
+                print(f"❌ No existe el perfil '{args.perfil}'", file=sys.stderr)
+                return SALIDA_USO
+        almacen = perfiles.almacen(clave)
+        comando = {"ingest": _cli_ingest, "query": _cli_query, "export": _cli_export, "stats": _cli_stats,
+                   "serve": _cli_serve, "fotos": _cli_fotos}[args.comando]
+        return comando(almacen, args)
+    except KeyboardInterrupt:
+        return SALIDA_INTERRUMPIDA
+    except BrokenPipeError:
+        # La salida se cortó (p. ej. `| head`): no es un error
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return SALIDA_OK
+    except ImportError as e:
+        libreria = (e.name or "").split(".")[0]
+        print(f"❌ La librería {libreria} no está instalada. Ejecuta: pip install {libreria}", file=sys.stderr)
+        return SALIDA_ERROR
+    except (OSError, ValueError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return SALIDA_ERROR
 
 # Función principal
 def main():
     """Función principal para ejecutar la aplicación"""
-    # Verificar que existe el archivo .env
-    if not os.path.exists('.env'):
+    # Subcomandos de línea de comandos: sin ventana
+    if any(arg in SUBCOMANDOS for arg in sys.argv[1:]) or sys.argv[1:2] in (["-h"], ["--help"]):
+        sys.exit(ejecutar_cli(sys.argv[1:]))
+
+    # --tiempos-arranque: imprimir el informe y cerrar al mostrar la ventana;
+    # TIEMPOS_ARRANQUE=1: imprimirlo sin cerrar
+    solo_medir = "--tiempos-arranque" in sys.argv[1:]
+    informar = solo_medir or os.getenv('TIEMPOS_ARRANQUE') == '1'
+
+    if tk is None:
+        print("❌ tkinter no está instalado: la interfaz gráfica no está disponible", file=sys.stderr)
+        return
+
+    inicio = time.perf_counter()
+    root = tk.Tk()
+    TIEMPOS_ARRANQUE["crear ventana Tk"] = time.perf_counter() - inicio
+
+    # Verificar que existe el archivo .env (con la ventana ya creada para no abrir una raíz implícita)
+    if not os.path.exists(ruta_env()):
+        root.withdraw()
         messagebox.showerror("Error de Configuración", 
                            "No se encontró el archivo .env\n\n"
-                           "Crea un archivo .env con tu ABACUS_API_KEY")
+                           "Crea un archivo .env con tu ABACUS_API_KEY", parent=root)
+        root.destroy()
         return
 
-    root = tk.Tk()
     app = ControlAzucarApp(root)
 
+    def primer_frame():
+        TIEMPOS_ARRANQUE["primer frame (total)"] = time.perf_counter() - _INICIO_ARRANQUE
+        if informar:
+            print(informe_arranque(), file=sys.stderr)
+        if solo_medir:
+            root.destroy()
+
+    # after_idle + after(0): se ejecuta después de que Tk haya dibujado la ventana por primera vez
+    root.after_idle(lambda: root.after(0, primer_frame))
+
     # Configurar cierre de aplicación
+    def cerrar():
+        # Solo una vez confirmado: si el usuario cancela, la API y el vigilante siguen funcionando
+        if app.servidor_api is not None:
+            app.servidor_api.detener()
+        if app.vigilante is not None:
+            app.vigilante.detener()
+        root.destroy()
+
     def on_closing():
-        if messagebox.askokcancel("Salir", "¿Deseas cerrar la aplicación?"):
-            root.destroy()
+        if app.exportacion.cola.pendientes():
+            if not messagebox.askokcancel("Salir", "Hay exportaciones en curso.\n¿Deseas cancelarlas y cerrar la aplicación?"):
+                return
+            app.exportacion.cola.cancelar_todo()
+            cerrar()
+        elif messagebox.askokcancel("Salir", "¿Deseas cerrar la aplicación?"):
+            cerrar()
 
     root.protocol("WM_DELETE_WINDOW", on_closing)
     root.mainloop()
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()  # Procesos hijos en el ejecutable de PyInstaller (comparar perfiles)
     main()
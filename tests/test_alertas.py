@@ -0,0 +1,88 @@
+"""Reglas de MotorAlertas: puntuales, racha, media móvil y registros fuera de orden"""
+import random
+from datetime import datetime, timedelta
+
+from control_azucar_app import MotorAlertas
+
+
+def lectura(momento, antes=None, despues=None, id_registro=None):
+    return {"id": id_registro or momento.isoformat(), "timestamp": momento.isoformat(),
+            "azucar_antes": antes, "azucar_despues": despues}
+
+
+def reglas(alertas):
+    return [a["regla"] for a in alertas]
+
+
+INICIO = datetime(2024, 1, 1, 8, 0)
+
+
+def test_reglas_puntuales():
+    motor = MotorAlertas()
+    assert reglas(motor.evaluar(lectura(INICIO, 65, 120))) == ["hipoglucemia"]
+    assert reglas(motor.evaluar(lectura(INICIO + timedelta(hours=1), 100, 170))) == ["subida_posprandial"]
+    alertas = motor.evaluar(lectura(INICIO + timedelta(hours=2), None, 260))
+    assert "hiperglucemia" in reglas(alertas)
+    assert alertas[0]["valor"] == 260 and alertas[0]["registro_id"] == (INICIO + timedelta(hours=2)).isoformat()
+    assert motor.evaluar(lectura(INICIO + timedelta(hours=3), 100, 120)) == []
+
+
+def test_racha_de_altos_avisa_una_vez_y_se_corta():
+    motor = MotorAlertas({"ventana_horas": 1})  # Que la media no se mezcle con la racha
+    momentos = [INICIO + timedelta(hours=3 * i) for i in range(8)]
+    valores = [190, 200, 210, 220, 150, 190, 195, 205]
+    disparos = [i for i, (m, v) in enumerate(zip(momentos, valores))
+                if "altos_consecutivos" in reglas(motor.evaluar(lectura(m, v)))]
+    assert disparos == [2, 7]
+    assert motor.racha_altos == 3
+
+
+def test_racha_cuenta_antes_y_despues_del_mismo_registro():
+    motor = MotorAlertas({"altos_consecutivos": 2, "ventana_horas": 1})
+    assert "altos_consecutivos" in reglas(motor.evaluar(lectura(INICIO, 185, 190)))
+
+
+def test_media_movil_con_ventana_deslizante():
+    motor = MotorAlertas({"ventana_horas": 4, "altos_consecutivos": 99})
+    assert reglas(motor.evaluar(lectura(INICIO, 150))) == []
+    assert reglas(motor.evaluar(lectura(INICIO + timedelta(hours=1), 230))) == ["media_movil"]  # Media 190
+    assert motor.evaluar(lectura(INICIO + timedelta(hours=2), 200)) == []  # Sigue alta: no se repite
+    assert motor.media_movil() == (150 + 230 + 200) / 3
+
+    motor.evaluar(lectura(INICIO + timedelta(hours=7), 100))  # Salen las tres primeras
+    assert motor.media_movil() == 100 and len(motor._ventana) == 1
+    assert reglas(motor.evaluar(lectura(INICIO + timedelta(hours=8), 240))) == []  # Media 170
+    assert reglas(motor.evaluar(lectura(INICIO + timedelta(hours=9), 240))) == ["media_movil"]
+
+
+def test_fuera_de_orden_solo_puntuales_y_reconstruye():
+    motor = MotorAlertas({"ventana_horas": 24})
+    registros = [lectura(INICIO + timedelta(hours=i), 190) for i in (0, 5, 10)]
+    for registro in registros:
+        motor.evaluar(registro, registros)
+    assert motor.racha_altos == 3
+
+    antiguo = lectura(INICIO + timedelta(hours=7), 60, 200)
+    registros.append(antiguo)
+    alertas = motor.evaluar(antiguo, registros)
+    assert reglas(alertas) == ["hipoglucemia", "subida_posprandial"]  # Nada de racha ni media
+    assert motor.ultimo_momento == INICIO + timedelta(hours=10)
+    assert motor.racha_altos == 2  # 190, 190, 60, 200, 190 en orden cronológico
+    assert motor.media_movil() == (190 * 3 + 60 + 200) / 5
+
+
+def test_estado_incremental_igual_que_reconstruido():
+    azar = random.Random(3)
+    motor = MotorAlertas({"ventana_horas": 6})
+    registros = []
+    for i in range(300):
+        momento = INICIO + timedelta(minutes=i * 47 - (azar.randrange(600) if azar.random() < 0.1 else 0))
+        registro = lectura(momento, azar.randrange(50, 300), azar.choice([None, azar.randrange(50, 300)]), str(i))
+        registros.append(registro)
+        motor.evaluar(registro, registros)
+
+        nuevo = MotorAlertas({"ventana_horas": 6})
+        nuevo.construir(registros)
+        assert (motor.racha_altos, list(motor._ventana), motor._media_alta) == \
+            (nuevo.racha_altos, list(nuevo._ventana), nuevo._media_alta)
+        assert abs(motor.media_movil() - nuevo.media_movil()) < 1e-6
@@ -0,0 +1,127 @@
+"""Varios almacenes (o procesos) sobre el mismo archivo: fusión de registros y de configuración"""
+import copy
+import multiprocessing
+from datetime import datetime
+
+from control_azucar_app import FRANJAS_PREDETERMINADAS, AlmacenRegistros
+
+
+def nuevo(almacen, nombre, antes=100, hora="08:30"):
+    metadata = {"fecha": "2024-03-01", "hora": hora, "datetime": datetime(2024, 3, 1, 8, 30), "fuente": "Test"}
+    registro = almacen.crear_registro(nombre, ["Pan"], antes, None, metadata=metadata)
+    almacen.agregar(registro)
+    return registro
+
+
+def nombres(almacen):
+    return sorted(r["nombre_comida"] for r in almacen.registros)
+
+
+def test_altas_en_dos_almacenes_se_conservan(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    a, b = AlmacenRegistros(ruta), AlmacenRegistros(ruta)
+    nuevo(a, "De A")
+    nuevo(b, "De B")
+    assert nombres(b) == ["De A", "De B"]
+    assert nombres(AlmacenRegistros(ruta)) == ["De A", "De B"]
+
+
+def test_edicion_y_borrado_concurrentes(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    a = AlmacenRegistros(ruta)
+    x, y = nuevo(a, "X"), nuevo(a, "Y")
+    b = AlmacenRegistros(ruta)
+
+    a.actualizar(x["id"], {"azucar_antes": 150})
+    b.borrar([y])
+
+    final = AlmacenRegistros(ruta)
+    assert nombres(final) == ["X"]
+    assert final.buscar(x["id"])["azucar_antes"] == 150
+
+
+def test_borrado_frente_a_edicion_del_mismo_registro(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    a = AlmacenRegistros(ruta)
+    x = nuevo(a, "X")
+    b = AlmacenRegistros(ruta)
+
+    b.actualizar(x["id"], {"nombre_comida": "X editado"})
+    a.borrar([x])  # A no había visto la edición y borra: gana el borrado
+    assert AlmacenRegistros(ruta).registros == []
+
+
+def test_la_edicion_mas_reciente_gana(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    a = AlmacenRegistros(ruta)
+    x = nuevo(a, "X")
+    b = AlmacenRegistros(ruta)
+
+    a.actualizar(x["id"], {"azucar_antes": 120})
+    b.actualizar(x["id"], {"azucar_antes": 130})
+    assert AlmacenRegistros(ruta).buscar(x["id"])["azucar_antes"] == 130
+
+
+def test_configuracion_de_ambos_procesos_se_fusiona(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    a, b = AlmacenRegistros(ruta), AlmacenRegistros(ruta)
+
+    franjas = copy.deepcopy(FRANJAS_PREDETERMINADAS)
+    franjas["recena"] = {"inicio": "00:00", "fin": "05:59"}
+    a.cambiar_franjas(franjas)
+
+    b.normalizador.agregar_alias("pan bimbo", "Pan de molde")
+    b.aplicar_alias()
+    b.configuracion["alertas"] = {"limite_alto": 150}
+    b.guardar()
+
+    final = AlmacenRegistros(ruta)
+    assert "recena" in final.configuracion["franjas_horarias"]
+    assert "pan bimbo" in final.configuracion["alias_alimentos"]
+    assert final.configuracion["alertas"] == {"limite_alto": 150}
+
+
+def test_mismo_dict_de_configuracion_se_fusiona_por_clave(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    a, b = AlmacenRegistros(ruta), AlmacenRegistros(ruta)
+
+    a.normalizador.agregar_alias("yogurt", "Yogur")
+    a.aplicar_alias()
+    b.normalizador.agregar_alias("cafe con leche", "Café")
+    b.aplicar_alias()
+
+    alias = AlmacenRegistros(ruta).configuracion["alias_alimentos"]
+    assert "yogurt" in alias and "cafe con leche" in alias
+
+
+def test_recargar_aplica_configuracion_y_reclasifica(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    a = AlmacenRegistros(ruta)
+    x = nuevo(a, "X", hora="08:30")
+    assert a.buscar(x["id"])["franja"] == "desayuno"
+    b = AlmacenRegistros(ruta)
+
+    b.cambiar_franjas({"temprano": {"inicio": "07:00", "fin": "09:00"}})
+    assert a.recargar_si_cambio() is not None
+    assert list(a.configuracion["franjas_horarias"]) == ["temprano"]
+    assert a.buscar(x["id"])["franja"] == "temprano"
+    assert a.recargar_si_cambio() is None
+
+
+def _agregar_en_proceso(ruta, prefijo, cantidad):
+    almacen = AlmacenRegistros(ruta)
+    for i in range(cantidad):
+        nuevo(almacen, f"{prefijo}-{i}")
+
+
+def test_varios_procesos_no_pierden_altas(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    AlmacenRegistros(ruta).guardar()
+    contexto = multiprocessing.get_context("spawn")
+    procesos = [contexto.Process(target=_agregar_en_proceso, args=(ruta, f"p{n}", 10)) for n in range(3)]
+    for proceso in procesos:
+        proceso.start()
+    for proceso in procesos:
+        proceso.join(60)
+        assert proceso.exitcode == 0
+    assert len(AlmacenRegistros(ruta).registros) == 30
@@ -0,0 +1,121 @@
+"""Autenticación de la API HTTP local"""
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from control_azucar_app import AlmacenRegistros, ServicioEstadisticas, ServidorAPI
+
+
+@pytest.fixture
+def servidor(tmp_path):
+    almacen = AlmacenRegistros(str(tmp_path / "datos.json"))
+    servidor = ServidorAPI(almacen, None, ServicioEstadisticas(almacen), puerto=0, token="secreto").iniciar()
+    yield servidor
+    servidor.detener()
+
+
+def pedir(servidor, ruta, token=None):
+    cabeceras = {"Authorization": f"Bearer {token}"} if token else {}
+    peticion = urllib.request.Request(servidor.direccion.rstrip("/") + ruta, headers=cabeceras)
+    with urllib.request.urlopen(peticion, timeout=5) as respuesta:
+        return respuesta.status, respuesta.read()
+
+
+def enviar(servidor, metodo, ruta, cuerpo):
+    peticion = urllib.request.Request(servidor.direccion.rstrip("/") + ruta, method=metodo,
+                                      data=json.dumps(cuerpo).encode("utf-8"),
+                                      headers={"Authorization": "Bearer secreto", "Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(peticion, timeout=5) as respuesta:
+            return respuesta.status, json.loads(respuesta.read() or b"null")
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+@pytest.mark.parametrize("token", [None, "otro", "secret", "secreto2"])
+def test_token_incorrecto_da_401(servidor, token):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        pedir(servidor, "/api/registros", token)
+    assert error.value.code == 401
+
+
+def test_token_correcto(servidor):
+    estado, cuerpo = pedir(servidor, "/api/registros", "secreto")
+    assert estado == 200 and json.loads(cuerpo)["registros"] == []
+
+
+def test_la_pagina_no_lee_el_token_de_la_url(servidor):
+    estado, cuerpo = pedir(servidor, "/")
+    assert estado == 200 and b"location.search" not in cuerpo
+
+
+@pytest.mark.parametrize("host, token, expuesta", [
+    ("127.0.0.1", None, False), ("localhost", None, False), ("::1", None, False),
+    ("0.0.0.0", None, True), ("192.168.1.10", None, True), ("0.0.0.0", "secreto", False),
+])
+def test_aviso_sin_token_fuera_de_local(host, token, expuesta):
+    assert ServidorAPI(None, None, None, host=host, token=token).expuesta is expuesta
+
+
+def test_crear_registro(servidor):
+    estado, cuerpo = enviar(servidor, "POST", "/api/registros",
+                            {"nombre_comida": "Arroz", "alimentos": ["arroz", "pollo"], "azucar_antes": "110"})
+    assert estado == 201
+    assert cuerpo["registro"]["alimentos"] == ["arroz", "pollo"]
+    assert cuerpo["registro"]["azucar_antes"] == 110
+
+
+@pytest.mark.parametrize("cuerpo", [
+    {"nombre_comida": 123, "azucar_antes": 100},
+    {"nombre_comida": "Arroz", "alimentos": "arroz", "azucar_antes": 100},
+    {"nombre_comida": "Arroz", "alimentos": [1, 2], "azucar_antes": 100},
+    {"nombre_comida": "Arroz", "azucar_antes": [100]},
+    {"nombre_comida": "Arroz", "fecha": 20240101, "azucar_antes": 100},
+])
+def test_crear_con_tipos_incorrectos_da_400(servidor, cuerpo):
+    estado, respuesta = enviar(servidor, "POST", "/api/registros", cuerpo)
+    assert estado == 400 and respuesta["error"]
+    assert servidor.almacen.registros == []
+
+
+@pytest.mark.parametrize("cambios", [{"nombre_comida": 5}, {"alimentos": "arroz"}, {"alimentos": 7},
+                                     {"alimentos": ["arroz", None]}])
+def test_modificar_con_tipos_incorrectos_da_400(servidor, cambios):
+    _, cuerpo = enviar(servidor, "POST", "/api/registros", {"nombre_comida": "Pan", "alimentos": ["pan"],
+                                                            "azucar_antes": 100})
+    id_registro = cuerpo["registro"]["id"]
+    estado, _ = enviar(servidor, "PATCH", f"/api/registros/{id_registro}", cambios)
+    assert estado == 400
+    assert servidor.almacen.buscar(id_registro)["alimentos"] == ["pan"]
+
+
+def test_modificar_alimentos(servidor):
+    _, cuerpo = enviar(servidor, "POST", "/api/registros", {"nombre_comida": "Pan", "azucar_antes": 100})
+    estado, registro = enviar(servidor, "PATCH", f"/api/registros/{cuerpo['registro']['id']}",
+                              {"alimentos": ["pan", "tomate"]})
+    assert estado == 200 and registro["alimentos"] == ["pan", "tomate"]
+    assert len(registro["alimentos_ids"]) == 2
+
+
+def test_estadisticas_no_esperan_al_cerrojo_del_almacen(servidor):
+    import threading
+
+    enviar(servidor, "POST", "/api/registros", {"nombre_comida": "Pan", "azucar_antes": 100, "azucar_despues": 150})
+    ocupado, soltar = threading.Event(), threading.Event()
+
+    def escritor_lento():
+        with servidor.almacen.cerrojo:
+            ocupado.set()
+            soltar.wait(10)
+
+    hilo = threading.Thread(target=escritor_lento)
+    hilo.start()
+    ocupado.wait(5)
+    try:
+        estado, resumen = pedir(servidor, "/api/estadisticas", "secreto")
+        assert estado == 200 and json.loads(resumen)["registros"] == 1
+    finally:
+        soltar.set()
+        hilo.join()
@@ -0,0 +1,102 @@
+"""Almacén CGM: lecturas en bruto y niveles preagregados por hora y por día"""
+import random
+from collections import defaultdict
+
+from control_azucar_app import AlmacenCGM
+
+
+def agregados_esperados(minutos, decimas, ancho):
+    cubos = defaultdict(list)
+    for minuto, valor in zip(minutos, decimas):
+        cubos[minuto - minuto % ancho].append(valor)
+    return [(inicio, len(v), float(sum(v)), min(v), max(v)) for inicio, v in sorted(cubos.items())]
+
+
+def agregados(nivel):
+    return list(zip(nivel.inicio, nivel.n, nivel.suma, nivel.minimo, nivel.maximo))
+
+
+def comprobar(cgm):
+    assert list(cgm.minutos) == sorted(set(cgm.minutos))
+    for nombre, ancho in AlmacenCGM.NIVELES.items():
+        if ancho:
+            assert agregados(cgm.niveles[nombre]) == agregados_esperados(cgm.minutos, cgm.decimas, ancho)
+
+
+def lecturas(desde, cantidad, azar):
+    minutos = list(range(desde, desde + 5 * cantidad, 5))
+    return minutos, [azar.randint(400, 3000) for _ in minutos]
+
+
+def test_lotes_en_orden_continuan_los_cubos(tmp_path):
+    azar = random.Random(0)
+    cgm = AlmacenCGM(str(tmp_path / "cgm.bin"))
+    inicio = 28_000_000
+    for lote in range(5):
+        # 7 lecturas por lote: los cubos de hora quedan a caballo entre lotes
+        assert cgm.agregar_lote(*lecturas(inicio + lote * 35, 7, azar)) == 7
+    assert len(cgm) == 35
+    comprobar(cgm)
+
+
+def test_lotes_desordenados_solapados_y_repetidos(tmp_path):
+    azar = random.Random(1)
+    cgm = AlmacenCGM(str(tmp_path / "cgm.bin"))
+    minutos, decimas = lecturas(28_000_000, 2000, azar)
+    pares = list(zip(minutos, decimas))
+    azar.shuffle(pares)
+    vistos = set()
+    for i in range(0, len(pares), 150):
+        lote = pares[i:i + 150] + azar.sample(pares[:i + 1], min(i + 1, 20))  # Con repetidas
+        nuevas = cgm.agregar_lote(*zip(*lote))
+        assert nuevas == len({m for m, _ in lote} - vistos)
+        vistos.update(m for m, _ in lote)
+        comprobar(cgm)
+    assert list(cgm.minutos) == minutos and list(cgm.decimas) == decimas
+
+
+def test_minuto_repetido_en_el_lote_vale_la_primera_lectura(tmp_path):
+    cgm = AlmacenCGM(str(tmp_path / "cgm.bin"))
+    assert cgm.agregar_lote([28_000_000, 28_000_010], [1000, 1200]) == 2
+    assert cgm.agregar_lote([28_000_005] * 3, [1500, 1400, 1300]) == 1  # Intercalada
+    assert cgm.agregar_lote([28_000_015] * 3, [1500, 1400, 1300]) == 1  # Al final
+    assert list(cgm.minutos) == [28_000_000, 28_000_005, 28_000_010, 28_000_015]
+    assert list(cgm.decimas) == [1000, 1500, 1200, 1500]
+    comprobar(cgm)
+
+
+def test_recargar_da_los_mismos_niveles(tmp_path):
+    azar = random.Random(2)
+    ruta = str(tmp_path / "cgm.bin")
+    cgm = AlmacenCGM(ruta)
+    cgm.agregar_lote(*lecturas(28_000_000, 500, azar))
+    cgm.agregar_lote(*lecturas(28_000_000 + 5 * 500, 100, azar))  # Al final del archivo
+    cgm.agregar_lote(*lecturas(27_999_000, 50, azar))  # Antes: se reescribe
+
+    otro = AlmacenCGM(ruta)
+    assert otro.minutos == cgm.minutos and otro.decimas == cgm.decimas
+    for nombre in cgm.niveles:
+        assert agregados(otro.niveles[nombre]) == agregados(cgm.niveles[nombre])
+
+
+def test_escritura_cortada_se_ignora(tmp_path):
+    ruta = str(tmp_path / "cgm.bin")
+    cgm = AlmacenCGM(ruta)
+    cgm.agregar_lote([28_000_000, 28_000_005], [1000, 1100])
+    with open(ruta, "ab") as f:
+        f.write(b"\x01\x02\x03")
+    assert list(AlmacenCGM(ruta).minutos) == [28_000_000, 28_000_005]
+
+
+def test_serie_y_eleccion_de_nivel(tmp_path):
+    azar = random.Random(3)
+    cgm = AlmacenCGM(str(tmp_path / "cgm.bin"))
+    minutos, decimas = lecturas(28_000_000 - 28_000_000 % 1440, 288 * 10, azar)  # Diez días
+    cgm.agregar_lote(minutos, decimas)
+
+    assert cgm.elegir_nivel(maximo_puntos=10 ** 6) == "5min"
+    assert cgm.elegir_nivel(maximo_puntos=500) == "hora"
+    assert cgm.elegir_nivel(maximo_puntos=100) == "dia"
+    inicios, medias = cgm.serie(nivel="dia")
+    assert len(inicios) == 10
+    assert medias[0] == sum(decimas[:288]) / 288 / 10
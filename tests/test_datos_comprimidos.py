@@ -0,0 +1,64 @@
+"""Lectura por bloques (LectorJSON) y archivos de datos comprimidos"""
+import io
+import json
+import random
+
+import pytest
+
+from control_azucar_app import AlmacenRegistros, LectorJSON, escribir_datos, leer_datos
+
+
+def aleatorio(azar, profundidad=0):
+    opciones = [
+        lambda: azar.randint(-10 ** 6, 10 ** 6),
+        lambda: azar.uniform(-1e6, 1e6),
+        lambda: azar.choice([1e-7, -2.5e21, 0.5, -0.0, 12.0]),
+        lambda: azar.choice([True, False, None]),
+        lambda: "".join(azar.choice('aé ñ"\\\n{}[],:1') for _ in range(azar.randint(0, 8))),
+    ]
+    if profundidad < 2:
+        opciones.append(lambda: [aleatorio(azar, profundidad + 1) for _ in range(azar.randint(0, 4))])
+        opciones.append(lambda: {f"k{i}": aleatorio(azar, profundidad + 1) for i in range(azar.randint(0, 4))})
+    return azar.choice(opciones)()
+
+
+@pytest.mark.parametrize("semilla", range(30))
+def test_lector_con_bloques_diminutos(semilla):
+    azar = random.Random(semilla)
+    datos = {
+        "registros": [aleatorio(azar) for _ in range(20)],
+        "configuracion": {"limite": azar.uniform(0, 300), "franjas": aleatorio(azar)},
+        "version": azar.randint(0, 10 ** 9),
+        "numeros": [azar.uniform(-1e3, 1e3) for _ in range(10)],
+    }
+    for separadores in ((",", ":"), (", ", ": ")):
+        texto = json.dumps(datos, ensure_ascii=False, separators=separadores)
+        for bloque in (1, 2, 3, 7):
+            assert LectorJSON(io.StringIO(texto), bloque).cargar() == datos
+
+
+@pytest.mark.parametrize("texto", ['{"a":12.5}', '{"a":-2.5e10}', '{"a":[1,23,-4.5E-3]}', '{"a":1e5,"b":7}'])
+def test_numero_cortado_por_el_bloque(texto):
+    for bloque in range(1, len(texto) + 1):
+        assert LectorJSON(io.StringIO(texto), bloque).cargar() == json.loads(texto)
+
+
+def test_json_invalido_da_value_error():
+    with pytest.raises(ValueError):
+        LectorJSON(io.StringIO('{"a":[1,2'), 2).cargar()
+
+
+@pytest.mark.parametrize("extension", [".gz", ".xz"])
+def test_ida_y_vuelta_comprimido(tmp_path, extension):
+    ruta = str(tmp_path / ("datos.json" + extension))
+    datos = {"registros": [{"id": str(i), "valor": i / 3} for i in range(100)], "configuracion": {}}
+    escribir_datos(ruta, datos, extension)
+    assert leer_datos(ruta, extension) == datos
+
+
+def test_pasar_a_comprimido_conserva_los_registros(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    almacen = AlmacenRegistros(ruta)
+    almacen.agregar(almacen.crear_registro("Pan", ["Pan"], 100, None))
+    comprimido = AlmacenRegistros(ruta + ".gz")
+    assert [r["nombre_comida"] for r in comprimido.registros] == ["Pan"]
@@ -0,0 +1,114 @@
+import os
+import time
+
+import pytest
+
+from control_azucar_app import AlmacenRegistros, ColaExportaciones, ServicioExportacion, TrabajoExportacion
+
+
+def esperar(trabajo, limite=10):
+    fin = time.monotonic() + limite
+    while trabajo.estado in ("en cola", "exportando") and time.monotonic() < fin:
+        time.sleep(0.01)
+    return trabajo.estado
+
+
+def registro(i):
+    return {"id": str(i), "fecha": "2024-01-01", "hora": "08:00", "nombre_comida": "Desayuno",
+            "azucar_antes": 90 + i, "azucar_despues": None, "alimentos": ["Pan"], "timestamp": "2024-01-01T08:00:00"}
+
+
+def test_trabajo_encolado_tras_quedar_inactivo_se_procesa(tmp_path):
+    cola = ColaExportaciones()
+    primero = TrabajoExportacion("uno", [str(tmp_path / "uno.csv")], [registro(1)], "ok")
+    cola.encolar(primero)
+    assert esperar(primero) == "completado"
+
+    time.sleep(1.2)  # Más que el antiguo get(timeout=1) del hilo
+    segundo = TrabajoExportacion("dos", [str(tmp_path / "dos.csv")], [registro(2)], "ok")
+    cola.encolar(segundo)
+    assert esperar(segundo) == "completado"
+    assert os.path.exists(tmp_path / "dos.csv")
+    assert cola.pendientes() == []
+
+
+def test_cancelar_todo_para_el_hilo(tmp_path):
+    cola = ColaExportaciones()
+    trabajo = TrabajoExportacion("uno", [str(tmp_path / "uno.csv")], [registro(1)], "ok")
+    cola.encolar(trabajo)
+    esperar(trabajo)
+    hilo = cola._hilo
+    inicio = time.monotonic()
+    cola.cancelar_todo()
+    assert not hilo.is_alive()
+    assert time.monotonic() - inicio < 1
+
+    # La cola sigue sirviendo después de parar el hilo
+    otro = TrabajoExportacion("dos", [str(tmp_path / "dos.csv")], [registro(2)], "ok")
+    cola.encolar(otro)
+    assert esperar(otro) == "completado"
+
+
+def test_marca_va_al_perfil_de_cuando_se_encolo(tmp_path):
+    ana, luis = AlmacenRegistros(str(tmp_path / "ana.json")), AlmacenRegistros(str(tmp_path / "luis.json"))
+    ana.agregar(ana.crear_registro("Pan", ["Pan"], 100, None))
+    servicio = ServicioExportacion(ana)
+    destino = str(tmp_path / "cambios.csv")
+    registros, _ = servicio.cambios(destino)
+
+    servicio.almacen = luis  # Cambio de perfil antes de que termine la exportación
+    servicio.confirmar_marca(destino, registros, ana)
+    assert ana.configuracion["marcas_exportacion"]
+    assert not luis.configuracion["marcas_exportacion"]
+    assert servicio.cambios(destino)[0] == []  # luis no tiene registros
+    servicio.almacen = ana
+    assert servicio.cambios(destino)[0] == []
+
+
+def test_cambios_solo_devuelve_lo_posterior_a_la_marca(tmp_path):
+    almacen = AlmacenRegistros(str(tmp_path / "datos.json"))
+    viejo, otro = almacen.crear_registro("Pan", ["Pan"], 100, None), almacen.crear_registro("Fruta", ["Manzana"], 95, None)
+    almacen.agregar(viejo)
+    almacen.agregar(otro)
+    servicio = ServicioExportacion(almacen)
+    destino = str(tmp_path / "cambios.csv")
+    registros, marca = servicio.cambios(destino)
+    assert marca is None and len(registros) == 2
+
+    servicio.confirmar_marca(destino, registros)
+    assert servicio.cambios(destino)[0] == []
+    time.sleep(0.01)
+    almacen.actualizar(viejo["id"], {"azucar_despues": 140})
+    nuevo = almacen.crear_registro("Cena", ["Arroz"], 110, None)
+    almacen.agregar(nuevo)
+    assert sorted(r["id"] for r in servicio.cambios(destino)[0]) == sorted([viejo["id"], nuevo["id"]])
+    assert servicio.cambios(str(tmp_path / "otro.csv"))[1] is None  # Cada destino tiene su marca
+
+
+def test_anexar_csv_repite_modificados_con_su_actualizado(tmp_path):
+    import csv
+    almacen = AlmacenRegistros(str(tmp_path / "datos.json"))
+    pan = almacen.crear_registro("Pan", ["Pan"], 100, None)
+    almacen.agregar(pan)
+    servicio = ServicioExportacion(almacen)
+    destino = str(tmp_path / "cambios.csv")
+    servicio.exportar([destino], almacen.registros)
+
+    time.sleep(0.01)
+    almacen.actualizar(pan["id"], {"azucar_despues": 140})
+    servicio.exportar([destino], almacen.registros, anexar=True)
+    with open(destino, newline="", encoding="utf-8") as archivo:
+        filas = list(csv.DictReader(archivo))
+    assert [f["ID"] for f in filas] == [pan["id"]] * 2
+    ultima = max(filas, key=lambda f: f["Actualizado"])
+    assert float(ultima["Azucar_Despues_mg/dL"]) == 140
+    assert ultima["Actualizado"] == almacen.buscar(pan["id"])["actualizado"]
+
+
+def test_anexar_csv_con_otras_columnas_no_toca_el_archivo(tmp_path):
+    destino = tmp_path / "viejo.csv"
+    destino.write_text("Fecha,Hora,ID\n2024-01-01,08:00,1\n", encoding="utf-8")
+    servicio = ServicioExportacion(AlmacenRegistros(str(tmp_path / "datos.json")))
+    with pytest.raises(ValueError):
+        servicio.exportar([str(destino)], [registro(1)], anexar=True)
+    assert destino.read_text(encoding="utf-8") == "Fecha,Hora,ID\n2024-01-01,08:00,1\n"
@@ -0,0 +1,31 @@
+"""Caché de series de las gráficas de tendencias"""
+from datetime import datetime, timedelta
+
+from control_azucar_app import GraficosTendencias, MotorAnaliticas
+
+
+def registros(n):
+    inicio = datetime(2024, 1, 1, 8, 0)
+    return [{"id": str(i), "fecha": (inicio + timedelta(hours=6 * i)).strftime("%Y-%m-%d"),
+             "hora": (inicio + timedelta(hours=6 * i)).strftime("%H:%M"),
+             "timestamp": (inicio + timedelta(hours=6 * i)).isoformat(),
+             "nombre_comida": "Pan", "azucar_antes": 90 + i % 40, "azucar_despues": 140 + i % 50}
+            for i in range(n)]
+
+
+def test_cada_llamada_da_una_figura_nueva_con_las_series_en_cache(monkeypatch):
+    datos = registros(200)
+    analiticas = MotorAnaliticas(lambda: datos)
+    graficos = GraficosTendencias(analiticas)
+    llamadas = []
+    original = graficos._series
+    monkeypatch.setattr(graficos, "_series", lambda *args: llamadas.append(args) or original(*args))
+
+    primera = graficos.figura(resolucion="Diaria")
+    segunda = graficos.figura(resolucion="Diaria", objetivo=(80, 160))
+    assert primera is not segunda
+    assert len(llamadas) == 1
+
+    analiticas.invalidar()
+    graficos.figura(resolucion="Diaria")
+    assert len(llamadas) == 2
@@ -0,0 +1,221 @@
+"""Registro de eventos: deshacer/rehacer, arranque desde instantánea, rotación y reconstrucción"""
+import os
+
+import pytest
+
+from control_azucar_app import AlmacenRegistros, HistorialEventos, ahora_iso
+
+
+@pytest.fixture
+def pocas_instantaneas(monkeypatch):
+    monkeypatch.setattr(HistorialEventos, "INSTANTANEA_CADA", 5)
+
+
+def nuevo(almacen, nombre):
+    registro = almacen.crear_registro(nombre, ["Pan"], 100, None)
+    almacen.agregar(registro)
+    return registro
+
+
+def nombres(almacen):
+    return sorted(r["nombre_comida"] for r in almacen.registros)
+
+
+def test_deshacer_y_rehacer_varios_pasos(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    almacen = AlmacenRegistros(ruta)
+    a, b = nuevo(almacen, "A"), nuevo(almacen, "B")
+    almacen.actualizar(a["id"], {"nombre_comida": "A2"})
+    almacen.borrar([almacen.buscar(b["id"])])
+    assert nombres(almacen) == ["A2"]
+
+    almacen.deshacer()
+    assert nombres(almacen) == ["A2", "B"]
+    almacen.deshacer()
+    assert nombres(almacen) == ["A", "B"]
+    almacen.deshacer()
+    assert nombres(almacen) == ["A"]
+
+    almacen.rehacer()
+    assert nombres(almacen) == ["A", "B"]
+    assert almacen.puede_rehacer()
+
+
+def test_las_pilas_sobreviven_a_un_reinicio(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    almacen = AlmacenRegistros(ruta)
+    nuevo(almacen, "A")
+    nuevo(almacen, "B")
+    almacen.deshacer()
+    pilas = almacen.eventos.pilas()
+
+    otro = AlmacenRegistros(ruta)
+    assert otro.eventos.pilas() == pilas
+    otro.rehacer()
+    assert nombres(otro) == ["A", "B"]
+
+
+def test_un_cambio_nuevo_vacia_rehacer(tmp_path):
+    almacen = AlmacenRegistros(str(tmp_path / "datos.json"))
+    nuevo(almacen, "A")
+    almacen.deshacer()
+    assert almacen.puede_rehacer()
+    nuevo(almacen, "B")
+    assert not almacen.puede_rehacer()
+
+
+def test_profundidad_de_deshacer_limitada(tmp_path, monkeypatch):
+    monkeypatch.setattr(HistorialEventos, "PROFUNDIDAD_DESHACER", 3)
+    almacen = AlmacenRegistros(str(tmp_path / "datos.json"))
+    for i in range(6):
+        nuevo(almacen, f"R{i}")
+    assert len(almacen.eventos.pilas()[0]) == 3
+    for _ in range(3):
+        almacen.deshacer()
+    assert almacen.deshacer() is None
+    assert nombres(almacen) == ["R0", "R1", "R2"]
+
+
+def test_arranque_indexa_solo_desde_la_ultima_instantanea(tmp_path, pocas_instantaneas):
+    ruta = str(tmp_path / "datos.json")
+    almacen = AlmacenRegistros(ruta)
+    for i in range(12):
+        nuevo(almacen, f"R{i}")
+    almacen.deshacer()
+    pilas = almacen.eventos.pilas()
+
+    eventos = AlmacenRegistros(ruta).eventos
+    assert eventos.pilas() == pilas
+    assert [seq for seq, *_ in eventos._indice] == [11, 12, 13]
+    assert len(eventos) == 13
+    # Lo anterior sigue disponible bajo demanda
+    assert eventos.evento(2)["datos"]["registros"][0]["nombre_comida"] == "R1"
+
+
+def test_registro_truncado_no_rompe_el_arranque(tmp_path, pocas_instantaneas):
+    ruta = str(tmp_path / "datos.json")
+    almacen = AlmacenRegistros(ruta)
+    for i in range(7):
+        nuevo(almacen, f"R{i}")
+    with open(almacen.eventos.ruta, "r+b") as f:
+        f.truncate(0)
+
+    otro = AlmacenRegistros(ruta)
+    assert otro.eventos.pilas() == ([], [])
+    nuevo(otro, "Otro")
+    assert otro.eventos.pilas()[0] == [1]
+    assert nombres(otro) == sorted([f"R{i}" for i in range(7)] + ["Otro"])
+
+
+def test_rotacion_conserva_historial_y_deshacer(tmp_path, pocas_instantaneas, monkeypatch):
+    monkeypatch.setattr(HistorialEventos, "ROTAR_BYTES", 1)
+    ruta = str(tmp_path / "datos.json")
+    almacen = AlmacenRegistros(ruta)
+    primero = nuevo(almacen, "R0")
+    momento = ahora_iso()
+    for i in range(1, 12):
+        nuevo(almacen, f"R{i}")
+
+    antiguos = os.listdir(almacen.eventos.directorio_antiguos)
+    assert sorted(antiguos) == ["eventos_00000001.jsonl", "eventos_00000002.jsonl", "eventos_00000006.jsonl"]
+    assert os.path.getsize(almacen.eventos.ruta) < os.path.getsize(
+        os.path.join(almacen.eventos.directorio_antiguos, "eventos_00000006.jsonl"))
+
+    otro = AlmacenRegistros(ruta)
+    assert [r["id"] for r in otro.vista(momento)] == [primero["id"]]
+    for _ in range(11):
+        otro.deshacer()
+    assert nombres(otro) == ["R0"]
+
+
+def test_otro_proceso_rota_el_registro(tmp_path, pocas_instantaneas, monkeypatch):
+    monkeypatch.setattr(HistorialEventos, "ROTAR_BYTES", 1)
+    ruta = str(tmp_path / "datos.json")
+    a = AlmacenRegistros(ruta)
+    nuevo(a, "A0")
+    b = AlmacenRegistros(ruta)
+    assert b.eventos.pilas()[0] == [1]
+    for i in range(1, 6):
+        nuevo(a, f"A{i}")  # El 5 toma instantánea y aparta el registro
+    nuevo(a, "A6")
+    assert b.eventos.pilas()[0] == list(range(1, 8))
+    assert b.eventos.evento(3)["seq"] == 3
+
+
+def test_reconstruir_desde_instantanea_y_eventos(tmp_path, pocas_instantaneas):
+    ruta = str(tmp_path / "datos.json")
+    almacen = AlmacenRegistros(ruta)
+    registros = [nuevo(almacen, f"R{i}") for i in range(8)]
+    almacen.actualizar(registros[0]["id"], {"nombre_comida": "Editado"})
+    almacen.borrar([almacen.buscar(registros[1]["id"])])
+    esperado = nombres(almacen)
+
+    with open(ruta, "w") as f:
+        f.write("{roto")
+    recuperado = AlmacenRegistros(ruta)
+    assert nombres(recuperado) == esperado
+    assert os.path.exists(ruta + ".corrupto")
+
+
+def test_vista_en_un_momento_pasado(tmp_path):
+    almacen = AlmacenRegistros(str(tmp_path / "datos.json"))
+    a, b = nuevo(almacen, "A"), nuevo(almacen, "B")
+    momento = ahora_iso()
+    franjas = almacen.configuracion["franjas_horarias"]
+    almacen.actualizar(a["id"], {"nombre_comida": "A2"})
+    almacen.borrar([almacen.buscar(b["id"])])
+    nuevo(almacen, "C")
+    almacen.cambiar_franjas({"todo": {"inicio": "00:00", "fin": "23:59"}})
+
+    vista = almacen.vista(momento)
+    assert sorted(r["nombre_comida"] for r in vista) == ["A", "B"]
+    assert len(vista) == 2
+    assert vista.franjas == franjas
+    assert list(almacen.vista("2000-01-01T00:00")) == []
+
+
+def test_vista_no_cambia_con_ediciones_posteriores(tmp_path):
+    almacen = AlmacenRegistros(str(tmp_path / "datos.json"))
+    a, b = nuevo(almacen, "A"), nuevo(almacen, "B")
+    vista = almacen.vista(ahora_iso())
+    antes = [r["nombre_comida"] for r in vista]
+
+    almacen.actualizar(a["id"], {"nombre_comida": "A2"})
+    almacen.borrar([almacen.buscar(b["id"])])
+    nuevo(almacen, "C")
+    assert [r["nombre_comida"] for r in vista] == antes == ["A", "B"]
+
+
+def test_cambiar_franjas_no_toca_los_registros_compartidos(tmp_path):
+    almacen = AlmacenRegistros(str(tmp_path / "datos.json"))
+    registro = nuevo(almacen, "A")
+    franja = almacen.buscar(registro["id"])["franja"]
+    compartido = almacen.rango()[0]
+    momento = ahora_iso()
+
+    almacen.cambiar_franjas({"todo": {"inicio": "00:00", "fin": "23:59"}})
+    actual = almacen.buscar(registro["id"])
+    assert actual["franja"] == "todo" and actual["actualizado"] > compartido["actualizado"]
+    assert compartido["franja"] == franja
+    assert [r["franja"] for r in almacen.vista(momento)] == [franja]
+    assert [r["franja"] for r in almacen.vista(ahora_iso())] == ["todo"]
+
+
+def test_aplicar_alias_no_toca_los_registros_compartidos(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    almacen = AlmacenRegistros(ruta)
+    registro = nuevo(almacen, "A")
+    compartido = almacen.rango()[0]
+    ids = list(compartido["alimentos_ids"])
+    momento = ahora_iso()
+
+    almacen.normalizador.agregar_alias("Pan", "Pan integral")
+    assert almacen.aplicar_alias() == 1
+    actual = almacen.buscar(registro["id"])
+    assert actual["alimentos_ids"] != ids and actual["actualizado"] > compartido["actualizado"]
+    assert compartido["alimentos_ids"] == ids
+    assert [r["alimentos_ids"] for r in almacen.vista(momento)] == [ids]
+    assert AlmacenRegistros(ruta).buscar(registro["id"])["alimentos_ids"] == actual["alimentos_ids"]
+
+    almacen.deshacer()
+    assert almacen.buscar(registro["id"])["alimentos_ids"] == ids
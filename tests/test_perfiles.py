@@ -0,0 +1,70 @@
+"""Perfiles: alta, cambio de perfil con carga perezosa y resúmenes en paralelo"""
+import json
+import os
+
+import pytest
+
+from control_azucar_app import GestorPerfiles
+
+
+def apuntar(almacen, nombre, antes, despues):
+    almacen.agregar(almacen.crear_registro(nombre, [nombre], antes, despues))
+
+
+def estado(ruta):
+    with open(ruta, "rb") as f:
+        return os.stat(ruta).st_mtime_ns, f.read()
+
+
+@pytest.fixture
+def perfiles(tmp_path):
+    gestor = GestorPerfiles(str(tmp_path / "datos.json"))
+    apuntar(gestor.almacen(), "Pan", 100, 150)
+    gestor.crear("Ana María")
+    return gestor
+
+
+def test_crear_y_buscar_perfil(perfiles):
+    assert perfiles.claves() == ["principal", "ana_maria"]
+    assert perfiles.buscar("ANA MARÍA") == "ana_maria"
+    assert perfiles.buscar("nadie") is None
+    with pytest.raises(ValueError):
+        perfiles.crear("ana maria")
+
+
+def test_cambiar_de_perfil_libera_el_anterior(perfiles):
+    principal = perfiles.almacen()
+    ana = perfiles.activar("ana_maria")
+    assert ana is not principal and ana.registros == []
+    assert list(perfiles._almacenes) == ["ana_maria"]
+    apuntar(ana, "Arroz", 90, 180)
+
+    otro = GestorPerfiles(perfiles.datos_file)
+    assert otro.activo == "ana_maria"
+    assert otro._almacenes == {}  # Nada se carga hasta que se pide
+    assert [r["nombre_comida"] for r in otro.almacen().registros] == ["Arroz"]
+    assert [r["nombre_comida"] for r in otro.activar("principal").registros] == ["Pan"]
+
+
+@pytest.mark.parametrize("procesos", [1, 2])
+def test_resumen_todos(perfiles, procesos):
+    apuntar(perfiles.activar("ana_maria"), "Arroz", 90, 180)
+    resumen = perfiles.resumen_todos(procesos=procesos)
+    assert resumen["perfiles"]["principal"]["registros"] == 1
+    assert resumen["perfiles"]["ana_maria"]["registros"] == 1
+    assert resumen["total"]["lecturas"] == 4
+    assert resumen["perfiles"]["principal"]["sensor"] is None
+
+
+def test_resumen_todos_no_escribe_en_los_perfiles(perfiles):
+    # Un perfil antiguo sin ids ni alimentos normalizados: cargarlo con un almacén lo migraría
+    ruta = perfiles.ruta("ana_maria")
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump({"registros": [{"fecha": "2024-01-01", "hora": "08:00", "nombre_comida": "Pan",
+                                  "azucar_antes": 100, "alimentos": ["Pan"]}], "configuracion": {}}, f)
+    antes = estado(ruta)
+
+    resumen = perfiles.resumen_todos(procesos=2)
+    assert resumen["perfiles"]["ana_maria"]["registros"] == 1
+    assert estado(ruta) == antes
+    assert not os.path.exists(os.path.join(os.path.dirname(ruta), "ana_maria_eventos.jsonl"))
@@ -0,0 +1,52 @@
+"""Autocompletado por prefijo de IndiceSugerencias"""
+import random
+from datetime import datetime, timedelta
+
+from control_azucar_app import IndiceSugerencias
+
+
+def esperado(indice, prefijo, k):
+    claves = [c for c in indice._entradas if c.startswith(prefijo)]
+    claves.sort(key=lambda c: indice._entradas[c][3], reverse=True)
+    return [indice._entradas[c][0] for c in claves[:k]]
+
+
+def test_prefijos_cortos_coinciden_con_el_recorrido_completo():
+    azar = random.Random(1)
+    nombres = [a + b + c for a in "abc" for b in "aeiou" for c in "lmnrst"]
+    indice = IndiceSugerencias()
+    usos = []
+    inicio = datetime(2024, 1, 1)
+    for paso in range(3000):
+        if usos and azar.random() < 0.3:
+            indice.quitar(*usos.pop(azar.randrange(len(usos))))
+        else:
+            uso = (azar.choice(nombres), (inicio + timedelta(minutes=azar.randrange(10 ** 6))).isoformat())
+            indice.registrar(*uso)
+            usos.append(uso)
+        if paso % 7 == 0:
+            prefijo = azar.choice(["a", "b", "c", "ae", "bi", "cu", "aem", "x"])
+            k = azar.choice([1, 5, 8, 16, 20])
+            assert indice.completar(prefijo, k) == esperado(indice, prefijo, k)
+
+
+def test_completar_sin_prefijo_da_el_top():
+    indice = IndiceSugerencias()
+    for nombre in ["Pan", "Pan", "Arroz"]:
+        indice.registrar(nombre, "2024-01-01T08:00")
+    assert indice.completar("") == ["Pan", "Arroz"]
+    assert indice.completar("PÁ") == ["Pan"]
+
+
+def test_quitar_sin_fecha_no_borra_un_nombre_con_usos():
+    indice = IndiceSugerencias()
+    for momento in [None, "no es una fecha", "2024-01-01T08:00"]:
+        indice.registrar("Pan", momento)
+    indice.registrar("Arroz", "2024-01-01T08:00")
+    indice.quitar("Pan", None)
+    indice.quitar("Pan", "no es una fecha")
+    assert indice.completar("pa") == ["Pan"]
+    assert indice._entradas["pan"][1] == 1
+    assert indice.completar("") == [c[0] for c in sorted(indice._entradas.values(), key=lambda e: -e[3])]
+    indice.quitar("Pan", "2024-01-01T08:00")
+    assert indice.completar("") == ["Arroz"]